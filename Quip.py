@@ -24,15 +24,18 @@ from gui.emoticons import Ui_Emoticons
 from gui.settings import Ui_Settings
 from gui.Resources import FLAGS, EMOTE_PATTERN, EMOTICONS, RESOURCE_PATTERN, EMOTICON_RESOURCES, URL_PATTERN, Friend, \
     EXT, MIMETYPES
-from gui.Utilities import updateRemoteProfile, signIn, messageBox, bytes2human, Background, emailValidation, patronWebsite
+from gui.Utilities import updateRemoteProfile, signIn, messageBox, bytes2human, Background, emailValidation, patronWebsite, \
+    LoopWatcher, QtEventLoop
 from lib.Config import Configuration
 from lib import Exceptions
 from lib.Constants import STATUS_OFFLINE, STATUS_INVISIBLE, STATUS_AWAY, STATUS_ONLINE, STATUS_BUSY, STATUSES_BASIC, \
-    LIMIT_PROFILE_VALUES
+    LIMIT_PROFILE_VALUES, NOTIFY_MESSAGES, NOTIFY_REQUESTS, NOTIFY_STATUS
 from lib.Utils import isValidUUID, checkCerts
 from lib.Client import ServerClient
 from lib.Database import getProfiles, getAvatar, getFriends, getMasks, updateLocalProfile, delFileRequests, getHistory
 from lib.Countries import COUNTRIES
+from lib.Transfers import Transfers
+from lib.Events import MessageReceived, AvatarUpdated, FileRequest, AuthPending, PresenceChanged
 
 # inbuilt modules
 import asyncio
@@ -189,7 +192,7 @@ class FileTransferWindow(QtGui.QMainWindow):
                     cancelButton.setFlat(True)
                     cancelButton.setFocusPolicy(QtCore.Qt.TabFocus)
                     # cancel transfer signal
-                    cancelButton.clicked.connect(partial(self.cancelTransfer, isIncoming, rowid))
+                    cancelButton.clicked.connect(partial(self.cancelTransfer, isIncoming, rowid, mask, checksum))
                     self.ui.transferTableWidget.setCellWidget(trow, 4, cancelButton)
 
             trow = trow + 1 if transfers else trow
@@ -273,7 +276,7 @@ class FileTransferWindow(QtGui.QMainWindow):
             details = self.loop.run_until_complete(self.client.getDetails((self.friend.mask,)))
             if len(details) > 1:
                 # if we have a valid server response, update local details
-                self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][1]
+                self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][0]
 
                 try:
                     location = self.loop.run_until_complete(retrieve_file)
@@ -286,8 +289,11 @@ class FileTransferWindow(QtGui.QMainWindow):
         except Exceptions.FileCorruption as e:
                     messageBox("warning", str(e))
                     self.server.fileRequests.reload()
+        except Exceptions.TransferCancelled:
+            # cancelled from the transfer list, request is removed by cancelTransfer
+            pass
 
-        if path.isfile(location):
+        if location and path.isfile(location):
             # successfully downloaded
             isIncoming = True if self.ui.transferTableWidget.cellWidget(tableRow, 3) else False
 
@@ -322,14 +328,22 @@ class FileTransferWindow(QtGui.QMainWindow):
         else:
             pbar.setMinimum(0)
             pbar.setMaximum(100)
+            if location is False:
+                # interrupted, partially received file is kept and resumed when accepted again
+                messageBox("warning", "Transfer interrupted: Accept the file again to resume")
 
-    def cancelTransfer(self, isIncoming, storageRow):
+    def cancelTransfer(self, isIncoming, storageRow, mask=None, checksum=None):
         """
         Cancel/Deline transfer, delete local storage information.
 
         @param isIncoming: True fif incoming transfer request, False if outgoing transfer request
         @param storageRow: Row ID of transfer entry in local database
+        @param mask: (Optional) friend mask, stops the transfer if it is queued or running
+        @param checksum: (Optional) file checksum
         """
+        if mask is not None:
+            Transfers.cancel(mask, checksum, outgoing=not isIncoming)
+
         delFileRequests(storageRow)
         if isIncoming:
             self.server.fileRequests.reload()
@@ -1060,19 +1074,74 @@ class ChatWindow(QtGui.QMainWindow):
         self.setAvatar()
         self.setStatus()
 
+        # number of history messages loaded at a time
+        self.historyPage = int(self.client.config.history_page)
+        # rowid of the oldest history message shown, None when no history has been loaded
+        self.historyCursor = None
+        # all stored history has been shown
+        self.historyComplete = False
+
         # draw previous history
-        history = getHistory(self.client.safe, self.client.profileId, self.friend.mask)
-        for recevied, msg, tstamp in ((r, m, t) for rowid, r, m, t in history if rowid not in ignore):
-            name = self.friend.alias if recevied else self.alias
-            # format history messages
-            historyFormat = self.templateBase.format(self.offlineColour, space * 7,
-                                                     name,
-                                                     space * (LIMIT_PROFILE_VALUES['alias'] - len(name))).replace("positional", "{}")
-            self.ui.historyTextBrowser.append(historyFormat.format(tstamp, msg.replace('\n', '<br />')))
+        history = getHistory(self.client.safe, self.client.profileId, self.friend.mask, limit=self.historyPage)
+        self.historyComplete = len(history) < self.historyPage
+        if history:
+            self.historyCursor = history[-1][0]
+        # history is returned newest first
+        for recevied, msg, tstamp in ((r, m, t) for rowid, r, m, t in reversed(history) if rowid not in ignore):
+            self.ui.historyTextBrowser.append(self._historyHtml(recevied, msg, tstamp))
+
+        # load older history when scrolled to the top
+        self.ui.historyTextBrowser.verticalScrollBar().valueChanged.connect(self.loadHistory)
 
         # ensure the msg area has foxus
         self.ui.chatTextEdit.setFocus()
 
+    def _historyHtml(self, received, msg, tstamp):
+        """
+        Format a stored history message
+
+        @param received: message was sent by friend
+        @param msg: message text
+        @param tstamp: message datestamp
+        @return: html formatted message
+        """
+        space = '&nbsp;'
+        name = self.friend.alias if received else self.alias
+        historyFormat = self.templateBase.format(self.offlineColour, space * 7,
+                                                 name,
+                                                 space * (LIMIT_PROFILE_VALUES['alias'] - len(name))).replace("positional", "{}")
+
+        return historyFormat.format(tstamp, msg.replace('\n', '<br />'))
+
+    def loadHistory(self, value):
+        """
+        Prepend the previous page of history when the history area is scrolled to the top
+
+        @param value: vertical scroll bar position
+        """
+        scrollBar = self.ui.historyTextBrowser.verticalScrollBar()
+        if value != scrollBar.minimum() or self.historyComplete or self.historyCursor is None:
+            return
+
+        history = getHistory(self.client.safe, self.client.profileId, self.friend.mask, limit=self.historyPage,
+                             before=self.historyCursor)
+        self.historyComplete = len(history) < self.historyPage
+        if not history:
+            return
+
+        self.historyCursor = history[-1][0]
+
+        # insert at the start of the document, oldest message first
+        previous = scrollBar.maximum()
+        cursor = QtGui.QTextCursor(self.ui.historyTextBrowser.document())
+        cursor.movePosition(QtGui.QTextCursor.Start)
+        for rowid, received, msg, tstamp in reversed(history):
+            cursor.insertHtml(self._historyHtml(received, msg, tstamp))
+            cursor.insertBlock()
+
+        # keep the previously top message in view
+        scrollBar.setValue(scrollBar.maximum() - previous)
+
     def eventFilter(self, widget, event):
         """
         Allows SHIFT+ENTER to insert new lines in chat text area without submitting message.
@@ -1115,7 +1184,7 @@ class ChatWindow(QtGui.QMainWindow):
                 details = self.loop.run_until_complete(self.client.getDetails((self.friend.mask,)))
                 if len(details) > 1:
                     # if we have a valid server response, update local details
-                    self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][1]
+                    self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][0]
 
                     try:
                         success = self.loop.run_until_complete(file_request)
@@ -1209,7 +1278,7 @@ class ChatWindow(QtGui.QMainWindow):
             details = yield from self.client.getDetails((self.friend.mask,))
             if len(details) > 1:
                 # if we have a valid server response, update local details
-                self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][1]
+                self.p2pClient.friends[self.friend.uid] = details[self.friend.mask][0]
 
                 try:
                     # second attempt at message sending
@@ -1397,22 +1466,34 @@ class FriendsList(QtGui.QMainWindow):
         self.alias = ''
         self.commentColour = '#8d8d8d'
 
-        # periodic server check for messages and transfers, every 300ms
-        self.timer = QtCore.QTimer(self)
-        self.timer.timeout.connect(self.checkServer)
-        self.timer.start(300)
-
-        # periodic offline msg check (15secs)
+        # run the loop when it has work to do (P2P connections, presence beacons, server notifications)
+        self.watcher = LoopWatcher(self.loop, self)
+        # P2P server events, handled by the Qt event loop once the loop step publishing them ends
+        for eventType, handler in ((MessageReceived, self.messageReceived), (AvatarUpdated, self.avatarUpdated),
+                                   (FileRequest, self.fileRequested), (AuthPending, self.authPending),
+                                   (PresenceChanged, self.presenceChanged)):
+            self.server.events.subscribe(eventType, partial(self._deferEvent, handler))
+        # auth tokens of accepted friend requests not yet stored by the quip server
+        self.authTokens = []
+
+        # periodic offline msg check (15secs), every push_poll seconds while server notifications are received
         self.mtimer = QtCore.QTimer(self)
-        self.mtimer.timeout.connect(self.getMessages)
+        self.mtimer.timeout.connect(self.pollServer)
         self.mtimer.start(15000)
 
-        # TODO: replace with UDP heartbeat
+        # periodic friend request check (5secs), every push_poll seconds while server notifications are received
         self.ftimer = QtCore.QTimer(self)
         self.ftimer.timeout.connect(self.getRequests)
-        # every 5 seconds
         self.ftimer.start(5000)
 
+        # periodic P2P connection pool maintenance (30secs)
+        self.ptimer = QtCore.QTimer(self)
+        self.ptimer.timeout.connect(self.p2pClient.prune)
+        self.ptimer.start(30000)
+
+        self.subscribed = False
+        self.subscribe()
+
         ######################
         # Additional UI setup
         ######################
@@ -1469,6 +1550,8 @@ class FriendsList(QtGui.QMainWindow):
 
 
     def closeEvent(self, event):
+        self.watcher.setEnabled(False)
+        self.client.unsubscribe()
         self.p2pClient.shutdown()
         self.server.stop(self.loop)
         event.accept()
@@ -1506,6 +1589,7 @@ class FriendsList(QtGui.QMainWindow):
 
         if success:
             self.status = status
+            self.server.presence.setStatus(status)
             self.setAvatarStatus()
         else:
             messageBox('warning', 'Unable to change status, try again later')
@@ -1524,20 +1608,188 @@ class FriendsList(QtGui.QMainWindow):
 
         self.ui.avatarLabel.setStyleSheet('\n'.join(style))
 
+    def subscribe(self):
+        """
+        Subscribe to server notifications, the server is polled every push_poll seconds while subscribed
+        """
+        try:
+            self.subscribed = self.loop.run_until_complete(self.client.subscribe(self._notified))
+        except RuntimeError:
+            # loop busy, try again on the next poll
+            self.subscribed = False
+
+        if self.subscribed:
+            self.mtimer.setInterval(int(self.client.config.push_poll) * 1000)
+            self.ftimer.setInterval(int(self.client.config.push_poll) * 1000)
+        else:
+            self.mtimer.setInterval(15000)
+            self.ftimer.setInterval(5000)
+
+    def _notified(self, kind, uid):
+        """
+        Server notification received, handled once the loop step receiving it ends
+        """
+        QtCore.QTimer.singleShot(0, partial(self.notification, kind))
+
+    def notification(self, kind):
+        """
+        Act on a server notification, kind None when the subscription ended
+        """
+        if kind is None:
+            if self.isVisible():
+                # poll as often as before until subscribed again
+                self.subscribe()
+        elif kind == NOTIFY_MESSAGES:
+            self.getMessages()
+        elif kind == NOTIFY_REQUESTS:
+            self.getRequests()
+        elif kind == NOTIFY_STATUS:
+            self.drawFriendlist()
+
+    def pollServer(self):
+        """
+        Check for server stored messages, subscribing to server notifications again if the subscription ended
+        """
+        if not self.client.subscribed and ServerClient.push is not False:
+            self.subscribe()
+
+        self.getMessages()
+        # auth tokens the quip server could not be sent before
+        self.sendAuthTokens()
+
+    def _deferEvent(self, handler, event):
+        """
+        P2P server event subscriber, handlers may run the loop so are called from the Qt event loop
+        """
+        QtCore.QTimer.singleShot(0, partial(handler, event))
+
+    def messageReceived(self, event):
+        """
+        Show a message received by the P2P server in its chat window
+        """
+        self.routeMessages(event.uid, [(event.rowid, event.message, event.timestamp)])
+
+    def avatarUpdated(self, event):
+        # redraw friend list with the new avatar
+        self.drawFriendlist()
+
+    def fileRequested(self, event):
+        # bring up file transfer request window
+        self.fileTransferWindow(refresh=True)
+
+    def authPending(self, event):
+        self.authTokens.append(event.token)
+        self.sendAuthTokens()
+
+    def sendAuthTokens(self):
+        """
+        Send auth tokens of accepted friend requests to the quip server, tokens which fail are sent on the next poll
+        """
+        if not self.authTokens:
+            return
+
+        sent = 0
+        for token in self.authTokens:
+            try:
+                success = self.loop.run_until_complete(self.client.addAuthorisationToken(token=token))
+            except RuntimeError:
+                success = False
+
+            if success is not True:
+                # unable to send to server, try again later
+                break
+            sent += 1
+
+        del self.authTokens[:sent]
+        if sent:
+            # show new friends
+            self.drawFriendlist()
+
+    def presenceChanged(self, event):
+        """
+        Update a friend's status and address from their presence beacons
+        """
+        friend = self.friends.get(event.uid)
+        if friend is None:
+            return
+
+        if event.status != STATUS_OFFLINE:
+            self.p2pClient.friends[event.uid] = event.address
+        if friend.status != event.status:
+            self.friends[event.uid] = friend._replace(status=event.status)
+            self.redrawFriendlist()
+
     def getMessages(self):
         """
         Check for server stored messages (sent to user while user was offline or not contactable)
+
+        Messages are shown in their chat windows batch by batch, as they are received
         """
+        # mask -> uid
+        uids = {mask: uid for uid, mask in (getMasks(self.client.safe, self.client.profileId) or {}).items()}
+
+        # timers must not use the loop while batches are drawn
+        timers = (self.mtimer, self.ftimer, self.ptimer)
+        for timer in timers:
+            timer.blockSignals(True)
+        self.watcher.setEnabled(False)
         try:
-            messages = self.loop.run_until_complete(self.client.getMessages())
+            messages = self.loop.run_until_complete(self.client.getMessages(callback=partial(self._storedMessages,
+                                                                                             uids)))
         except RuntimeError:
-            # currently waiting on read()
-            messages = None
+            # loop busy, check again on the next timer
+            messages = {}
+        finally:
+            for timer in timers:
+                timer.blockSignals(False)
+            self.watcher.setEnabled(True)
+
+        if messages:
+            # pending message counts
+            self.redrawFriendlist()
+
+    def _storedMessages(self, uids, mask, messages):
+        """
+        Show a batch of server stored messages, see ServerClient.getMessages()
+        """
+        uid = uids.get(mask)
+        if uid is None:
+            # friend deleted, messages are kept in history
+            return
+
+        self.routeMessages(uid, messages, redraw=False)
+        # draw batch before the next one is received
+        QtGui.QApplication.processEvents(QtCore.QEventLoop.ExcludeUserInputEvents)
 
-        # add to server message storage for GUI retrieval
-        for uid, msgs in messages.items():
-            for msg in msgs:
-                self.server.messages[uid].append(msg)
+    def routeMessages(self, uid, messages, redraw=True):
+        """
+        Send messages to their friend's chat window, creating the window if needed
+
+        @param uid: friend uid
+        @param messages: [(rowid, message, timestamp),]
+        @param redraw: redraw the friend list with the friend's pending message count
+        """
+        mask = self.p2pClient.masks[uid]
+        try:
+            w = getattr(self, mask)
+        except AttributeError:
+            f = self.friends[uid]
+            setattr(self, f.mask, ChatWindow(self.alias, f, self.getProfile(uid), self.p2pClient, self.client,
+                                             self.fileTransferWindow, self.server.fileRequestsOut.reload,
+                                             ignore=[rowid for rowid, message, ts in messages], loop=self.loop))
+            w = getattr(self, mask)
+
+        for (rowid, msg, tstamp) in messages:
+            # decode bytes data received by server
+            w.receiveMessage(msg.decode('utf-8'), timestamp=tstamp)
+
+        if not w.isActiveWindow():
+            self.pending[uid] += len(messages)
+        else:
+            self.pending[uid] = 0
+
+        if redraw:
+            self.redrawFriendlist()
 
     def getRequests(self):
         """
@@ -1557,65 +1809,6 @@ class FriendsList(QtGui.QMainWindow):
                                                           loop=self.loop)
                 self._friendRequestWindow.show()
 
-    def checkServer(self):
-        """
-        Check P2P Server for waiting messages or transfer requests
-        """
-        # send messages to their appropriate chat window
-        while True:
-            # destructively iterate over message container to ensure all messages are obtained before deletion
-            try:
-                uid, messages = self.server.messages.popitem()
-            except KeyError:
-                break
-
-            mask = self.p2pClient.masks[uid]
-            try:
-                w = getattr(self, mask)
-            except AttributeError:
-                f = self.friends[uid]
-                setattr(self, f.mask, ChatWindow(self.alias, f, self.getProfile(uid), self.p2pClient, self.client,
-                                                 self.fileTransferWindow, self.server.fileRequestsOut.reload,
-                                                 ignore=[rowid for rowid, message, ts in messages], loop=self.loop))
-                w = getattr(self, mask)
-
-            for (rowid, msg, tstamp) in messages:
-                # decode bytes data received by server
-                w.receiveMessage(msg.decode('utf-8'), timestamp=tstamp)
-
-            if not w.isActiveWindow():
-                self.pending[uid] += len(messages)
-            else:
-                self.pending[uid] = 0
-
-            self.drawFriendlist()
-
-        save = False
-        # send auth tokens to server
-        for n, token in enumerate(self.server.auth + self.p2pClient.auth):
-            success = self.loop.run_until_complete(self.client.addAuthorisationToken(token=token))
-
-            try:
-                assert success is True
-            except AssertionError:
-                # unable to send to server, try again later
-                save = True
-                break
-
-        if self.server.auth or self.p2pClient.auth or self.server.avatar:
-            # redraw friend list
-            self.drawFriendlist()
-            self.server.avatar = False
-
-        if not save:
-            self.server.auth.clear()
-            self.p2pClient.auth.clear()
-
-        # incoming file transfer requests
-        if len(self.server.fileRequests):
-            # bring up file transfer request window
-            self.fileTransferWindow(refresh=True)
-
     def invitesWindow(self):
         """
         Create and show Invites window
@@ -1699,34 +1892,27 @@ class FriendsList(QtGui.QMainWindow):
         # uid-> mask
         masks = getMasks(self.client.safe, self.client.profileId)
         if masks:
+            # friends refusing details, they may have removed authorisation rights
+            denied = []
             try:
-                # attempt bulk friend list information update
-                details = self.loop.run_until_complete(self.client.getDetails(tuple(masks.values())))
-            except Exceptions.Unauthorised:
-                # failure on one or more friends
+                # bulk friend list information update
+                details = self.loop.run_until_complete(self.client.getDetails(tuple(masks.values()), denied=denied))
+            except RuntimeError:
+                # draw another time
+                return
+
+            if denied:
                 if retry:
                     # friend acceptance handling time allowance (3 secs)
                     QtCore.QTimer.singleShot(3000, self.drawFriendlist)
                     return
-                else:
-                    denied = []
-                    details = {}
-                    # friend may have removed authorisation rights
-                    for mask in masks.values():
-                        try:
-                            details.update(self.loop.run_until_complete(self.client.getDetails(mask)))
-                        except Exceptions.Unauthorised:
-                            denied.append(mask)
-
-                    for mask in denied:
-                        # delete unauthorised friends
-                        self.loop.run_until_complete(self.client.deleteFriend(mask))
-
-                    # only show authorised users in friend list
-                    masks = {u: m for u, m in masks.items() if m not in denied}
-            except RuntimeError:
-                # draw another time
-                return
+
+                for mask in denied:
+                    # delete unauthorised friends
+                    self.loop.run_until_complete(self.client.deleteFriend(mask))
+
+                # only show authorised users in friend list
+                masks = {u: m for u, m in masks.items() if m not in denied}
 
             # mask-> uid
             uids = {v: k for k, v in masks.items()}
@@ -1738,16 +1924,29 @@ class FriendsList(QtGui.QMainWindow):
                 f = Friend(uids[mask], mask, alias or p['alias'], avatar, p['comment'] or 'No comment', details[mask][1])
                 friends.append(f)
 
-            self.friends = OrderedDict((f.uid, f) for f in sorted(friends, key=lambda x: (x.status == STATUS_ONLINE, x.alias)))
+                if f.status != STATUS_OFFLINE:
+                    # exchange presence beacons with online friends
+                    self.server.presence.track(f.uid, details[mask][0][0])
+
+            self.friends = OrderedDict((f.uid, f) for f in friends)
 
             for uid in (u for u in self.friends.keys() if u not in self.pending):
                 self.pending[uid] = 0
 
-            model = FriendListModel(self.friends, self.pending)
-            delegate = FriendItemDelegate(self.friends)
+            self.redrawFriendlist()
+
+    def redrawFriendlist(self):
+        """
+        Draw the friend list from the current friend details
+        """
+        self.friends = OrderedDict((f.uid, f) for f in sorted(self.friends.values(),
+                                                              key=lambda x: (x.status == STATUS_ONLINE, x.alias)))
+
+        model = FriendListModel(self.friends, self.pending)
+        delegate = FriendItemDelegate(self.friends)
 
-            self.ui.friendsListView.setModel(model)
-            self.ui.friendsListView.setItemDelegate(delegate)
+        self.ui.friendsListView.setModel(model)
+        self.ui.friendsListView.setItemDelegate(delegate)
 
     def drawProfile(self):
         """
@@ -2271,6 +2470,8 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     app = QtGui.QApplication(sys.argv)
+    # run by the main window's LoopWatcher, its sockets are watched by the Qt event loop
+    asyncio.set_event_loop(QtEventLoop())
     if checkCerts():
         mySW = LoginWindow()
         mySW.show()
@@ -80,6 +80,45 @@ CREATE TABLE file_requests(
   checksum    BLOB,
   filesize    BLOB,
   datestamp   BLOB,
+  tree        BLOB,
 
   FOREIGN KEY(friend_mask) REFERENCES friend_mask(friend_mask)
-);
\ No newline at end of file
+);
+
+-- file checksums by keyed hash of file path, details are size:mtime:inode:checksum, tree is
+-- size:mtime:inode:chunk size:digest name:Merkle tree leaves of the file last sent in chunks
+CREATE TABLE file_checksums(
+  profile_id  INTEGER,
+  path_key    BLOB,
+  details     BLOB,
+  tree        BLOB
+);
+
+-- download journals of partially received files, one checksum per completely received chunk
+CREATE TABLE file_partials(
+  profile_id  INTEGER,
+  request_id  INTEGER,
+  location    BLOB,
+  chunk_size  INTEGER
+);
+
+CREATE TABLE file_partial_chunks(
+  request_id  INTEGER,
+  chunk       INTEGER,
+  checksum    BLOB
+);
+
+-- lookup indexes, every query filters on the logged in profile (and usually the friend mask)
+CREATE INDEX friend_mask_profile_mask ON friend_mask(profile_id, friend_mask);
+CREATE INDEX friends_profile_mask ON friends(profile_id, friend_mask);
+CREATE INDEX friend_auth_profile_mask ON friend_auth(profile_id, friend_mask);
+CREATE INDEX address_profile_mask ON address(profile_id, friend_mask);
+CREATE INDEX history_profile_mask_datestamp ON history(profile_id, friend_mask, datestamp);
+CREATE INDEX friend_requests_profile_outgoing ON friend_requests(profile_id, outgoing);
+CREATE INDEX file_requests_profile_outgoing_mask ON file_requests(profile_id, outgoing, friend_mask);
+CREATE UNIQUE INDEX file_checksums_profile_path ON file_checksums(profile_id, path_key);
+CREATE UNIQUE INDEX file_partials_profile_request ON file_partials(profile_id, request_id);
+CREATE UNIQUE INDEX file_partial_chunks_request_chunk ON file_partial_chunks(request_id, chunk);
+
+-- schema version, see MIGRATIONS in lib/Database.py
+PRAGMA user_version = 6;
@@ -2,7 +2,9 @@
 # UItility functions used by the Graphic User Interface
 #
 import asyncio
+import heapq
 import logging
+import selectors
 from uuid import uuid4
 from PySide import QtGui, QtCore
 from lib import Exceptions
@@ -172,3 +174,202 @@ class Background(QtCore.QThread):
             except Exception as e:
                 self.result = e
                 #logging.debug("[Thread {}] Function failed with error: {}".format(self.currentThreadId(), e))
+
+
+class QtSelector(selectors.BaseSelector):
+    """
+    Selector of a QtEventLoop, watching each registered file descriptor with a QSocketNotifier so the Qt event loop
+    notices when the asyncio loop has I/O to process.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # fd -> selector event -> QSocketNotifier
+        self.notifiers = {}
+        self.enabled = True
+        # called when a watched file descriptor is ready
+        self.activated = None
+
+    def register(self, fileobj, events, data=None):
+        key = self.selector.register(fileobj, events, data)
+        self._watch(key.fd, events)
+        return key
+
+    def unregister(self, fileobj):
+        key = self.selector.unregister(fileobj)
+        self._watch(key.fd, 0)
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        key = self.selector.modify(fileobj, events, data)
+        self._watch(key.fd, events)
+        return key
+
+    def select(self, timeout=None):
+        return self.selector.select(timeout)
+
+    def get_map(self):
+        return self.selector.get_map()
+
+    def close(self):
+        for fd in list(self.notifiers):
+            self._watch(fd, 0)
+        self.selector.close()
+
+    def setEnabled(self, enabled):
+        """
+        Stop (or restart) watching file descriptors
+        """
+        self.enabled = enabled
+        for notifiers in self.notifiers.values():
+            for notifier in notifiers.values():
+                notifier.setEnabled(enabled)
+
+    def _watch(self, fd, events):
+        """
+        Create and remove the notifiers of a file descriptor to match the events it is registered for
+        """
+        notifiers = self.notifiers.setdefault(fd, {})
+        for event, kind in ((selectors.EVENT_READ, QtCore.QSocketNotifier.Read),
+                            (selectors.EVENT_WRITE, QtCore.QSocketNotifier.Write)):
+            if events & event and event not in notifiers:
+                notifier = notifiers[event] = QtCore.QSocketNotifier(fd, kind)
+                notifier.setEnabled(self.enabled)
+                notifier.activated.connect(self._activated)
+            elif not events & event and event in notifiers:
+                notifier = notifiers.pop(event)
+                notifier.setEnabled(False)
+                notifier.deleteLater()
+
+        if not notifiers:
+            del self.notifiers[fd]
+
+    def _activated(self, fd):
+        if self.activated is not None:
+            self.activated()
+
+
+class QtEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop run by a LoopWatcher from the Qt event loop. Its sockets are watched by QSocketNotifiers and callbacks
+    it is given (call_soon(), call_at()) are reported to the watcher, so the loop is only run when it has work to do.
+    """
+    def __init__(self):
+        # set by LoopWatcher
+        self.watcher = None
+        self.notifiers = QtSelector()
+        super().__init__(self.notifiers)
+
+    def call_soon(self, callback, *args, **kwargs):
+        handle = super().call_soon(callback, *args, **kwargs)
+        if self.watcher is not None:
+            self.watcher.ready()
+        return handle
+
+    def call_at(self, when, callback, *args, **kwargs):
+        handle = super().call_at(when, callback, *args, **kwargs)
+        if self.watcher is not None:
+            self.watcher.scheduled(when)
+        return handle
+
+
+class LoopWatcher(QtCore.QObject):
+    """
+    Runs a QtEventLoop from the Qt event loop whenever it has work to do.
+
+    The GUI only runs the event loop while waiting on a coroutine (run_until_complete), so connections, datagrams and
+    timers of the loop would otherwise wait for the next GUI action. The watcher runs a step of the loop when one of
+    its sockets is ready (QSocketNotifier), it was given a callback, or its next timer is due (a single shot QTimer), an
+    idle client is not woken up.
+    """
+    def __init__(self, loop, parent=None):
+        """
+        Loop watcher constructor
+
+        @param loop: QtEventLoop used by the GUI
+        @param parent: (Optional) QT Parent object
+        """
+        super().__init__(parent)
+
+        self.loop = loop
+        self.enabled = True
+        # the loop was given a callback which may not have run yet
+        self.pending = False
+        # loop times of the loop's timers, earliest first. Cancelled timers only cause a step when they would be due
+        self.deadlines = []
+        self.stepping = False
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.step)
+
+        loop.watcher = self
+        loop.notifiers.activated = self.step
+        self.step()
+
+    def setEnabled(self, enabled):
+        """
+        Stop (or restart) running the loop, e.g. while the GUI is waiting on a coroutine and processing Qt events
+        """
+        self.enabled = enabled
+        self.loop.notifiers.setEnabled(enabled)
+        if enabled:
+            self.step()
+        else:
+            self.timer.stop()
+
+    def ready(self):
+        """
+        The loop was given a callback, see QtEventLoop.call_soon()
+        """
+        self.pending = True
+        self._arm()
+
+    def scheduled(self, when):
+        """
+        The loop was given a timer, see QtEventLoop.call_at()
+
+        @param when: loop time the timer is due
+        """
+        heapq.heappush(self.deadlines, when)
+        self._arm()
+
+    def _arm(self):
+        """
+        Start the timer for the loop's next step, the step arms it again once it is done
+        """
+        if not self.enabled or self.stepping:
+            return
+
+        if self.pending:
+            delay = 0
+        elif self.deadlines:
+            delay = max((self.deadlines[0] - self.loop.time()) * 1000 + 1, 0)
+        else:
+            # idle until a socket is ready or the loop is given a callback
+            self.timer.stop()
+            return
+
+        self.timer.start(int(delay))
+
+    def step(self):
+        """
+        Run the loop's ready callbacks and I/O
+        """
+        if not self.enabled or self.stepping or self.loop.is_running():
+            # the GUI is waiting on a coroutine, stepped once it is done
+            return
+
+        start = self.loop.time()
+        self.stepping = True
+        try:
+            # callbacks given before the step run before it stops
+            self.loop.call_soon(self.loop.stop)
+            self.pending = False
+            self.loop.run_forever()
+        finally:
+            self.stepping = False
+
+        # timers due when the step started have run
+        while self.deadlines and self.deadlines[0] <= start:
+            heapq.heappop(self.deadlines)
+
+        self._arm()
@@ -4,19 +4,25 @@
 
 import asyncio
 import ssl
+import socket
 import logging
 from os import path
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
 from hashlib import sha1, sha384
 from base64 import a85encode, a85decode
+from binascii import hexlify, unhexlify
 from tempfile import mkstemp
 from uuid import uuid4
 from time import time
+from functools import partial
+from itertools import count
+import zlib
 
 from nacl.public import Box, PublicKey, PrivateKey
 from nacl.secret import SecretBox
 from nacl.signing import SigningKey
+from nacl.exceptions import CryptoError
 
 import lib.Constants as CONS
 from lib.Config import Configuration
@@ -25,8 +31,13 @@ from lib.Containers import Friends, FileRequests, Masks
 from lib.Database import storeAccount, updateAccount, getAccount, getSigningKeys, getUidMask, getAuthority, storeHistory,\
     getFriendAuth, updateAddress, getFriendRequests, setUidMask, setFriendAuth, storeAuthority, storeFriendRequest,\
     deleteAccount, getMessageKeys, updateFriendAuth, getLocalAuth, setAddress, storeFileRequest, delFileRequests,\
-    delFriendRequests, getAvatar, getMasks, deleteFriend, getAuthTokens
-from lib.Utils import isValidUUID, sha1sum, encrypt
+    delFriendRequests, getAvatar, getMasks, deleteFriend, getAuthTokens, getFileChecksum, getFileMerkleTree, \
+    getFilePartial, storeFilePartial, storeFilePartialChunk, truncateFilePartial, delFilePartials, delFilePartialChunks, \
+    getFileTree, storeHistoryBatch, Cache
+from lib.Utils import isValidUUID, encrypt, merkleLeaf, merkleVerify, decompress, DIGESTS, CODECS, \
+    CODEC_ERRORS
+from lib.Transfers import Transfers
+from lib.Multiplex import Multiplexer
 
 
 #################
@@ -62,7 +73,7 @@ class TLSClient:
 
         self.config = Configuration()
 
-        # (ip, port) -> (reader, writer, connection timestamp)
+        # (ip, port) -> (reader, writer, connection (P2P: last use) timestamp)
         self.connections = {}
 
         self.profileId = profileId
@@ -77,24 +88,26 @@ class TLSClient:
     # TODO: client timeout on connections changes
 
     @asyncio.coroutine
-    def _connect_host(self, server, port):
+    def _connect_host(self, server, port, key=None):
         """
         Securely connect to a quip server
 
         @param server: ipv4/ipv6 server ip
         @param port: destination TCP port
+        @param key: (Optional) connections key, defaults to (server, port). Allows several connections to one host
         @return: ssl wraped socket
         """
+        key = key or (server, port)
         try:
-            self.connections[(server, port)][1].close()
-            del self.connections[(server, port)]
+            self.connections[key][1].close()
+            del self.connections[key]
         except KeyError:
             pass
 
         reader, writer = yield from asyncio.open_connection(host=server, port=port, ssl=self.context, loop=self.loop)
         writer.transport.set_write_buffer_limits(low=8)
         stamp = datetime.utcnow()
-        self.connections[(server, port)] = (reader, writer, stamp)
+        self.connections[key] = (reader, writer, stamp)
 
         return reader, writer, stamp
 
@@ -108,6 +121,32 @@ class ServerClient(TLSClient):
 
     Handles all interaction between the chat client, and the main Quip server
     """
+    # server answers DETAILS_BULK requests, unknown (None) until the first bulk request
+    bulkDetails = None
+    # server accepts SUBSCRIBE requests, unknown (None) until the first subscription
+    push = None
+
+    def __init__(self, profileId=None, phrase=None, loop=None):
+        """
+        Quip server client constructor
+
+        @param profileId: Profile ID to login with.
+        @param phrase: Profile ID's pass phrase (byte object) for crypto calls
+        @param loop: asyncio loop object. If None, open_connection will use asyncio.events.get_event_loop()
+        """
+        super().__init__(profileId=profileId, phrase=phrase, loop=loop)
+
+        # requests awaiting their response, in the order sent: (request id, Future, response parser, StreamReader)
+        self.pending = deque()
+        self.requestIds = count(1)
+        # serialises writing requests, keeping the order of pending requests and the wire the same
+        self.writing = asyncio.Lock(loop=loop)
+        # task reading the responses of pending requests, see _respond()
+        self.responder = None
+        # message encryption boxes of the logged in session, mask -> Box. Populated on first use, see _box()
+        self.boxes = {}
+        # task reading server notifications, see subscribe()
+        self.subscription = None
 
     def __del__(self):
         """
@@ -136,6 +175,37 @@ class ServerClient(TLSClient):
         self.connections[(CONS.SERVER_IPv4, CONS.SERVER_PORT)] = (reader, writer, stamp)
         return reader, writer, stamp
 
+    def _box(self, mask):
+        """
+        Return message encryption box for given friend
+
+        @param mask: friend mask
+        @return: Box of our private message key and the friend's stored public message key
+        """
+        try:
+            box = self.boxes[mask]
+        except KeyError:
+            box = self.boxes[mask] = Box(PrivateKey(getMessageKeys(self.safe, self.profileId)[0]),
+                                         PublicKey(getAuthority(self.safe, self.profileId, mask)[1]))
+
+        return box
+
+    def _invalidateBox(self, profileId, mask, names):
+        """
+        Cache invalidation listener, removes boxes made from invalidated keys
+
+        @param profileId: profile ID of invalidated values
+        @param mask: friend mask of invalidated values, None for all friends
+        @param names: invalidated database function names, empty for all
+        """
+        if profileId != self.profileId or (names and not {'getAuthority', 'getMessageKeys'}.intersection(names)):
+            return
+
+        if mask is None or 'getMessageKeys' in names:
+            self.boxes.clear()
+        else:
+            self.boxes.pop(mask, None)
+
     def confirmLoggedIn(self):
         """
         Asserts whether user is currently logged in. Potentially raises NotLoggedIn exception
@@ -184,11 +254,142 @@ class ServerClient(TLSClient):
 
         return success
 
+    @asyncio.coroutine
+    def request(self, command, rbytes=None, parse=None):
+        """
+        Send a command to the quip server and wait for its response.
+
+        Requests are pipelined, each command is written as soon as it is made and a single reader task (_respond())
+        hands responses to the requests waiting for them, so concurrent coroutines share the connection without waiting
+        for each other's round trips. The quip server answers the commands of a connection in order, responses are
+        matched to request ids by that order.
+
+        Multi-step exchanges (login, account creation) expect no other requests to be made until they complete.
+
+        @param command: complete command to send
+        @param rbytes: (Optional) length of the response in bytes, otherwise a line (or failure code) is read
+        @param parse: (Optional) coroutine function reading the response from a StreamReader, overrides rbytes. Commands
+                      answered with a success value are read with _readStatus
+        @return: response, empty if the connection was lost
+        """
+        requestId = next(self.requestIds)
+        future = asyncio.Future(loop=self.loop)
+        parse = parse or partial(self._readReply, rbytes=rbytes)
+
+        with (yield from self.writing):
+            if not (yield from self.send(command)):
+                return b''
+
+            self.pending.append((requestId, future, parse, self.connections[(CONS.SERVER_IPv4, CONS.SERVER_PORT)][0]))
+
+        if self.responder is None or self.responder.done():
+            self.responder = asyncio.ensure_future(self._respond(), loop=self.loop)
+
+        return (yield from future)
+
+    @asyncio.coroutine
+    def _respond(self):
+        """
+        Read the responses of pending requests in the order sent, until none are pending
+        """
+        while self.pending:
+            requestId, future, parse, reader = self.pending[0]
+            try:
+                response = yield from parse(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                # requests sent before a reconnection are not answered
+                logging.warning("\t".join(("Quip server response failed", "Request: {}".format(requestId),
+                                            "Reason: {!r}".format(e))))
+                response = b''
+
+            self.pending.popleft()
+            # the request may have been cancelled (timed out) while waiting, its response is still consumed
+            if not future.done():
+                future.set_result(response)
+
+    @staticmethod
+    @asyncio.coroutine
+    def _readReply(reader, rbytes=None):
+        """
+        Read a single response
+
+        @param reader: StreamReader of the connection
+        @param rbytes: number of bytes to read, otherwise readline() used. Failure codes are followed by the server
+                       closing the connection, ending the line or returning a shorter response
+        @return: response
+        """
+        if rbytes is None:
+            return (yield from reader.readline())
+
+        try:
+            return (yield from reader.readexactly(rbytes))
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    @staticmethod
+    @asyncio.coroutine
+    def _readStatus(reader):
+        """
+        Read the response of a command answered with a success value, BTRUE or BFALSE, or a failure code
+
+        A leading 1 or 0 is a complete response, the remainder of a failure code beginning with 1 is left to the
+        requests pending when the server closed the connection after it, which then fail.
+
+        @param reader: StreamReader of the connection
+        @return: response
+        """
+        status = yield from reader.readexactly(1)
+        if status in (CONS.BTRUE, CONS.BFALSE):
+            return status
+
+        try:
+            return b''.join((status, (yield from reader.readexactly(len(CONS.SERVER_BUSY) - 1))))
+        except asyncio.IncompleteReadError as e:
+            return b''.join((status, e.partial))
+
+    @staticmethod
+    @asyncio.coroutine
+    def _readMessages(reader, batches):
+        """
+        Read the response of MESSAGES_GET, stored messages each preceded by a line holding its size and ending with an
+        empty line
+
+        @param reader: StreamReader of the connection
+        @param batches: asyncio.Queue receiving lists of up to LIMIT_MESSAGE_BATCH stored messages as they are read
+        @return: number of stored messages read
+        """
+        stored = []
+        total = 0
+        try:
+            line = yield from reader.readline()
+            if len(line) > 2:
+                while line and line != CONS.WRITE_END:
+                    try:
+                        size = int(line)
+                    except ValueError:
+                        # failure code
+                        break
+                    stored.append((yield from reader.readexactly(size)))
+                    total += 1
+                    if len(stored) >= CONS.LIMIT_MESSAGE_BATCH:
+                        batches.put_nowait(stored)
+                        stored = []
+                    line = yield from reader.readline()
+        finally:
+            # messages read before the connection was lost are still delivered
+            if stored:
+                batches.put_nowait(stored)
+
+        return total
+
     @asyncio.coroutine
     def read(self, rbytes=None):
         """
         Receive from the quip server StreamReader
 
+        NOTE: responses of requests made with request() are read by its reader task, read() is only safe when no
+        request is pending
+
         @param rbytes: number of bytes to read, otherwise readline() used
         @return: received data
         """
@@ -241,10 +442,9 @@ class ServerClient(TLSClient):
             # must be logged in before attemping this action
             raise Exceptions.NotLoggedIn("Unable to delete account without logging in first")
 
-        yield from self.send(b''.join((bytes(str(CONS.LOGIN_DEL), encoding='ascii'), self.uid, self.auth)))
-
         # receive command success value
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.LOGIN_DEL), encoding='ascii'), self.uid, self.auth)),
+                                          parse=self._readStatus)
         if success and int(success) == 1:
             deleteAccount(self.safe, self.profileId, self.uid)
             success = True
@@ -272,11 +472,8 @@ class ServerClient(TLSClient):
 
         # send create command to server
         yield from self.send(bytes(str(CONS.LOGIN_NEW), encoding='ascii'))
-        # send invite code
-        yield from self.send(bytes(code, encoding='ascii'))
-
-        # uid, pid sent back from server
-        output = yield from self.read(256)
+        # send invite code, uid and auth (uuids) are sent back from server
+        output = yield from self.request(bytes(code, encoding='ascii'), 72)
 
         reason = ''
         try:
@@ -296,11 +493,8 @@ class ServerClient(TLSClient):
             self.auth = auth
             self.profileId, self.safe = storeAccount(phrase, uid, auth, alias)
 
-            # send confirmation of stored data
-            yield from self.send(b''.join((uid, auth)))
-
-            # receive command success value
-            success = yield from self.read(2)
+            # send confirmation of stored data, receive command success value
+            success = yield from self.request(b''.join((uid, auth)), parse=self._readStatus)
             if not success or int(success) != 1:
                 logging.error('\t'.join(("Create account failure during account confirmation",
                               "Received UID: {!r}".format(uid),
@@ -325,11 +519,14 @@ class ServerClient(TLSClient):
         if auth is None:
             raise Exceptions.LoginFailure("Invalid passphrase for profile ID: {}".format(profileId))
 
-        # Send login command with uid and pid
-        yield from self.send(b''.join((bytes(str(CONS.LOGIN), encoding='ascii'), self.uid, auth)))
+        # shared keys are computed once per login, and dropped when a friend's stored authority or our message keys
+        # change, or the friend is deleted
+        self.boxes.clear()
+        if self._invalidateBox not in Cache.listeners:
+            Cache.listeners.append(self._invalidateBox)
 
-        # expect return of auth (uuid)
-        data = yield from self.read(64)
+        # Send login command with uid and pid, expect return of auth (uuid)
+        data = yield from self.request(b''.join((bytes(str(CONS.LOGIN), encoding='ascii'), self.uid, auth)), 36)
         try:
             # if integer returned, there was login failure
             int(data)
@@ -338,17 +535,15 @@ class ServerClient(TLSClient):
             auth = data
 
         # send new auth back for confirmation
-        yield from self.send(auth)
-
-        success = yield from self.read(2)
+        success = yield from self.request(auth, parse=self._readStatus)
         if success and int(success) == 1:
-            yield from self.send(b':'.join((bytes(self.config.tcp, encoding='ascii'),
-                                            bytes(self.config.udp, encoding='ascii'),
-                                            bytes(str(CONS.STATUS_ONLINE), encoding='ascii'))))
+            success = yield from self.request(b':'.join((bytes(self.config.tcp, encoding='ascii'),
+                                                         bytes(self.config.udp, encoding='ascii'),
+                                                         bytes(str(CONS.STATUS_ONLINE), encoding='ascii'))),
+                                          parse=self._readStatus)
         else:
             raise Exceptions.LoginFailure("Authentication session token mismatch")
 
-        success = yield from self.read(2)
         if success and int(success) == 1:
             # store new auth value
             updateAccount(self.safe, profileId, auth)
@@ -368,11 +563,116 @@ class ServerClient(TLSClient):
         """
         self.confirmLoggedIn()
         
-        yield from self.send(b''.join((bytes(str(CONS.LOGOUT), encoding='ascii'), self.uid, self.auth)))
-        success = yield from self.read(2)
+        self.unsubscribe()
+        success = yield from self.request(b''.join((bytes(str(CONS.LOGOUT), encoding='ascii'), self.uid, self.auth)),
+                                          parse=self._readStatus)
+
+        try:
+            Cache.listeners.remove(self._invalidateBox)
+        except ValueError:
+            pass
+        self.boxes.clear()
 
         return int(success) == 1 if success else False
 
+    @property
+    def subscribed(self):
+        """
+        @return: True while server notifications are received, see subscribe()
+        """
+        return self.subscription is not None and not self.subscription.done()
+
+    @asyncio.coroutine
+    def subscribe(self, callback):
+        """
+        Subscribe to server notifications of new offline messages, friend requests and friend status changes
+
+        Notifications are received on a connection of their own, so responses to requests stay in order. The
+        subscription ends when that connection is lost, callers should keep polling (less often) while subscribed and
+        subscribe again once subscribed is False.
+
+        @param callback: called with (NOTIFY_* value, friend uid or None) for each notification, and with (None, None)
+                         once the subscription ends
+        @return: True if subscribed
+        """
+        self.confirmLoggedIn()
+
+        if self.subscribed:
+            return True
+        elif ServerClient.push is False:
+            return False
+
+        try:
+            reader, writer = yield from asyncio.open_connection(host=CONS.SERVER_IPv4, port=CONS.SERVER_PORT,
+                                                                ssl=self.context, loop=self.loop)
+        except OSError:
+            logging.info("Unable to connect for quip server notifications")
+            return False
+
+        try:
+            writer.write(b''.join((bytes(str(CONS.SUBSCRIBE), encoding='ascii'), self.uid, self.auth,
+                                   CONS.WRITE_END)))
+            yield from writer.drain()
+            success = yield from reader.readline()
+        except ConnectionError:
+            success = b''
+
+        try:
+            subscribed = int(success) == 1
+        except ValueError:
+            subscribed = False
+
+        if not subscribed:
+            writer.close()
+            if success:
+                # failure code, server does not support notifications
+                ServerClient.push = False
+            return False
+
+        ServerClient.push = True
+        # the connection is idle between notifications, have the OS detect lost connections
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        self.subscription = asyncio.ensure_future(self._notifications(reader, writer, callback), loop=self.loop)
+        return True
+
+    @asyncio.coroutine
+    def _notifications(self, reader, writer, callback):
+        """
+        Pass received notifications to callback until the subscription connection is closed
+        """
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+
+                kind, _, uid = line.rstrip().partition(CONS.NOTIFY_SEPARATOR)
+                try:
+                    kind = int(kind)
+                except ValueError:
+                    logging.info("Invalid quip server notification: {!r}".format(line))
+                    continue
+
+                callback(kind, uid or None)
+        except (ConnectionError, ValueError):
+            # connection lost or line limit exceeded
+            pass
+        finally:
+            writer.close()
+            logging.info("Quip server notifications ended")
+            callback(None, None)
+
+    def unsubscribe(self):
+        """
+        End server notifications
+        """
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+
     @asyncio.coroutine
     def setStatus(self, status):
         """
@@ -388,9 +688,8 @@ class ServerClient(TLSClient):
         except (ValueError, KeyError):
             raise Exceptions.InvalidClientData("Unable to set status, invalid status value provided: {!r}".format(status))
 
-        yield from self.send(b''.join((bytes(str(CONS.STATUS_SET), encoding='ascii'), self.uid, self.auth,
-                                       bytes(str(status), encoding='ascii'))))
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.STATUS_SET), encoding='ascii'), self.uid, self.auth,
+                                                    bytes(str(status), encoding='ascii'))), parse=self._readStatus)
 
         return int(success) == 1 if success else False
 
@@ -413,11 +712,9 @@ class ServerClient(TLSClient):
         # get original friend ID
         friendID = getUidMask(self.safe, self.profileId, mask)
 
-        yield from self.send(b''.join((bytes(str(CONS.DETAILS_GET), encoding='ascii'), self.uid, self.auth, friendID,
-                                       authToken)))
-
         # obtain all addresses associated with friend
-        addr = yield from self.read()
+        addr = yield from self.request(b''.join((bytes(str(CONS.DETAILS_GET), encoding='ascii'), self.uid, self.auth,
+                                                 friendID, authToken)))
         addresses = addr.rstrip()
 
         # store address information
@@ -428,21 +725,26 @@ class ServerClient(TLSClient):
         return addresses
 
     @asyncio.coroutine
-    def getDetails(self, masks):
+    def getDetails(self, masks, denied=None):
         """
         Return details for given friends (e.g. current address, status)
 
+        Details of several friends are requested in DETAILS_BULK requests of up to LIMIT_DETAILS_BULK friends, falling
+        back to one DETAILS_GET request per friend when the server does not support them.
+
         @param masks: localised friend ID (masked uid) iterable contaner, singular also accepted.
+        @param denied: (Optional) list receiving the masks the server refused details for, instead of raising
+                       Unauthorised
         @return: {'mask': ((ip, port), 'status')}
         """
         if type(masks) in (str, bytes):
             masks = (masks,)
 
         # masks must be ascii to continue
-        if type(masks[0]) is bytes:
-            masks = tuple(m.decode('ascii') for m in masks)
+        masks = tuple(m.decode('ascii') if type(m) is bytes else m for m in masks)
 
-        details = {}
+        # (mask, uid, token) of each friend
+        friends = []
         for mask in masks:
             try:
                 token = getFriendAuth(self.safe, self.profileId, mask)[0]
@@ -450,13 +752,32 @@ class ServerClient(TLSClient):
             except IndexError:
                 raise Exceptions.MissingFriend("Friend mask does not exist: {!r}".format(mask))
 
-            yield from self.send(b''.join((bytes(str(CONS.DETAILS_GET), encoding='ascii'), self.uid, self.auth, uid, token)))
-            detail = yield from self.read()
+            friends.append((mask, uid, token))
 
+        responses = []
+        for start in range(0, len(friends), CONS.LIMIT_DETAILS_BULK):
+            batch = friends[start:start + CONS.LIMIT_DETAILS_BULK]
+            bulk = None
+            if len(batch) > 1 and self.bulkDetails is not False:
+                bulk = yield from self._getDetailsBulk(batch)
+
+            if bulk is None:
+                # per friend requests are pipelined, answered in one round trip
+                bulk = yield from asyncio.gather(*[self.request(b''.join((bytes(str(CONS.DETAILS_GET), encoding='ascii'),
+                                                                          self.uid, self.auth, uid, token)))
+                                                   for mask, uid, token in batch], loop=self.loop)
+
+            responses.extend(bulk)
+
+        details = {}
+        for (mask, uid, token), detail in zip(friends, responses):
             try:
                 addr, status, _ = detail.split(bytes(CONS.PROFILE_VALUE_SEPARATOR, encoding='utf-8'))
             except ValueError:
-                raise Exceptions.Unauthorised("Unauthorised to obtain details for mask: {!r}".format(mask))
+                if denied is None:
+                    raise Exceptions.Unauthorised("Unauthorised to obtain details for mask: {!r}".format(mask))
+                denied.append(mask)
+                continue
 
             # update address details for friend
             details[mask] = tuple((addr.decode('ascii').split(':') , int(status)))
@@ -465,6 +786,28 @@ class ServerClient(TLSClient):
 
         return details
 
+    @asyncio.coroutine
+    def _getDetailsBulk(self, friends):
+        """
+        Request the details of several friends in one round trip (DETAILS_BULK)
+
+        @param friends: list of (mask, uid, token)
+        @return: list of DETAILS_GET responses in the order of friends, None if the server does not support the request
+        """
+        output = yield from self.request(b''.join((bytes(str(CONS.DETAILS_BULK), encoding='ascii'), self.uid, self.auth,
+                                                   b''.join(b''.join((uid, token)) for mask, uid, token in friends))))
+
+        # response entries are separated like profile entries, unauthorised entries are empty
+        entries = output.rstrip(CONS.WRITE_END).split(bytes(CONS.PROFILE_ENTRY_SEPARATOR, encoding='utf-8'))
+        if output in CONS.FAILURE_COMMANDS or len(entries) != len(friends):
+            if self.bulkDetails is None:
+                logging.info("Server does not support bulk details requests, requesting details per friend")
+                self.bulkDetails = False
+            return None
+
+        self.bulkDetails = True
+        return entries
+
     @asyncio.coroutine
     def addAuthorisationToken(self, mask=None, token=None):
         """
@@ -487,11 +830,9 @@ class ServerClient(TLSClient):
             # get auth token provided to friend for authorised commands to this (uid) account
             _, token = getFriendAuth(self.safe, self.profileId, mask)
 
-        yield from self.send(b''.join((bytes(str(CONS.AUTH_TOKEN_SET), encoding='ascii'), self.uid, self.auth,
-                                       token)))
-
         # receive command success value
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.AUTH_TOKEN_SET), encoding='ascii'), self.uid,
+                                                    self.auth, token)), parse=self._readStatus)
 
         return int(success) == 1 if success else False
 
@@ -508,10 +849,9 @@ class ServerClient(TLSClient):
         # get auth token provided to friend for authorised commands to this (uid) account
         _, sentToken = getFriendAuth(self.safe, self.profileId, mask)
 
-        yield from self.send(b''.join((bytes(str(CONS.AUTH_TOKEN_DEL), encoding='ascii'), self.uid, self.auth, sentToken)))
-
         # receive command success value
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.AUTH_TOKEN_DEL), encoding='ascii'), self.uid,
+                                                    self.auth, sentToken)), parse=self._readStatus)
 
         if success and int(success) == 1:
             # remove sent auth token from storage
@@ -530,9 +870,8 @@ class ServerClient(TLSClient):
         @return: set of allowed masks
         """
         self.confirmLoggedIn()
-        yield from self.send(b''.join((bytes(str(CONS.AUTH_TOKEN_GET), encoding='ascii'), self.uid, self.auth)))
-
-        allowances = yield from self.read()
+        allowances = yield from self.request(b''.join((bytes(str(CONS.AUTH_TOKEN_GET), encoding='ascii'), self.uid,
+                                                       self.auth)))
 
         return {i.strip() for i in allowances.split(b':')}
 
@@ -558,15 +897,13 @@ class ServerClient(TLSClient):
         friendId = bytes(friendId, encoding='ascii') if type(friendId) is str else friendId
         message = bytes(message, encoding='utf-8') if type(message) is str else message
 
-        yield from self.send(b''.join((bytes(str(CONS.FRIEND_REQUEST), encoding='ascii'), self.uid, self.auth,
-                                       friendId, a85encode(message, foldspaces=True))))
-
-
         # store message hash locally with uid for initial handshake
         storeFriendRequest(self.safe, self.profileId, friendId, message, b'', True)
 
         # receive command success value
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.FRIEND_REQUEST), encoding='ascii'), self.uid,
+                                                    self.auth, friendId, a85encode(message, foldspaces=True))),
+                                          parse=self._readStatus)
 
         return int(success) == 1 if success else False
 
@@ -580,10 +917,9 @@ class ServerClient(TLSClient):
         # confirmed already logged in
         self.confirmLoggedIn()
 
-        yield from self.send(b''.join((bytes(str(CONS.FRIEND_REQUESTS_GET), encoding='ascii'), self.uid, self.auth)))
-
         requests = {}
-        req = yield from self.read()
+        req = yield from self.request(b''.join((bytes(str(CONS.FRIEND_REQUESTS_GET), encoding='ascii'), self.uid,
+                                                self.auth)))
 
         stored = getFriendRequests(self.safe, self.profileId, expire=int(self.config.request_expiry))
         bval = bytes(CONS.PROFILE_VALUE_SEPARATOR, encoding='utf-8')
@@ -632,10 +968,10 @@ class ServerClient(TLSClient):
                                            "Friend request for user {} does not exist".format(uid))))
                 return False
 
-        yield from self.send(b''.join((bytes(str(CONS.FRIEND_REQUEST_DEL), encoding='ascii'),
-                                       self.uid, self.auth, bytes(uid, encoding='ascii') if type(uid) is str else uid)))
-
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.FRIEND_REQUEST_DEL), encoding='ascii'),
+                                                    self.uid, self.auth,
+                                                    bytes(uid, encoding='ascii') if type(uid) is str else uid)),
+                                          parse=self._readStatus)
         if success and int(success) == 1:
             delFriendRequests(rowid)
             success = True
@@ -661,14 +997,13 @@ class ServerClient(TLSClient):
 
         message = bytes(message, encoding='utf-8')
 
-        safe = Box(PrivateKey(getMessageKeys(self.safe, self.profileId)[0]), PublicKey(getAuthority(self.safe, self.profileId, mask)[1]))
-        msg = list(encrypt(safe, message))[0]
+        msg = list(encrypt(self._box(mask), message))[0]
 
         # dest, token, size of message, and message.
-        yield from self.send(b''.join((bytes(str(CONS.MESSAGE_STORE), encoding='ascii'), self.uid, self.auth, uid, token,
-                                       CONS.WRITE_END.join((bytes(str(len(msg)), encoding='ascii'), msg)))))
-
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.MESSAGE_STORE), encoding='ascii'), self.uid,
+                                                    self.auth, uid, token,
+                                                    CONS.WRITE_END.join((bytes(str(len(msg)), encoding='ascii'), msg)))),
+                                          parse=self._readStatus)
 
         if success and int(success) == 1:
             # store history
@@ -680,42 +1015,79 @@ class ServerClient(TLSClient):
         return success
 
     @asyncio.coroutine
-    def getMessages(self):
+    def getMessages(self, callback=None):
         """
         Obtain any offline messages stored on the server
 
-        @param tokenMasks: token->mask dict friend relationship
-        @return: friend mask -> [(timestamp, message),]
+        Messages are handled in batches of up to LIMIT_MESSAGE_BATCH while the rest are still being received. Each batch
+        is decrypted and stored in a single transaction by the loop's default executor, keeping the event loop free,
+        then passed to callback.
+
+        @param callback: (Optional) called with (friend mask, [(rowid, message, timestamp),]) for each friend of a batch
+        @return: friend mask -> [(rowid, message, timestamp),]
         """
         # confirmed already logged in
         self.confirmLoggedIn()
 
-        yield from self.send(b''.join((bytes(str(CONS.MESSAGES_GET), encoding='ascii'), self.uid, self.auth)))
+        messages = defaultdict(list)
+        tokens = None
+
+        batches = asyncio.Queue(loop=self.loop)
+        fetch = asyncio.ensure_future(self.request(b''.join((bytes(str(CONS.MESSAGES_GET), encoding='ascii'), self.uid,
+                                                             self.auth)),
+                                                   parse=partial(self._readMessages, batches=batches)), loop=self.loop)
+        # batches are queued while the response is read, None follows the last one
+        fetch.add_done_callback(lambda f: batches.put_nowait(None))
+
+        while True:
+            batch = yield from batches.get()
+            if batch is None:
+                break
+
+            if tokens is None:
+                tokens = getAuthTokens(self.safe, self.profileId)
+
+            # boxes are only used (not made) by the executor, the box cache is changed from the loop
+            boxes = {mask: self._box(mask) for mask in {tokens.get(msg[:36]) for msg in batch} if mask}
+            received = yield from self.loop.run_in_executor(None, self._storeMessages, tokens, boxes, batch)
+            for mask, msgs in received.items():
+                messages[mask].extend(msgs)
+                if callback is not None:
+                    callback(mask, msgs)
+
+        # raises any error of the request
+        yield from fetch
+
+        return messages
+
+    def _storeMessages(self, tokens, boxes, stored):
+        """
+        Decrypt a batch of offline messages and store them in chat history, called from an executor thread
+
+        @param tokens: auth token -> friend mask
+        @param boxes: friend mask -> message encryption box, see _box()
+        @param stored: stored messages, as read by _readMessages()
+        @return: friend mask -> [(rowid, message, timestamp),]
+        """
+        entries = []
+        for msg in stored:
+            token, tstamp, msg = msg[:36], msg[36:46], msg[46:]
+            # get unmasked uid
+            mask = tokens.get(token)
+            if not mask:
+                continue
+
+            try:
+                # timestamp of message
+                tstamp = datetime.fromtimestamp(int(tstamp)).strftime("%Y-%m-%d %H:%M:%S")
+                entries.append((mask, boxes[mask].decrypt(msg), True, tstamp))
+            except (ValueError, CryptoError):
+                logging.warning("\t".join(("Invalid stored message", "Mask: {}".format(mask))))
 
         messages = defaultdict(list)
-        boxes = {}
-
-        msg = yield from self.read()
-        if len(msg) > 2:
-            tokens = getAuthTokens(self.safe, self.profileId)
-
-            while msg != CONS.WRITE_END:
-                byteSize = int(msg)
-                msg = yield from self.read(byteSize)
-                token, tstamp, msg = msg[:36], msg[:36:46], msg[46:]
-                # get unmasked uid
-                mask = tokens.get(token)
-
-                if mask:
-                    # timestamp of message
-                    tstamp = datetime.fromtimestamp(int(tstamp)).strftime("%Y-%m-%d %H:%M:%S")
-                    storeHistory(self.safe, self.profileId, mask, msg, True, tstamp)
-                    messages[mask].append(boxes.setdefault(mask,
-                                                           Box(PrivateKey(getMessageKeys(self.safe, self.profileId)[0]),
-                                                               PublicKey(getAuthority(self.safe, self.profileId, mask)[1])
-                                                           )).decrypt(msg))
-
-                msg = yield from self.read()
+        for rowid, (mask, msg, fromFriend, tstamp) in zip(storeHistoryBatch(self.safe, self.profileId, entries),
+                                                           entries):
+            messages[mask].append((rowid, msg, tstamp))
 
         return messages
 
@@ -742,11 +1114,10 @@ class ServerClient(TLSClient):
         fields = bytes(CONS.PROFILE_ENTRY_SEPARATOR.join(CONS.PROFILE_VALUE_SEPARATOR.join((k, v)) for k, v in fields.items()),
                        encoding='utf-8')
 
-        yield from self.send(b''.join((bytes(str(CONS.PROFILE_SEARCH), encoding='utf-8'), self.uid, self.auth,
-                                       bytes(CONS.PROFILE_ENTRY_SEPARATOR, encoding='utf-8').join((cursor if cursor is not None else b'0', fields)))))
-
         # output from profile search contains cursor for search continuance and uids
-        output = yield from self.read()
+        output = yield from self.request(b''.join((bytes(str(CONS.PROFILE_SEARCH), encoding='utf-8'), self.uid, self.auth,
+                                                   bytes(CONS.PROFILE_ENTRY_SEPARATOR, encoding='utf-8').join(
+                                                       (cursor if cursor is not None else b'0', fields)))))
         output = output.decode('utf-8').rstrip().split(CONS.PROFILE_ENTRY_SEPARATOR)
 
         # cursor, total profiles found, user ids (empty list if none found)
@@ -774,9 +1145,8 @@ class ServerClient(TLSClient):
         fields = bytes(CONS.PROFILE_ENTRY_SEPARATOR.join(CONS.PROFILE_VALUE_SEPARATOR.join((k, v)) for k, v in fields.items()),
                        encoding='utf-8')
 
-        yield from self.send(b''.join((bytes(str(CONS.PROFILE_SET), encoding='ascii'), self.uid, self.auth, fields)))
-
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.PROFILE_SET), encoding='ascii'), self.uid, self.auth,
+                                                    fields)), parse=self._readStatus)
 
         return int(success) == 1 if success else False
 
@@ -796,10 +1166,9 @@ class ServerClient(TLSClient):
         except AssertionError:
             raise Exceptions.InvalidClientData("User ID passed is invalid format: {}".format(uid))
 
-        yield from self.send(b''.join((bytes(str(CONS.PROFILE_GET), encoding='ascii'),
-                                       self.uid, self.auth, bytes(uid, encoding='ascii') if type(uid) is str else uid)))
-
-        profile = yield from self.read()
+        profile = yield from self.request(b''.join((bytes(str(CONS.PROFILE_GET), encoding='ascii'),
+                                                    self.uid, self.auth,
+                                                    bytes(uid, encoding='ascii') if type(uid) is str else uid)))
 
         if len(profile) < 7:
             # no profile found with provided UID
@@ -817,10 +1186,8 @@ class ServerClient(TLSClient):
         @param email: email address to receive recovery code
         """
         # send email
-        yield from self.send(b''.join((bytes(str(CONS.RECOVERY_EMAIL), encoding='ascii'),
-                                       bytes(email, encoding='utf-8'))))
-
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.RECOVERY_EMAIL), encoding='ascii'),
+                                                    bytes(email, encoding='utf-8'))), parse=self._readStatus)
 
         return int(success) == 1 if success else False
 
@@ -839,12 +1206,9 @@ class ServerClient(TLSClient):
         except AssertionError:
             raise Exceptions.InvalidClientData("Passphrase length less than 8 characters or more than 32")
 
-        # submit code
-        yield from self.send(b''.join((bytes(str(CONS.RECOVERY_CODE), encoding='ascii'),
-                                       bytes(code, encoding='ascii'))))
-
-        # retrieve uid, auth, alias
-        output = yield from self.read()
+        # submit code, retrieve uid, auth, alias
+        output = yield from self.request(b''.join((bytes(str(CONS.RECOVERY_CODE), encoding='ascii'),
+                                                   bytes(code, encoding='ascii'))))
 
         if len(output) > 2:
             # expect uid, auth and alias
@@ -876,10 +1240,9 @@ class ServerClient(TLSClient):
         """
         self.confirmLoggedIn()
 
-        yield from self.send(b''.join((bytes(str(CONS.INVITES_GENERATE), encoding='ascii'), self.uid, self.auth)))
-
         # retrieve generation response
-        output = yield from self.read()
+        output = yield from self.request(b''.join((bytes(str(CONS.INVITES_GENERATE), encoding='ascii'), self.uid,
+                                                   self.auth)))
 
         if len(output) > 4:
             remaining, code = output.split(bytes(CONS.PROFILE_VALUE_SEPARATOR, encoding='utf-8'))
@@ -898,10 +1261,8 @@ class ServerClient(TLSClient):
         """
         self.confirmLoggedIn()
 
-        yield from self.send(b''.join((bytes(str(CONS.INVITES_GET), encoding='ascii'), self.uid, self.auth)))
-
-
-        output = yield from self.read()
+        output = yield from self.request(b''.join((bytes(str(CONS.INVITES_GET), encoding='ascii'), self.uid,
+                                                   self.auth)))
 
         invites = {}
         remaining = 0
@@ -926,9 +1287,8 @@ class ServerClient(TLSClient):
         """
         self.confirmLoggedIn()
 
-        yield from self.send(b''.join((bytes(str(CONS.INVITES_CLEAR), encoding='ascii'), self.uid, self.auth)))
-
-        success = yield from self.read(2)
+        success = yield from self.request(b''.join((bytes(str(CONS.INVITES_CLEAR), encoding='ascii'), self.uid,
+                                                    self.auth)), parse=self._readStatus)
 
         return True if success == CONS.BTRUE else False
 
@@ -960,6 +1320,21 @@ class P2PClient(TLSClient):
         self.auth = []
         # hash chain of messages
         self.hashchain = defaultdict(bytes)
+        # serialises sends of each hash chain, see send()
+        self.chainLocks = defaultdict(partial(asyncio.Lock, loop=self.loop))
+        # negotiated P2P protocol version: (ip, port) -> version
+        self.protocols = {}
+        # multiplexed (v6) connections: (ip, port) -> Multiplexer, connections of such friends are streams
+        self.muxes = {}
+        # channel numbers of file and avatar transfers, unique so transfers never share a connection
+        self.channelIds = count(1)
+        # connection pool limits, see prune()
+        self.maxConnections = int(self.config.max_peer_connections)
+        self.idleTimeout = int(self.config.peer_idle)
+        # connections used by running file transfers are not evicted: (ip, port) -> number of transfers
+        self.busy = Counter()
+        # connection pool metrics: opened, reused, evicted and failed connections
+        self.poolStats = Counter()
 
         sec, _ = getSigningKeys(self.safe, self.profileId)
         # signing object created from stored private key
@@ -979,51 +1354,299 @@ class P2PClient(TLSClient):
             except Exception:
                 pass
 
+        for mux in self.muxes.values():
+            mux.close()
+        self.muxes.clear()
+
     @asyncio.coroutine
-    def send(self, uid, command, data, address=None, sign=True):
+    def _connect_host(self, server, port, key=None):
         """
-        Attempt to send given command to friend's (uid) P2P server
+        Securely connect to a friend's P2P server and negotiate the protocol version.
 
-        @param uid: destination friend's ID
-        @param command: command integer to send
-        @param data: data sent with initial command (to be signed)
-        @param address: (optional) Direct IP address tuple
-        @param sign: digitally sign sent data
-        @return: True if successfully sent, else False
+        Peers which do not answer the negotiation (protocol v1 servers) are reconnected to and remembered as v1. Once
+        v6 is negotiated the connection is multiplexed, and this and further connections to the friend are streams of
+        it (the (server, port) connection being the control stream) rather than new TLS connections.
+
+        @param server: ipv4/ipv6 server ip
+        @param port: destination TCP port
+        @param key: (Optional) connections key, defaults to (server, port)
+        @return: StreamReader, StreamWriter and timestamp (UTC) of new connection
         """
-        addr = address or self.friends[uid]
+        mux = self.muxes.get((server, port))
+        if mux is not None and not mux.closed:
+            return self._openStream(mux, server, port, key)
+
+        reader, writer, stamp = yield from super()._connect_host(server, port, key)
+
+        if self.protocols.get((server, port), CONS.PROTOCOL_VERSION) > 1:
+            writer.write(b''.join((bytes(str(CONS.PROTOCOL_NEGOTIATE), encoding='ascii'),
+                                   bytes(str(CONS.PROTOCOL_VERSION), encoding='ascii'), CONS.WRITE_END)))
+            try:
+                yield from writer.drain()
+                version = yield from asyncio.wait_for(reader.readline(), CONS.NEGOTIATE_TIMEOUT)
+                version = int(version)
+            except (asyncio.TimeoutError, ConnectionError, ValueError):
+                version = 1
+
+            self.protocols[(server, port)] = version
+            if version == 1:
+                # v1 servers close the connection on unknown commands
+                logging.info("Host {!r} does not support protocol negotiation, using v1".format((server, port)))
+                reader, writer, stamp = yield from super()._connect_host(server, port, key)
+            elif version >= CONS.PROTOCOL_MULTIPLEX:
+                # the connection now belongs to the Multiplexer, _openStream() must not close it
+                del self.connections[key or (server, port)]
+                mux = self.muxes[(server, port)] = Multiplexer(reader, writer, self.loop)
+                mux.start()
+                return self._openStream(mux, server, port, key)
+
+        return reader, writer, stamp
+
+    def _openStream(self, mux, server, port, key=None):
+        """
+        Open a stream of a multiplexed connection, replacing the connection stored under key
+
+        @param mux: Multiplexer of the friend's connection
+        @param server: ipv4/ipv6 server ip
+        @param port: destination TCP port
+        @param key: (Optional) connections key, defaults to (server, port) which is the control stream
+        @return: stream (as reader and writer) and timestamp (UTC) of the new stream
+        """
+        key = key or (server, port)
+        try:
+            self.connections.pop(key)[1].close()
+        except KeyError:
+            pass
+
+        stream = mux.open(CONS.PRIORITY_CONTROL if key == (server, port) else CONS.PRIORITY_BULK)
+        stamp = datetime.utcnow()
+        self.connections[key] = (stream, stream, stamp)
+
+        return stream, stream, stamp
+
+    def _transferChannel(self, addr):
+        """
+        Connection channel for a file or avatar transfer. Transfers with multiplexing friends get a stream of their
+        own, so chat is not held up by the transfer. Other friends use the main connection, avoiding another TLS
+        connection.
+
+        @param addr: friend's (ip, port), connected to
+        @return: channel number
+        """
+        return next(self.channelIds) if self.protocols.get(addr, 1) >= CONS.PROTOCOL_MULTIPLEX else 0
+
+    def _frame(self, addr, command, data, sign):
+        """
+        Format outgoing command data for the negotiated protocol version of the destination. Protocol v5 payloads of
+        COMPRESS_MIN_SIZE bytes or more are compressed.
+
+        @param addr: destination (ip, port)
+        @param command: command integer, '' to send data without command framing
+        @param data: command data, signed data if sign is True
+        @param sign: data is signed
+        @return: bytes to write
+        """
+        if command == '':
+            # continuation data of a command is sent as is
+            return data
+
+        version = self.protocols.get(addr, 1)
+        if version > 1:
+            flags = CONS.FRAME_SIGNED if sign else 0
+            if version >= CONS.PROTOCOL_COMPRESSION and len(data) >= CONS.COMPRESS_MIN_SIZE and \
+                    self.config.compression != 'none':
+                # large messages (pastes, logs) are zlib compressed when it reduces their size
+                compressed = zlib.compress(data, int(self.config.compression_level))
+                if len(compressed) < len(data):
+                    flags |= CONS.FRAME_COMPRESSED
+                    data = compressed
+
+            return b''.join((CONS.FRAME_HEADER.pack(int(command), flags, len(data)), data))
+
+        return b''.join((bytes(str(command), encoding='ascii'), a85encode(data, foldspaces=True) if sign else data,
+                         CONS.WRITE_END if sign else b''))
 
+    @asyncio.coroutine
+    def _connection(self, uid, addr, channel=0):
+        """
+        Return the connection to a friend's P2P server, connecting if required
+
+        @param uid: friend's user ID
+        @param addr: friend's (ip, port)
+        @param channel: connection number, channels other than 0 are additional connections used for file transfers
+        @return: StreamReader, StreamWriter and timestamp (UTC) of the connection
+        """
         if addr is None:
             # intended to prompt frontend to obtain address from quip server object
             raise Exceptions.ConnectionFailure("No IP address found locally for friend, contact server for address")
 
+        key = addr + (channel,) if channel else addr
+        if key in self.connections and not self._alive(key):
+            # closed by the friend (idle timeout) or lost, reconnect instead of failing on the next write
+            logging.info("Connection to host {!r} closed by peer".format(addr))
+            self.poolStats['failed'] += 1
+            self._evict(key)
+
         try:
-            r, w, s = self.connections[addr]
+            r, w, s = self.connections[key]
             logging.info("Using current connection to host: {!r}".format(addr))
+            self.poolStats['reused'] += 1
+            # last use of the connection, see prune()
+            s = datetime.utcnow()
+            self.connections[key] = (r, w, s)
         except KeyError:
             logging.info("(Re)connecting to host: {!r}".format(addr))
+            if not channel:
+                # make room in the pool for the new connection
+                self.prune(reserve=1)
             try:
                 # reset hash chain
-                self.hashchain[uid] = b''
-                r, w, s = yield from self._connect_host(addr[0], addr[1])
+                self.hashchain[(uid, channel) if channel else uid] = b''
+                r, w, s = yield from self._connect_host(addr[0], addr[1], key if channel else None)
+                self.poolStats['opened'] += 1
             except ConnectionRefusedError:
                 logging.info("Address {!r} not accepting incoming connections".format(addr))
+                self.poolStats['failed'] += 1
                 raise Exceptions.ConnectionFailure("Address {!r} not accepting incoming connections".format(addr))
             except Exception as e:
                 logging.info("Address {!r} connection failed. Reason: {}".format(addr, e))
+                self.poolStats['failed'] += 1
                 raise Exceptions.ConnectionFailure("Address {!r} connection failed. Reason: {}".format(addr, e))
 
+        return r, w, s
+
+    def _alive(self, key):
+        """
+        Liveness probe of a pooled connection, without sending anything. Connections closed by the friend (their idle
+        timeout) or lost have reached EOF or hold the connection error.
+
+        @param key: connections key
+        @return: True if the connection is still open
+        """
+        r, w, s = self.connections[key]
+        return not r.at_eof() and r.exception() is None
+
+    def _evict(self, key):
+        """
+        Close and remove a connection, and the friend's multiplexed connection once none of its streams remain
+
+        @param key: connections key
+        """
+        r, w, s = self.connections.pop(key)
+        try:
+            w.close()
+        except Exception:
+            pass
+
+        addr = key[:2]
+        mux = self.muxes.get(addr)
+        if mux is not None and not any(k[:2] == addr for k in self.connections):
+            mux.close()
+            del self.muxes[addr]
+
+    def prune(self, reserve=0):
+        """
+        Connection pool maintenance. Closes dead connections, connections unused for peer_idle seconds and the least
+        recently used connections beyond max_peer_connections. Only main connections to friends are pooled, transfer
+        channels are closed by their transfers, and connections of running transfers are kept.
+
+        @param reserve: (Optional) number of connections about to be opened
+        @return: number of connections closed
+        """
+        now = datetime.utcnow()
+        pooled = [k for k in self.connections if len(k) == 2]
+        excess = len(pooled) + reserve - self.maxConnections
+        closed = 0
+        # least recently used first
+        for key in sorted((k for k in pooled if not self.busy[k]), key=lambda k: self.connections[k][2]):
+            if not self._alive(key):
+                self.poolStats['failed'] += 1
+            elif excess > 0 or (now - self.connections[key][2]).total_seconds() > self.idleTimeout:
+                self.poolStats['evicted'] += 1
+            else:
+                continue
+
+            self._evict(key)
+            excess -= 1
+            closed += 1
+
+        # multiplexed connections closed by the friend
+        for addr in [a for a, mux in self.muxes.items() if mux.closed]:
+            del self.muxes[addr]
+
+        if closed:
+            logging.info("\t".join(("Connection pool pruned", "Closed: {}".format(closed),
+                                     "Metrics: {!r}".format(self.poolMetrics()))))
+
+        return closed
+
+    def poolMetrics(self):
+        """
+        @return: dict of open (pooled) connections and the number of opened, reused, evicted and failed connections
+        """
+        metrics = dict.fromkeys(('opened', 'reused', 'evicted', 'failed'), 0)
+        metrics.update(self.poolStats)
+        metrics['open'] = sum(1 for k in self.connections if len(k) == 2)
+
+        return metrics
+
+    def _closeChannel(self, uid, addr, channel):
+        """
+        Close a connection to a friend's P2P server
+
+        @param uid: friend's user ID
+        @param addr: friend's (ip, port)
+        @param channel: connection number
+        """
+        try:
+            self.connections.pop(addr + (channel,) if channel else addr)[1].close()
+        except KeyError:
+            pass
+
+        chain = (uid, channel) if channel else uid
+        self.hashchain.pop(chain, None)
+        if chain in self.chainLocks and not self.chainLocks[chain].locked():
+            del self.chainLocks[chain]
+
+    @asyncio.coroutine
+    def send(self, uid, command, data, address=None, sign=True, channel=0):
+        """
+        Attempt to send given command to friend's (uid) P2P server. Sends sharing a connection (and its hash chain) are
+        serialised, concurrent sends would otherwise sign with the same link and the friend rejects all but the first.
+
+        @param uid: destination friend's ID
+        @param command: command integer to send
+        @param data: data sent with initial command (to be signed)
+        @param address: (optional) Direct IP address tuple
+        @param sign: digitally sign sent data
+        @param channel: (optional) connection number, see _connection()
+        @return: True if successfully sent, else False
+        """
+        with (yield from self.chainLocks[(uid, channel) if channel else uid]):
+            return (yield from self._send(uid, command, data, address, sign, channel))
+
+    @asyncio.coroutine
+    def _send(self, uid, command, data, address, sign, channel):
+        """
+        Send given command to friend's (uid) P2P server, extending the connection's hash chain. See send()
+        """
+        addr = address or self.friends[uid]
+        # each connection has its own hash chain
+        chain = (uid, channel) if channel else uid
+
+        r, w, s = yield from self._connection(uid, addr, channel)
+
         if sign:
             # update progressive hash chain
-            hchain = bytes(sha1(b''.join((self.hashchain[uid], data))).hexdigest(), encoding='ascii')
+            hchain = bytes(sha1(b''.join((self.hashchain[chain], data))).hexdigest(), encoding='ascii')
             # use epoch (time.time()), hash chain, dest uuid, data, origin uuid - when signing to avoid replay attack
             outgoing = b''.join((bytes(str(int(time())), encoding='ascii'), hchain, uid, data, self.uid))
-            outdata = a85encode(self.signer.sign(outgoing), foldspaces=True)
+            outdata = self.signer.sign(outgoing)
         else:
             outdata = data
 
         # outgoing data format
-        cmd = b''.join((bytes(str(command), encoding='ascii'), outdata, CONS.WRITE_END if sign else b''))
+        cmd = self._frame(addr, command, outdata, sign)
         success = True
         try:
             w.write(cmd)
@@ -1031,22 +1654,23 @@ class P2PClient(TLSClient):
             logging.info("Sent data: {!r}".format(cmd))
         except (BrokenPipeError, ConnectionResetError):
             # socket closed
+            self.poolStats['failed'] += 1
             try:
                 logging.info("Reconnecting to: {!r}".format(addr))
                 # reset hash chain
-                self.hashchain[uid] = b''
+                self.hashchain[chain] = b''
                 # reconnect to friend
-                r, w, s = yield from self._connect_host(addr[0], addr[1])
+                r, w, s = yield from self._connect_host(addr[0], addr[1], addr + (channel,) if channel else None)
                 # hash chain changed, resign data
                 if sign:
                     # update progressive hash chain
-                    hchain = bytes(sha1(b''.join((self.hashchain[uid], data))).hexdigest(), encoding='ascii')
+                    hchain = bytes(sha1(b''.join((self.hashchain[chain], data))).hexdigest(), encoding='ascii')
                     # use epoch (time.time()), hash chain, dest uuid, data, origin uuid - when signing to avoid replay attack
                     outgoing = b''.join((bytes(str(int(time())), encoding='ascii'), hchain, uid, data, self.uid))
-                    outdata = a85encode(self.signer.sign(outgoing), foldspaces=True)
+                    outdata = self.signer.sign(outgoing)
 
                 # outgoing data format
-                cmd = b''.join((bytes(str(command), encoding='ascii'), outdata, CONS.WRITE_END if sign else b''))
+                cmd = self._frame(addr, command, outdata, sign)
 
                 w.write(cmd)
                 yield from w.drain()
@@ -1060,18 +1684,19 @@ class P2PClient(TLSClient):
 
         if success and sign:
             # update hash chain if sending successful
-            self.hashchain[uid] = hchain
+            self.hashchain[chain] = hchain
 
         return success
 
     @asyncio.coroutine
-    def read(self, uid, rbytes=None, address=None):
+    def read(self, uid, rbytes=None, address=None, channel=0):
         """
         Receive from the quip server StreamReader
 
         @param uid: friend's user ID
         @param rbytes: (optional) number of bytes to read, otherwise readline() used
         @param address: (optional) Direct IP address tuple
+        @param channel: (optional) connection number, see _connection()
         @return: received data
         """
         addr = address or self.friends[uid]
@@ -1081,7 +1706,7 @@ class P2PClient(TLSClient):
             raise Exceptions.ConnectionFailure("No IP address found locally for friend, contact server for address")
 
         try:
-            r, w, s = self.connections[addr]
+            r, w, s = self.connections[addr + (channel,) if channel else addr]
         except KeyError:
             # this will be raised if send() return value isn't checked for sending failure and read() is called
             logging.warning("Trying to read() from unconnected friend connection")
@@ -1130,11 +1755,31 @@ class P2PClient(TLSClient):
             return False
 
         # create checksum
-        digest = sha1sum(filePath)
+        digest = getFileChecksum(self.safe, self.profileId, filePath)
 
         fname = bytes(path.basename(filePath), encoding='utf-8')
+        fields = [fname, size, digest]
+
+        addr = self.friends[uid]
+        yield from self._connection(uid, addr)
+        version = self.protocols.get(addr, 1)
+        if version >= CONS.PROTOCOL_CHUNKED:
+            # friend can receive the file in verified chunks, send the chunk size and Merkle tree root
+            chunkSize = max(CONS.LIMIT_CHUNK_MIN, min(int(self.config.transfer_chunk), CONS.LIMIT_CHUNK_MAX))
+            treeDigest = bytes(self.config.transfer_digest, encoding='ascii')
+            if version < CONS.PROTOCOL_DIGESTS or treeDigest not in DIGESTS:
+                treeDigest = b'sha1'
+
+            # the file is only hashed (in an executor) when its tree is not stored or the file changed
+            levels = yield from self.loop.run_in_executor(None, getFileMerkleTree, self.safe, self.profileId, filePath,
+                                                          chunkSize, treeDigest)
+            root = levels[-1][0]
+            fields.extend((bytes(str(chunkSize), encoding='ascii'), hexlify(root)))
+            if treeDigest != b'sha1':
+                fields.append(treeDigest)
+
         # send file transfer request
-        yield from self.send(uid, CONS.REQ_FILE, b''.join((bytes(CONS.PROFILE_VALUE_SEPARATOR, encoding='utf-8').join((fname, size, digest)), bytes(str(CONS.REQ_FILE), encoding='ascii'))))
+        yield from self.send(uid, CONS.REQ_FILE, b''.join((bytes(CONS.PROFILE_VALUE_SEPARATOR, encoding='utf-8').join(fields), bytes(str(CONS.REQ_FILE), encoding='ascii'))), address=addr)
 
         # response from friend's server
         accepted = yield from self.read(uid, rbytes=1)
@@ -1149,8 +1794,464 @@ class P2PClient(TLSClient):
 
         return digest if success else success
 
+    def _verifiedChunks(self, requestId, size):
+        """
+        Find the chunks of an interrupted download which are already on disk.
+
+        Chunks on disk are checked against their journaled checksums, journal entries of chunks which no longer match
+        are dropped.
+
+        @param requestId: file transfer request row ID
+        @param size: total size of the file in bytes
+        @return: (download location, chunk size, set of verified chunk indexes), location is None when there is
+                 nothing to resume
+        """
+        journal = getFilePartial(self.safe, self.profileId, requestId)
+        if journal is None:
+            return None, None, set()
+
+        dest, chunkSize, checksums = journal
+        if not path.isfile(dest):
+            delFilePartials((requestId,))
+            return None, None, set()
+
+        verified = set()
+        with open(dest, 'rb') as fd:
+            for chunk, expected in checksums.items():
+                fd.seek(chunk * chunkSize)
+                buf = fd.read(chunkSize)
+                if len(buf) == min(chunkSize, max(size - chunk * chunkSize, 0)) and sha1(buf).digest() == expected:
+                    verified.add(chunk)
+
+        delFilePartialChunks(requestId, set(checksums) - verified)
+
+        return dest, chunkSize, verified
+
+    def _offeredCodecs(self, addr):
+        """
+        Compression codecs offered to a friend's P2P server for file transfers
+
+        @param addr: friend's (ip, port)
+        @return: list of codec names, None if the friend does not support compression or compression is disabled
+        """
+        if self.protocols.get(addr, 1) < CONS.PROTOCOL_COMPRESSION or self.config.compression == 'none':
+            return None
+
+        return sorted(CODECS)
+
     @asyncio.coroutine
-    def retrieveFile(self, uid, checksum, saveAs=None):
+    def _requestFile(self, uid, checksum, size, offset=0, channel=0):
+        """
+        Request a file transfer from friend, starting from the given byte offset
+
+        @param uid: friend's uid to retrieve file from
+        @param checksum: checksum of file to download
+        @param size: total size of the file in bytes
+        @param offset: byte position to receive the file from
+        @param channel: connection number, see _connection()
+        @return: (first received file data, coroutine function reading more file data), None if the file (or offset) is
+                 not available, False if the file was modified
+        """
+        addr = self.friends[uid]
+        codecs = self._offeredCodecs(addr)
+        request = [bytes(str(offset), encoding='ascii') if offset else b'']
+        if codecs is not None:
+            request.append(b','.join(codecs))
+
+        yield from self.send(uid, CONS.RECV_FILE, b''.join((checksum, b':'.join(request),
+                                                            bytes(str(CONS.RECV_FILE), encoding='ascii'))),
+                             channel=channel)
+        read = partial(self.read, uid, channel=channel)
+
+        if codecs is not None:
+            # codec used by the sender (or failure), followed by the file
+            isFileData = (yield from read()).strip()
+        else:
+            # read up to 9 bytes
+            isFileData = yield from read(rbytes=9)
+
+        if isFileData[:CONS.COMMAND_LENGTH] == CONS.MODIFIED_FILE:
+            return False
+        elif isFileData[:CONS.COMMAND_LENGTH] == CONS.NONEXISTANT:
+            return None
+
+        if codecs is None:
+            return isFileData, read
+        elif isFileData in CODECS:
+            return b'', self._decompressingReader(self.connections[addr + (channel,) if channel else addr][0],
+                                                  isFileData, size - offset)
+
+        return b'', read
+
+    @staticmethod
+    def _decompressingReader(reader, codec, size):
+        """
+        Create a reader of a compressed file stream (length prefixed blocks ending with an empty block)
+
+        @param reader: StreamReader of the connection
+        @param codec: codec name, see CODECS
+        @param size: number of bytes the stream decompresses to, the stream is invalid once it produces more
+        @return: coroutine function returning decompressed data, empty when the stream ends or is invalid
+        """
+        decompressor = CODECS[codec][1]()
+        # compressed data not yet decompressed, number of bytes decompressed
+        pending, produced = b'', 0
+
+        @asyncio.coroutine
+        def read(rbytes=None):
+            nonlocal pending, produced
+            # output is limited to the data wanted, a small block may decompress to far more
+            limit = min(rbytes or CONS.LIMIT_CHUNK_MIN, max(size - produced, 1))
+            while True:
+                try:
+                    if not pending and (getattr(decompressor, 'needs_input', True) or decompressor.eof):
+                        length = CONS.BLOCK_LENGTH.unpack((yield from reader.readexactly(CONS.BLOCK_LENGTH.size)))[0]
+                        if not length:
+                            return b''
+                        pending = yield from reader.readexactly(length)
+
+                    try:
+                        data = decompressor.decompress(pending, limit)
+                    except TypeError:
+                        # lzma before python 3.5 has no output limit
+                        data = decompressor.decompress(pending)
+                    # zlib keeps input beyond the limit in unconsumed_tail, lzma buffers it (needs_input is False)
+                    pending = getattr(decompressor, 'unconsumed_tail', b'')
+                except (asyncio.IncompleteReadError, ConnectionError, EOFError) + CODEC_ERRORS as e:
+                    logging.warning("Compressed file stream failed: {!r}".format(e))
+                    return b''
+
+                produced += len(data)
+                if produced > size:
+                    logging.warning("Compressed file stream exceeds the file size of {} bytes".format(size))
+                    return b''
+
+                # compressed blocks may not produce any data yet
+                if data:
+                    return data
+
+        return read
+
+    @asyncio.coroutine
+    def _receiveChunks(self, read, fd, requestId, data, offset, size, chunkSize, fileHash=None, throttle=None):
+        """
+        Write received file data to disk, journaling the checksum of every completed chunk
+
+        @param read: coroutine function returning more file data, given the maximum number of bytes wanted
+        @param fd: file object positioned at offset
+        @param requestId: file transfer request row ID
+        @param data: file data already received
+        @param offset: byte position of data, must be a chunk boundary
+        @param size: total size of the file in bytes
+        @param chunkSize: number of bytes covered by each journaled chunk checksum
+        @param fileHash: (Optional) hash object to update with received data
+        @param throttle: (Optional) coroutine function called with the length of received data before it is written
+        @return: number of bytes of the file on disk
+        """
+        # maximum amount of data to read at once before writing to disk
+        readSize = int(self.config.max_chunk)
+        chunk, position = offset // chunkSize, offset
+        chash = sha1()
+        while True:
+            data = data[:size - position]
+            if throttle is not None and data:
+                yield from throttle(len(data))
+
+            while data:
+                # split received data at chunk boundaries
+                split = chunkSize - position % chunkSize
+                part, data = data[:split], data[split:]
+                fd.write(part)
+                chash.update(part)
+                if fileHash is not None:
+                    fileHash.update(part)
+                position += len(part)
+
+                if position % chunkSize == 0 or position == size:
+                    # chunk is only journaled once written out
+                    fd.flush()
+                    storeFilePartialChunk(self.safe, requestId, chunk, chash.digest())
+                    chunk += 1
+                    chash = sha1()
+
+            if position >= size:
+                break
+
+            # received data may be less than read size due to sender controlling the transport write speed
+            data = yield from read(rbytes=min(readSize, size - position))
+            if not data:
+                break
+
+        return position
+
+    @asyncio.coroutine
+    def _retrieveStream(self, uid, checksum, requestId, dest, size, chunkSize, verified, fileHash=None,
+                        throttle=None):
+        """
+        Receive a file as a single stream, resuming after the leading verified chunks
+
+        When a hash object is given it is updated with the whole file as it is received, only the data already on disk
+        when resuming is read back.
+
+        @param uid: friend's uid to retrieve file from
+        @param checksum: checksum of file to download
+        @param requestId: file transfer request row ID
+        @param dest: download location
+        @param size: total size of the file in bytes
+        @param chunkSize: number of bytes covered by each journaled chunk checksum
+        @param verified: set of chunk indexes already on disk
+        @param fileHash: (Optional) hash object to update with the file data
+        @param throttle: (Optional) coroutine function called with the length of received data
+        @return: True when the file is completely received, otherwise False
+        """
+        # a stream can only resume after the chunks received without gaps
+        chunks = 0
+        while chunks in verified:
+            chunks += 1
+        truncateFilePartial(requestId, chunks)
+        offset = min(chunks * chunkSize, size)
+
+        if offset == size:
+            self._hashFile(dest, size, fileHash)
+            return True
+
+        addr = self.friends[uid]
+        channel = self._transferChannel(addr)
+        # the connection is kept by the pool during the transfer
+        self.busy[addr] += 1
+        try:
+            isFileData = yield from self._requestFile(uid, checksum, size, offset, channel)
+            if isFileData is None and offset:
+                # sender could not resume from our offset (or does not support resuming), start over
+                logging.info("\t".join(("File transfer could not be resumed", "File: {}".format(dest),
+                                         "Offset: {}".format(offset))))
+                storeFilePartial(self.safe, self.profileId, requestId, dest, chunkSize)
+                offset = 0
+                isFileData = yield from self._requestFile(uid, checksum, size, offset, channel)
+
+            if isFileData is None:
+                delFileRequests(requestId)
+                raise Exceptions.FileCorruption("Remote file no longer exists")
+            elif isFileData is False:
+                delFileRequests(requestId)
+                raise Exceptions.FileCorruption("File has been modified since receiving transfer request")
+
+            data, read = isFileData
+
+            # data received before resuming
+            self._hashFile(dest, offset, fileHash)
+
+            with open(dest, 'r+b') as fd:
+                fd.seek(offset)
+                fd.truncate()
+                received = yield from self._receiveChunks(read, fd, requestId, data, offset, size, chunkSize, fileHash,
+                                                          throttle)
+        except Exceptions.TransferCancelled:
+            # remaining file data is still in flight, the connection can not be used for other commands
+            self._closeChannel(uid, addr, channel)
+            raise
+        finally:
+            self.busy[addr] -= 1
+            if channel:
+                self._closeChannel(uid, addr, channel)
+
+        if received < size:
+            logging.warning("\t".join(("File transfer interrupted", "File: {}".format(dest),
+                                        "Received: {} of {} bytes".format(received, size))))
+            return False
+
+        return True
+
+    @staticmethod
+    def _hashFile(filePath, length, fileHash, blockSize=1048576):
+        """
+        Update a hash object with the start of a file
+
+        @param filePath: path of file
+        @param length: number of bytes from the start of the file to hash
+        @param fileHash: hash object, nothing is read when None
+        @param blockSize: number of bytes to read at once
+        """
+        if fileHash is None or not length:
+            return
+
+        with open(filePath, 'rb') as fd:
+            while length > 0:
+                buf = fd.read(min(blockSize, length))
+                if not buf:
+                    break
+                fileHash.update(buf)
+                length -= len(buf)
+
+    @asyncio.coroutine
+    def _retrieveChunks(self, uid, addr, checksum, requestId, dest, size, tree, verified, throttle=None):
+        """
+        Receive a file in chunks over several parallel connections (file_connections in client.conf).
+
+        Each chunk is verified against the Merkle tree root sent with the file request before it is written, chunks
+        failing verification are requested again. Chunks of connections which fail are left for the remaining
+        connections.
+
+        @param uid: friend's uid to retrieve file from
+        @param addr: friend's (ip, port)
+        @param checksum: checksum of file to download
+        @param requestId: file transfer request row ID
+        @param dest: download location
+        @param size: total size of the file in bytes
+        @param tree: (chunk size, Merkle tree root hash, digest name)
+        @param verified: set of chunk indexes already on disk
+        @param throttle: (Optional) coroutine function called with the length of each received chunk
+        @return: True when the file is completely received, otherwise False
+        """
+        chunkSize = tree[0]
+        count = max(1, -(-size // chunkSize))
+        # chunks still to be received, failed chunks are returned to this queue
+        pending = deque(c for c in range(count) if c not in verified)
+        # chunk index -> number of failed verifications
+        retries = Counter()
+        # exception which ends the transfer for all connections
+        failure = []
+
+        # multiplexing friends receive each connection as a stream of one connection
+        channels = [next(self.channelIds) for _ in range(max(1, min(int(self.config.file_connections), len(pending))))]
+        if pending:
+            with open(dest, 'r+b') as fd:
+                results = yield from asyncio.gather(*[self._chunkWorker(uid, addr, channel, fd, checksum, requestId,
+                                                                        size, tree, pending, retries, failure,
+                                                                        throttle)
+                                                      for channel in channels], loop=self.loop, return_exceptions=True)
+
+            for result in results:
+                if isinstance(result, Exception):
+                    logging.error("File chunk connection failed", exc_info=result)
+
+        try:
+            if failure:
+                if not isinstance(failure[0], Exceptions.TransferCancelled):
+                    delFileRequests(requestId)
+                raise failure[0]
+
+            if pending:
+                logging.warning("\t".join(("File transfer interrupted", "File: {}".format(dest),
+                                            "Remaining: {} of {} chunks".format(len(pending), count))))
+                return False
+
+            try:
+                # requesting the end of the file completes the transfer for the sender
+                yield from self.send(uid, CONS.RECV_FILE, b''.join((checksum, bytes(str(size), encoding='ascii'),
+                                                                    bytes(str(CONS.RECV_FILE), encoding='ascii'))),
+                                     address=addr, channel=channels[0])
+            except Exceptions.ConnectionFailure:
+                # file is received, the sender's request expires instead
+                pass
+        finally:
+            for channel in channels:
+                self._closeChannel(uid, addr, channel)
+
+        return True
+
+    @asyncio.coroutine
+    def _chunkWorker(self, uid, addr, channel, fd, checksum, requestId, size, tree, pending, retries, failure,
+                     throttle=None):
+        """
+        Request and verify chunks from the pending queue over one connection until the queue is empty
+
+        @param uid: friend's uid to retrieve file from
+        @param addr: friend's (ip, port)
+        @param channel: connection number
+        @param fd: file object of the download
+        @param checksum: checksum of file to download
+        @param requestId: file transfer request row ID
+        @param size: total size of the file in bytes
+        @param tree: (chunk size, Merkle tree root hash, digest name)
+        @param pending: deque of chunk indexes to receive
+        @param retries: Counter of failed verifications by chunk index
+        @param failure: list receiving the exception which ends the transfer
+        @param throttle: (Optional) coroutine function called with the length of each received chunk
+        @return: True when the queue is emptied, False if the connection failed
+        """
+        chunkSize, root, digest = tree
+        count = max(1, -(-size // chunkSize))
+        timeout = int(self.config.file_timeout)
+        codecs = self._offeredCodecs(addr)
+        # chunk size, chunk index, Merkle tree digest (sha1 is implied, as understood by protocol v3 peers) and
+        # compression codecs
+        request = [bytes(str(chunkSize), encoding='ascii'), None]
+        if codecs is not None:
+            request.extend((digest, b','.join(codecs)))
+        elif digest != b'sha1':
+            request.append(digest)
+
+        while pending and not failure:
+            index = pending.popleft()
+            try:
+                request[1] = bytes(str(index), encoding='ascii')
+                yield from self.send(uid, CONS.RECV_CHUNK, b''.join((checksum, b':'.join(request),
+                                                                     bytes(str(CONS.RECV_CHUNK), encoding='ascii'))),
+                                     address=addr, channel=channel)
+                reader = self.connections[addr + (channel,)][0]
+
+                header = (yield from asyncio.wait_for(reader.readline(), timeout)).strip()
+                if header == CONS.NONEXISTANT:
+                    failure.append(Exceptions.FileCorruption("Remote file no longer exists"))
+                    return False
+                elif header == CONS.MODIFIED_FILE:
+                    failure.append(Exceptions.FileCorruption("File has been modified since receiving transfer request"))
+                    return False
+
+                # chunk index, chunk length, compression codec (when codecs were offered), proof hashes
+                header = header.split(b':')
+                assert int(header[0]) == index
+                length = int(header[1])
+                expected = min(chunkSize, size - index * chunkSize)
+                codec = header.pop(2) if codecs is not None else b'none'
+                assert length == expected if codec == b'none' else codec in CODECS and 0 < length <= chunkSize
+                proof = [unhexlify(h) for h in header[2:]]
+
+                chunk = yield from asyncio.wait_for(reader.readexactly(length), timeout)
+                if throttle is not None:
+                    yield from throttle(length)
+            except Exceptions.TransferCancelled as e:
+                # verified chunks are kept on disk
+                pending.appendleft(index)
+                failure.append(e)
+                return False
+            except (Exceptions.ConnectionFailure, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    ValueError, IndexError, AssertionError) as e:
+                # connection lost or response unreadable, chunk is left for the other connections
+                logging.warning("\t".join(("File chunk connection failed", "Channel: {}".format(channel),
+                                            "Chunk: {}".format(index), "Reason: {!r}".format(e))))
+                pending.appendleft(index)
+                self._closeChannel(uid, addr, channel)
+                return False
+
+            if codec != b'none':
+                try:
+                    chunk = decompress(codec, chunk, expected)
+                except CODEC_ERRORS:
+                    # invalid data fails verification below
+                    chunk = b''
+
+            if not merkleVerify(merkleLeaf(chunk, DIGESTS[digest]), index, count, proof, root, DIGESTS[digest]):
+                retries[index] += 1
+                logging.warning("\t".join(("File chunk failed verification", "Chunk: {}".format(index),
+                                            "Attempt: {}".format(retries[index]))))
+                if retries[index] > CONS.LIMIT_CHUNK_RETRIES:
+                    failure.append(Exceptions.FileCorruption("File chunk {} repeatedly failed verification".format(index)))
+                    return False
+
+                pending.append(index)
+                continue
+
+            fd.seek(index * chunkSize)
+            fd.write(chunk)
+            fd.flush()
+            storeFilePartialChunk(self.safe, requestId, index, sha1(chunk).digest())
+
+        return True
+
+    @asyncio.coroutine
+    def retrieveFile(self, uid, checksum, saveAs=None, priority=0):
         """
         Retrieve file from friend.
 
@@ -1159,7 +2260,8 @@ class P2PClient(TLSClient):
         @param uid: friend's uid to retrieve file from
         @param checksum: checksum of file to download
         @param saveAs: (optional) Name the file this value instead of the filename sent by the friend
-        @return: True when data it completely retreived and saved, else False
+        @param priority: (optional) lower values are started first when transfers are queued
+        @return: location of the saved file when completely retrieved, else False
         """
         try:
             filename, size, rid = self.fileRequests[self.masks[uid]][checksum]
@@ -1169,58 +2271,65 @@ class P2PClient(TLSClient):
                                        "Checksum: {!r}".format(checksum))))
             return False
 
-        if saveAs is not None:
-            filename = saveAs if type(saveAs) is str else saveAs.decode('utf-8')
-        else:
-            filename = filename.decode('utf-8')
-
-        yield from self.send(uid, CONS.RECV_FILE, b''.join((checksum, bytes(str(CONS.RECV_FILE), encoding='ascii'))))
-
-        # read up to 9 bytes
-        isFileData = yield from self.read(uid, rbytes=9)
-
-        if isFileData[:CONS.COMMAND_LENGTH] == CONS.MODIFIED_FILE:
-            delFileRequests(rid)
-            raise Exceptions.FileCorruption("File has been modified since receiving transfer request")
-        elif isFileData[:CONS.COMMAND_LENGTH] == CONS.NONEXISTANT:
-            delFileRequests(rid)
-            raise Exceptions.FileCorruption("Remote file no longer exists")
-
-        dest = path.join(self.config.download_directory, filename)
-        if path.isfile(dest):
-            # if a file of the same name already exists, create a new file
-            name, ext = path.splitext(filename)
-            fd, dest = mkstemp(suffix=ext, prefix="{}-".format(name), dir=self.config.download_directory)
-            fd = open(fd, 'wb')
-        else:
-            fd = open(dest, 'wb')
-
         size = int(size)
-        # command data not present, contains file data
-        fd.write(isFileData if size > len(isFileData) else isFileData[:size])
-        # maximum chunk size before writing to disk
-        chunk = int(self.config.max_chunk)
-        # total size of file, minus the command data length check
-        total = size - 9
-        while total > 0:
-            fdata = yield from self.read(uid, rbytes=chunk if chunk < total else total)
-            # received data may be less than chunk size due to sender controlling the transport write speed
-            total -= len(fdata)
-
-            if not fdata:
-                break
-
-            # write to disk
-            fd.write(fdata)
+        addr = self.friends[uid]
+        yield from self._connection(uid, addr)
+        # chunk size and Merkle tree root, when sent by a friend able to send the file in chunks
+        tree = getFileTree(self.safe, self.profileId, rid)
+        if self.protocols.get(addr, 1) < CONS.PROTOCOL_CHUNKED:
+            tree = None
+
+        # resume from the verified chunks of a previously interrupted download
+        dest, chunkSize, verified = self._verifiedChunks(rid, size)
+        if dest is None:
+            # bytes covered by each journaled chunk checksum
+            chunkSize = tree[0] if tree is not None else int(self.config.max_chunk)
+
+            if saveAs is not None:
+                filename = saveAs if type(saveAs) is str else saveAs.decode('utf-8')
+            else:
+                filename = filename.decode('utf-8')
+
+            dest = path.join(self.config.download_directory, filename)
+            if path.isfile(dest):
+                # if a file of the same name already exists, create a new file
+                name, ext = path.splitext(filename)
+                fd, dest = mkstemp(suffix=ext, prefix="{}-".format(name), dir=self.config.download_directory)
+                open(fd, 'wb').close()
+            else:
+                open(dest, 'wb').close()
+
+            storeFilePartial(self.safe, self.profileId, rid, dest, chunkSize)
+        elif tree is not None and tree[0] != chunkSize:
+            # journal was started with a different chunk size, chunks can not be reused
+            chunkSize, verified = tree[0], set()
+            storeFilePartial(self.safe, self.profileId, rid, dest, chunkSize)
+
+        # streamed files are hashed as they are received, chunked transfers are verified as each chunk is received
+        fileHash = sha1() if tree is None and int(self.config.verify) else None
+        # wait for a free download slot
+        transfer = yield from Transfers.acquire(self.masks[uid], checksum, outgoing=False, priority=priority)
+        try:
+            # raises if cancelled while queued
+            yield from transfer.throttle(0)
+            if tree is not None:
+                complete = yield from self._retrieveChunks(uid, addr, checksum, rid, dest, size, tree, verified,
+                                                           transfer.throttle)
+            else:
+                complete = yield from self._retrieveStream(uid, checksum, rid, dest, size, chunkSize, verified,
+                                                           fileHash, transfer.throttle)
+        finally:
+            Transfers.release(transfer)
 
-        fd.flush()
-        fd.close()
+        if not complete:
+            # request and download journal are kept, accepting the transfer again resumes from the verified chunks
+            return False
 
-        # remove incoming request entry, regardless of checksum verification success
+        # download is complete, remove incoming request entry (and its journal) regardless of checksum verification
         delFileRequests(rid)
 
-        if int(self.config.verify):
-            lhash = sha1sum(dest)
+        if fileHash is not None:
+            lhash = bytes(fileHash.hexdigest(), encoding='ascii')
             if lhash != checksum:
                 logging.warning("\t".join(("Downloaded file does not match sent file hash: {}".format(dest),
                                            "Sent Hash: {}".format(checksum),
@@ -1254,25 +2363,34 @@ class P2PClient(TLSClient):
         values = {}
         checksum = bytes(sha1(avatar).hexdigest(), encoding='ascii')
         for uid in friends:
-            # send initial signed command with checksum value
-            yield from self.send(uid, CONS.RECV_AVATAR, b''.join((checksum, bytes(str(CONS.RECV_AVATAR), encoding='ascii'))))
-
-            success = yield from self.read(uid, rbytes=2)
-            if success == CONS.BTRUE:
-                # send size of avatar to read
-                yield from self.send(uid, '', b''.join((bytes(str(len(avatar)), encoding='ascii'), CONS.WRITE_END)), sign=False)
-                success = yield from self.read(uid, rbytes=2)
+            addr = self.friends[uid]
+            yield from self._connection(uid, addr)
+            channel = self._transferChannel(addr)
+            send = partial(self.send, uid, channel=channel)
+            read = partial(self.read, uid, channel=channel)
+            try:
+                # send initial signed command with checksum value
+                yield from send(CONS.RECV_AVATAR, b''.join((checksum, bytes(str(CONS.RECV_AVATAR), encoding='ascii'))))
 
+                success = yield from read(rbytes=2)
                 if success == CONS.BTRUE:
-                    # send entire avatar
-                    yield from self.send(uid, '', avatar, sign=False)
-
-                    # 40 char checksum
-                    fchecksum = yield from self.read(uid, rbytes=64)
-
-                    # compare checksum value friend calculated to our own
-                    if fchecksum != checksum:
-                        success = CONS.BFALSE
+                    # send size of avatar to read
+                    yield from send('', b''.join((bytes(str(len(avatar)), encoding='ascii'), CONS.WRITE_END)), sign=False)
+                    success = yield from read(rbytes=2)
+
+                    if success == CONS.BTRUE:
+                        # send entire avatar
+                        yield from send('', avatar, sign=False)
+
+                        # 40 char checksum
+                        fchecksum = yield from read(rbytes=64)
+
+                        # compare checksum value friend calculated to our own
+                        if fchecksum != checksum:
+                            success = CONS.BFALSE
+            finally:
+                if channel:
+                    self._closeChannel(uid, addr, channel)
 
             values[uid] = True if success == CONS.BTRUE else False
 
@@ -21,7 +21,16 @@ class Configuration:
         # required fields and their defaults. Defaults are used when fields do not exist or contain invalid data
         self.required = {'verify': 1, 'download_directory': 'Downloads', 'max_chunk': 524288,
                          'request_expiry': 28, 'file_expiry': 7,
-                         'host': '', 'tcp': 22012, 'idle_timeout': 30}
+                         'host': '', 'tcp': 22012, 'idle_timeout': 180, 'max_connections': 64, 'read_limit': 65536,
+                         'header_timeout': 10, 'file_timeout': 30, 'max_frame': 1048576,
+                         'write_high': 262144, 'write_low': 65536, 'transfer_chunk': 1048576, 'file_connections': 4,
+                         'transfer_digest': 'blake2b', 'compression': 'zlib', 'compression_level': 6,
+                         'max_transfers': 4, 'max_friend_transfers': 2, 'upload_rate': 0, 'download_rate': 0,
+                         'max_peer_connections': 32, 'peer_idle': 120, 'push_poll': 300,
+                         'udp': 22012, 'presence_interval': 60, 'presence_timeout': 180,
+                         'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -2000, 'mmap_size': 0,
+                         'history_batch': 50, 'history_delay': 250,
+                         'history_page': 20, 'cache_entries': 1024}
 
         self.__checkRequired()
 
@@ -1,6 +1,7 @@
 #
 # Constants used throughout the library
 #
+from struct import Struct
 
 ######################
 # P2P Server Commands
@@ -11,6 +12,10 @@ RECV_FILE = 99119841
 RECV_MSG = 78986713
 RECV_AVATAR = 57383752
 INVITE_CHAT = 86878161
+# single verified chunk of a file transfer (protocol v3)
+RECV_CHUNK = 99119842
+# protocol version negotiation, sent in v1 framing on connection
+PROTOCOL_NEGOTIATE = 40914252
 
 #########################
 # Quip Server Commands
@@ -44,11 +49,21 @@ RECOVERY_EMAIL = 65663422
 RECOVERY_CODE = 65663424
 
 DETAILS_GET = 17549000
+# details of many friends in one request: concatenated (uid, token) pairs, answered by one line of entries
+DETAILS_BULK = 17549001
 
 INVITES_GET = 35433331
 INVITES_CLEAR = 35433332
 INVITES_GENERATE = 47422112
 
+# subscribe a connection to account notifications, answered by a status code then a NOTIFY_* line per event until the
+# connection is closed. Status changes are followed by the friend's uid (NOTIFY_STATUS:uid)
+SUBSCRIBE = 31744310
+NOTIFY_MESSAGES = 1
+NOTIFY_REQUESTS = 2
+NOTIFY_STATUS = 3
+NOTIFY_SEPARATOR = b':'
+
 #########
 # Limits
 #########
@@ -63,6 +78,68 @@ LIMIT_PROFILE_VALUES = {'first': 16, 'last': 32, 'alias': 16, 'comment': 128, 'c
 LIMIT_AVATAR_SIZE = 131072
 # age of message being received in seconds
 LIMIT_MESSAGE_TIME = 600
+# most friends requested in one DETAILS_BULK request
+LIMIT_DETAILS_BULK = 512
+# offline messages decrypted and stored together, see ServerClient.getMessages()
+LIMIT_MESSAGE_BATCH = 200
+
+##################
+# P2P Protocol
+##################
+# highest supported P2P protocol version. v1: ASCII command, ASCII85 payload and newline. v2: FRAME_HEADER and raw payload
+# v3: v2 framing with chunked (Merkle tree verified) file transfers. v4: negotiated Merkle tree digest
+# v5: negotiated file transfer compression and compressed frames. v6: streams multiplexed over one connection
+PROTOCOL_VERSION = 6
+# lowest protocol version supporting chunked file transfers (RECV_CHUNK)
+PROTOCOL_CHUNKED = 3
+# lowest protocol version supporting Merkle tree digests other than sha1
+PROTOCOL_DIGESTS = 4
+# lowest protocol version supporting compression
+PROTOCOL_COMPRESSION = 5
+# lowest protocol version multiplexing streams over the connection after negotiation
+PROTOCOL_MULTIPLEX = 6
+# v2 frame header: command, flags, payload length
+FRAME_HEADER = Struct('!IBI')
+# v2 frame flags
+FRAME_SIGNED = 1
+# payload is zlib compressed (v5)
+FRAME_COMPRESSED = 2
+# seconds to wait for a protocol negotiation response before assuming a v1 peer
+NEGOTIATE_TIMEOUT = 3
+# bounds of file transfer chunk sizes accepted from peers
+LIMIT_CHUNK_MIN = 16384
+LIMIT_CHUNK_MAX = 16777216
+# times a chunk failing verification is fetched again before the transfer is abandoned
+LIMIT_CHUNK_RETRIES = 3
+# compressed file streams are sent as length prefixed blocks, ending with an empty block
+BLOCK_LENGTH = Struct('!I')
+# frames of at least this many bytes are compressed
+COMPRESS_MIN_SIZE = 1024
+# bytes from the start of a file compressed to decide if the file is worth compressing
+COMPRESS_SAMPLE = 65536
+# files are only compressed when the sample compresses below this fraction of its size (skips compressed formats)
+COMPRESS_RATIO = 0.9
+# v6 multiplexed connection frame header: stream id, frame type, payload length
+MUX_HEADER = Struct('!IBI')
+# v6 frame types. MUX_OPEN payload is the stream priority (1 byte), MUX_WINDOW payload is a BLOCK_LENGTH increment
+MUX_OPEN = 0
+MUX_DATA = 1
+MUX_WINDOW = 2
+MUX_CLOSE = 3
+# maximum payload of a data frame, streams with pending data take turns sending frames of up to this size
+MUX_FRAME = 16384
+# bytes a stream may send before the receiver grants more (per-stream flow control window)
+MUX_WINDOW_SIZE = 262144
+# stream priorities, data of lower values is sent first. Connection channel 0 (chat, presence) is the control stream
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+# maximum number of open streams on one connection
+LIMIT_STREAMS = 32
+# UDP presence beacon: version, sender uid, recipient uid, status, P2P server (TCP) port, timestamp (milliseconds).
+# Sent signed, the 64 byte signature followed by the beacon
+PRESENCE_BEACON = Struct('!B36s36sIHQ')
+PRESENCE_VERSION = 2
+PRESENCE_SIZE = 64 + PRESENCE_BEACON.size
 
 #################################
 # Pre-defined byte return values
@@ -74,6 +151,7 @@ INVALID_DATA = b'10000002'
 NONEXISTANT = b'10000003'
 MODIFIED_FILE = b'10000004'
 TIMEOUT = b'20000001'
+SERVER_BUSY = b'20000002'
 
 FAILURE_COMMANDS = {INVALID_COMMAND, INVALID_DATA, TIMEOUT}
 
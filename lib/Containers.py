@@ -76,11 +76,12 @@ class Friends:
         Used when address of a friend requires updating
 
         @param uid: Friend user uid
-        @param address: 'ip:port' address information for user
+        @param address: (ip, port) address information for user
         """
-        # raise KeyError exception if uid does not exist
-        if address != self.__friends[uid]:
-            updateAddress(self.safe, self.profileId, self.__masks[uid], address)
+        address = tuple(str(a) for a in address)
+        # raises MissingFriend if uid does not exist
+        if address != self.__friends.get(uid):
+            updateAddress(self.safe, self.profileId, self.__masks[uid], bytes(':'.join(address), encoding='ascii'))
             self.__friends[uid] = address
 
     def __iter__(self):
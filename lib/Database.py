@@ -3,13 +3,19 @@
 #
 
 # built-ins
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
+from functools import wraps
+import atexit
 import logging
+import threading
 from datetime import datetime
+from time import monotonic
 from sqlite3 import connect, IntegrityError
 from uuid import uuid4
-from os import path
-from hashlib import sha1
+from os import path, stat
+from hashlib import sha1, sha256
+from binascii import hexlify, unhexlify
+import hmac
 
 # third party
 from nacl.exceptions import CryptoError
@@ -20,7 +26,159 @@ import nacl.utils
 from nacl.secret import SecretBox
 
 # application modules
-from lib.Utils import encrypt, absolutePath
+from lib.Config import Configuration
+from lib.Utils import encrypt, absolutePath, sha1sum, merkleTree, merkleLevels, DIGESTS
+
+Config = Configuration()
+
+# accepted values for PRAGMAs which can not be bound as statement parameters
+JOURNAL_MODES = frozenset(('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'))
+SYNCHRONOUS_MODES = frozenset(('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3'))
+# label deriving the key of file path hashes from the crypto box key, see _pathMacKey()
+PATH_MAC_LABEL = b'quip file path mac'
+
+
+class ConnectionManager:
+    """
+    Long lived sqlite connections, one per thread and database location.
+
+    sqlite connections can not be shared across threads, background workers (see gui.Utilities.Background) therefore
+    receive their own connection which is released along with the thread's local storage.
+    """
+
+    def __init__(self, journalMode='WAL', synchronous='NORMAL', cacheSize=-2000, mmapSize=0):
+        """
+        Connection manager constructor
+
+        @param journalMode: sqlite journal_mode PRAGMA value
+        @param synchronous: sqlite synchronous PRAGMA value
+        @param cacheSize: sqlite cache_size PRAGMA value (negative values are KiB, positive values are pages)
+        @param mmapSize: sqlite mmap_size PRAGMA value in bytes, 0 disables memory mapped I/O
+        """
+        self.pragmas = []
+
+        journalMode = str(journalMode).upper()
+        if journalMode in JOURNAL_MODES:
+            self.pragmas.append("PRAGMA journal_mode={}".format(journalMode))
+        else:
+            logging.warning("Invalid database journal_mode '{}', using sqlite default".format(journalMode))
+
+        synchronous = str(synchronous).upper()
+        if synchronous in SYNCHRONOUS_MODES:
+            self.pragmas.append("PRAGMA synchronous={}".format(synchronous))
+        else:
+            logging.warning("Invalid database synchronous value '{}', using sqlite default".format(synchronous))
+
+        for pragma, value in (('cache_size', cacheSize), ('mmap_size', mmapSize)):
+            try:
+                self.pragmas.append("PRAGMA {}={:d}".format(pragma, int(value)))
+            except ValueError:
+                logging.warning("Invalid database {} value '{}', using sqlite default".format(pragma, value))
+
+        self._local = threading.local()
+
+    def connection(self, location):
+        """
+        Return this thread's connection to the given database, creating it on first use
+
+        @param location: absolute file location of database
+        @return: sqlite connection object
+        """
+        try:
+            connections = self._local.connections
+        except AttributeError:
+            connections = self._local.connections = {}
+
+        try:
+            con = connections[location]
+        except KeyError:
+            con = connect(location, isolation_level=None)
+            for pragma in self.pragmas:
+                con.execute(pragma)
+            connections[location] = con
+
+        return con
+
+    def close(self):
+        """
+        Close all connections held by the calling thread
+        """
+        for con in getattr(self._local, 'connections', {}).values():
+            try:
+                con.close()
+            except Exception:
+                pass
+
+        self._local.connections = {}
+
+
+Connections = ConnectionManager(Config.journal_mode, Config.synchronous, Config.cache_size, Config.mmap_size)
+
+# Schema migrations as (user_version, statements). New migrations must be appended with the next version number, and
+# Resources/create_database.sql updated to produce the same schema with its user_version set to the latest version.
+MIGRATIONS = (
+    (1, ("CREATE INDEX IF NOT EXISTS friend_mask_profile_mask ON friend_mask(profile_id, friend_mask)",
+         "CREATE INDEX IF NOT EXISTS friends_profile_mask ON friends(profile_id, friend_mask)",
+         "CREATE INDEX IF NOT EXISTS friend_auth_profile_mask ON friend_auth(profile_id, friend_mask)",
+         "CREATE INDEX IF NOT EXISTS address_profile_mask ON address(profile_id, friend_mask)",
+         "CREATE INDEX IF NOT EXISTS history_profile_mask_datestamp ON history(profile_id, friend_mask, datestamp)",
+         "CREATE INDEX IF NOT EXISTS friend_requests_profile_outgoing ON friend_requests(profile_id, outgoing)",
+         "CREATE INDEX IF NOT EXISTS file_requests_profile_outgoing_mask "
+         "ON file_requests(profile_id, outgoing, friend_mask)")),
+    (2, ("CREATE TABLE IF NOT EXISTS file_checksums(profile_id INTEGER, path_key BLOB, details BLOB)",
+         "CREATE UNIQUE INDEX IF NOT EXISTS file_checksums_profile_path ON file_checksums(profile_id, path_key)")),
+    (3, ("CREATE TABLE IF NOT EXISTS file_partials(profile_id INTEGER, request_id INTEGER, location BLOB, "
+         "chunk_size INTEGER)",
+         "CREATE TABLE IF NOT EXISTS file_partial_chunks(request_id INTEGER, chunk INTEGER, checksum BLOB)",
+         "CREATE UNIQUE INDEX IF NOT EXISTS file_partials_profile_request ON file_partials(profile_id, request_id)",
+         "CREATE UNIQUE INDEX IF NOT EXISTS file_partial_chunks_request_chunk "
+         "ON file_partial_chunks(request_id, chunk)")),
+    (4, ("ALTER TABLE file_requests ADD COLUMN tree BLOB",)),
+    (5, ("ALTER TABLE file_checksums ADD COLUMN tree BLOB",)),
+    # path keys are derived from a separate MAC key (see _fileKey), cached checksums under the old keys are unreachable
+    (6, ("DELETE FROM file_checksums",)),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# resolved (and migrated) database locations, avoids repeated absolute path lookups
+_locations = {}
+_migrationLock = threading.Lock()
+
+
+def migrateDatabase(con):
+    """
+    Upgrade database schema in place to the latest version, using PRAGMA user_version to track the applied version.
+
+    An empty database is created from Resources/create_database.sql.
+
+    @param con: sqlite connection object (autocommit mode)
+    @return: schema version of the database
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+
+    if not version and not con.execute("SELECT count(name) FROM sqlite_master WHERE type='table'").fetchone()[0]:
+        # new database, create current schema
+        with open(absolutePath(path.join('Resources', 'create_database.sql')), 'r') as schema:
+            con.executescript(schema.read())
+        return con.execute("PRAGMA user_version").fetchone()[0]
+
+    for target, statements in ((v, s) for v, s in MIGRATIONS if v > version):
+        logging.info("Migrating database schema from version {} to {}".format(version, target))
+        con.execute("BEGIN")
+        try:
+            for statement in statements:
+                con.execute(statement)
+            con.execute("PRAGMA user_version={:d}".format(target))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            logging.error("Database migration to schema version {} failed".format(target), exc_info=True)
+            raise
+
+        version = target
+
+    return version
 
 
 def getCursor(location=path.join('Resources', 'quip.db')):
@@ -29,7 +187,289 @@ def getCursor(location=path.join('Resources', 'quip.db')):
     @param location: file location of database
     @return: database connection cursor
     """
-    return connect(absolutePath(location), isolation_level=None).cursor()
+    try:
+        location = _locations[location]
+    except KeyError:
+        with _migrationLock:
+            if location not in _locations:
+                # first use of this database by the process, bring schema up to date
+                migrateDatabase(Connections.connection(absolutePath(location)))
+                _locations[location] = absolutePath(location)
+        location = _locations[location]
+
+    return Connections.connection(location).cursor()
+
+class HistoryWriter:
+    """
+    Write-behind storage of chat history.
+
+    Messages are queued and inserted in a single transaction once batchSize messages are waiting or flushDelay
+    milliseconds have passed since the first message was queued, delayed writes are made by a single writer thread.
+    Row IDs are allocated when a message is queued, so callers receive the row ID of a message before it is written.
+    Should history rows be written elsewhere (e.g. by another process) in the meantime, queued messages are stored after
+    them instead.
+    """
+
+    def __init__(self, batchSize=50, flushDelay=250, location=path.join('Resources', 'quip.db')):
+        """
+        History writer constructor
+
+        @param batchSize: number of queued messages which triggers an immediate write
+        @param flushDelay: maximum milliseconds a message is queued before being written, 0 writes immediately
+        @param location: file location of database
+        """
+        self.batchSize = max(int(batchSize), 1)
+        self.flushDelay = max(int(flushDelay), 0) / 1000
+        self.location = location
+        # queued (rowid, safe, profile id, mask, datestamp, message, from friend)
+        self._pending = []
+        # last allocated history row ID
+        self._rowid = None
+        # time the oldest queued message was queued (monotonic)
+        self._queued = None
+        self._lock = threading.RLock()
+        # wakes the writer thread when messages are queued
+        self._wake = threading.Condition(self._lock)
+        self._writer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def store(self, safe, profileId, mask, message, fromFriend, timestamp=None):
+        """
+        Queue message for storage, see storeHistory()
+
+        @return: row ID the message will be stored with
+        """
+        with self._lock:
+            rowid = self._queue(safe, profileId, mask, message, fromFriend, timestamp)
+
+            if len(self._pending) >= self.batchSize or not self.flushDelay:
+                self.flush()
+            else:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='HistoryWriter', daemon=True)
+                    self._writer.start()
+                self._wake.notify()
+
+        return rowid
+
+    def storeMany(self, safe, profileId, entries):
+        """
+        Store messages, together with any queued messages, in a single transaction. See storeHistoryBatch()
+
+        @return: row IDs the messages are stored with, in order of entries
+        """
+        with self._lock:
+            rowids = [self._queue(safe, profileId, mask, message, fromFriend, timestamp)
+                      for mask, message, fromFriend, timestamp in entries]
+            self.flush()
+
+        return rowids
+
+    def _queue(self, safe, profileId, mask, message, fromFriend, timestamp=None):
+        """
+        Queue message and allocate its row ID, the caller must hold the lock
+
+        @return: row ID the message will be stored with
+        """
+        if self._rowid is None:
+            con = getCursor(self.location)
+            con.execute("SELECT max(rowid) FROM history")
+            self._rowid = con.fetchone()[0] or 0
+
+        self._rowid += 1
+        if not self._pending:
+            self._queued = monotonic()
+        # datestamp matches CURRENT_TIMESTAMP format, taken now rather than when written
+        self._pending.append((self._rowid, safe, profileId, mask,
+                              timestamp or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), message, fromFriend))
+
+        return self._rowid
+
+    def flush(self):
+        """
+        Write all queued messages in a single transaction
+
+        @return: number of messages written
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+
+            pending, self._pending = self._pending, []
+
+            con = getCursor(self.location)
+            # the write lock is taken straight away, so no rows can be added between reading the last row ID and writing
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute("SELECT max(rowid) FROM history")
+                last = con.fetchone()[0] or 0
+                if last >= pending[0][0]:
+                    logging.warning("History rows written since row IDs were allocated, storing queued messages after "
+                                    "row ID {}".format(last))
+                    pending = [(last + i,) + entry[1:] for i, entry in enumerate(pending, 1)]
+                    self._rowid = last + len(pending)
+
+                con.executemany("INSERT INTO history (rowid, profile_id, friend_mask, datestamp, message, from_friend) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                ([rowid, profileId, mask, tstamp] +
+                                 list(encrypt(safe, message, bytes(str(int(fromFriend)), encoding='ascii')))
+                                 for rowid, safe, profileId, mask, tstamp, message, fromFriend in pending))
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                # keep messages queued for the next attempt
+                self._pending = pending + self._pending
+                raise
+
+        return len(pending)
+
+    def _run(self):
+        """
+        Writer thread, flushes queued messages flushDelay seconds after the oldest was queued
+        """
+        with self._lock:
+            while True:
+                if not self._pending:
+                    self._wake.wait()
+                    continue
+
+                remaining = self._queued + self.flushDelay - monotonic()
+                if remaining > 0:
+                    self._wake.wait(remaining)
+                    continue
+
+                try:
+                    self.flush()
+                except Exception:
+                    logging.error("Unable to write queued history", exc_info=True)
+                    # retried after another delay
+                    self._queued = monotonic()
+
+
+History = HistoryWriter(Config.history_batch, Config.history_delay)
+# write any remaining queued history on interpreter exit
+atexit.register(History.flush)
+
+class DecryptedCache:
+    """
+    Size bounded, least recently used cache of decrypted database values.
+
+    Entries are keyed by (function name, profile ID, friend mask) so values can be invalidated per friend or per profile
+    by the write paths which change them. Hit and miss counts are kept per function name.
+    """
+
+    def __init__(self, size=1024):
+        """
+        Decrypted value cache constructor
+
+        @param size: maximum number of cached values
+        """
+        self.size = max(int(size), 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        # callables notified of invalidation with (profileId, mask, names), see invalidate()
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return cached value, raises KeyError if not cached
+
+        @param key: (function name, profile ID, mask)
+        @return: cached value
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses[key[0]] += 1
+                raise
+
+            # most recently used entries are kept at the end
+            self._entries[key] = value
+            self.hits[key[0]] += 1
+
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value, evicting the least recently used value if the cache is full
+
+        @param key: (function name, profile ID, mask)
+        @param value: decrypted value
+        """
+        if not self.size:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, profileId, mask=None, *names):
+        """
+        Remove cached values
+
+        @param profileId: profile ID values belong to
+        @param mask: (Optional) only remove values for this friend mask. None removes values for the entire profile
+        @param names: (Optional) only remove values cached for these function names
+        """
+        with self._lock:
+            for key in [k for k in self._entries
+                        if k[1] == profileId and (mask is None or k[2] == mask) and (not names or k[0] in names)]:
+                del self._entries[key]
+
+        # objects derived from cached values (e.g. P2PServer verify keys) are invalidated by their owners
+        for listener in tuple(self.listeners):
+            listener(profileId, mask, names)
+
+    def clear(self):
+        """
+        Remove all cached values and reset hit/miss counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        """
+        @return: {function name: (hits, misses)}
+        """
+        return {name: (self.hits[name], self.misses[name]) for name in set(self.hits) | set(self.misses)}
+
+
+Cache = DecryptedCache(Config.cache_entries)
+
+
+def cached(function):
+    """
+    Cache decrypted output of database read functions with the signature (safe, profileId[, mask]).
+
+    Empty results are not cached. Functions writing the underlying rows must call Cache.invalidate().
+    """
+    @wraps(function)
+    def wrapper(safe, profileId, mask=None):
+        key = (function.__name__, profileId, mask)
+        try:
+            return Cache.get(key)
+        except KeyError:
+            pass
+
+        value = function(safe, profileId, mask) if mask is not None else function(safe, profileId)
+        if value:
+            Cache.set(key, value)
+
+        return value
+
+    return wrapper
 
 def getAddress(safe, profileId, mask):
     """
@@ -76,6 +516,7 @@ def updateAddress(safe, profileId, mask, addr):
     else:
         setAddress(safe, profileId, mask, addr)
 
+@cached
 def getAuthority(safe, profileId, mask):
     """
     Return public key for given friend (mask)
@@ -108,6 +549,7 @@ def storeAuthority(safe, profileId, mask, signingKey, messageKey):
     try:
         con.execute("INSERT INTO friends (profile_id, friend_mask, verify_key, public_key) VALUES (?, ?, ?, ?)",
                     [profileId, mask] + list(encrypt(safe, signingKey, messageKey)))
+        Cache.invalidate(profileId, mask, 'getAuthority')
         success = True
     except IntegrityError:
         # friend entry already exists
@@ -267,6 +709,7 @@ def updateFriendDetails(safe, profileId, mask, avatar=None, alias=None):
         checksum = bytes(sha1(avatar).hexdigest(), encoding='ascii')
         con.execute("UPDATE friends SET checksum=?, avatar=? WHERE profile_id=? AND friend_mask=?",
                     list(encrypt(safe, checksum, avatar)) + [profileId, mask])
+        Cache.invalidate(profileId, mask, 'getFriendChecksum')
 
     if alias:
         con.execute("UPDATE friends SET alias=? WHERE profile_id=? AND friend_mask=?",
@@ -289,6 +732,7 @@ def getFriendDetails(safe, profileId, mask):
 
     return tuple(safe.decrypt(i) if i else i for i in out)
 
+@cached
 def getFriendChecksum(safe, profileId, mask):
     """
     Return friend's avatar checksum value
@@ -324,9 +768,12 @@ def deleteFriend(safe, profileId, mask):
     except Exception:
         return False
 
+    History.flush()
     for table in  ('address', 'history', 'file_requests', 'friend_auth', 'friend_mask', 'friends'):
         con.execute("DELETE FROM {} WHERE profile_id=? AND friend_mask=?".format(table), (profileId, mask))
 
+    Cache.invalidate(profileId, mask)
+
     return True
 
 def deleteAccount(safe, profileId, uid):
@@ -339,15 +786,21 @@ def deleteAccount(safe, profileId, uid):
     @return: True if successfully deleted, otherwise False
     """
     if uid == getAccount(safe, profileId)[0]:
+        History.flush()
         con = getCursor()
-        for table in ('history', 'file_requests', 'address', 'friend_auth', 'friends', 'friend_mask'):
+        con.execute("DELETE FROM file_partial_chunks WHERE request_id IN "
+                    "(SELECT request_id FROM file_partials WHERE profile_id=?)", (profileId,))
+        for table in ('history', 'file_requests', 'file_checksums', 'file_partials', 'address', 'friend_auth',
+                      'friends', 'friend_mask'):
             con.execute("DELETE FROM {} WHERE profile_id=?".format(table), (profileId,))
 
         con.execute("DELETE FROM profiles WHERE ROWID=?", (profileId,))
+        Cache.invalidate(profileId)
         return True
 
     return False
 
+@cached
 def getSigningKeys(safe, profileId):
     """
     Return private and public keys for given profile ID
@@ -362,6 +815,7 @@ def getSigningKeys(safe, profileId):
 
     return tuple(safe.decrypt(i) for i in out)
 
+@cached
 def getMessageKeys(safe, profileId):
     """
     Return message encryption private and public keys for a given profile ID
@@ -376,6 +830,7 @@ def getMessageKeys(safe, profileId):
 
     return tuple(safe.decrypt(i) for i in out)
 
+@cached
 def getUidMask(safe, profileId, mask):
     """
     Return original uid associated with given masked id (mask)
@@ -422,6 +877,7 @@ def getMasks(safe, profileId):
 
     return {safe.decrypt(u): m for u, m in out} if out else None
 
+@cached
 def getFriendAuth(safe, profileId, mask):
     """
     Return profile's mask associated with friend (uid) for authorised server interaction with friend
@@ -446,8 +902,8 @@ def getAuthTokens(safe, profileId):
     :return: iterable of dict token->mask
     """
     con = getCursor()
-    con.execute("SELECT auth_token, friend_mask FROM friend_auth WHERE profile_id=?", (profileId))
-    out = con.fetchone() or ()
+    con.execute("SELECT auth_token, friend_mask FROM friend_auth WHERE profile_id=?", (profileId,))
+    out = con.fetchall()
 
     return {safe.decrypt(token): mask for token, mask in out}
 
@@ -464,6 +920,7 @@ def setFriendAuth(safe, profileId, mask, authToken, sentToken):
     con = getCursor()
     con.execute("INSERT INTO friend_auth (profile_id, friend_mask, auth_token, sent_token) VALUES (?, ?, ?, ?)",
                 [profileId, mask] + list(encrypt(safe, authToken, sentToken)))
+    Cache.invalidate(profileId, mask, 'getFriendAuth')
 
 def updateFriendAuth(safe, profileId, mask, authToken=False, sentToken=False):
     """
@@ -488,6 +945,8 @@ def updateFriendAuth(safe, profileId, mask, authToken=False, sentToken=False):
         con.execute("UPDATE friend_auth SET sent_token=? WHERE profile_id=? AND friend_mask=?",
                     list(encrypt(safe, sentToken)) if sentToken is not None else [b''] + [profileId, mask])
 
+    Cache.invalidate(profileId, mask, 'getFriendAuth')
+
 def storeHistory(safe, profileId, mask, message, fromFriend, timestamp=None):
     """
     Store messages in database
@@ -498,34 +957,69 @@ def storeHistory(safe, profileId, mask, message, fromFriend, timestamp=None):
     @param message: message to store
     @param fromFriend: Message was sent by friend (True), instead of being sent by logged in user (False)
     @param timestamp: Custom timestamp for received message, default uses current time
-    @return: inserted rowid
+    @return: rowid of queued message (written by History, see HistoryWriter)
     """
-    con = getCursor()
-    if not timestamp:
-        con.execute("INSERT INTO history (profile_id, friend_mask, message, from_friend) VALUES (?, ?, ?, ?)",
-                    [profileId, mask] + list(encrypt(safe, message, bytes(str(int(fromFriend)), encoding='ascii'))))
-    else:
-        con.execute("INSERT INTO history (profile_id, friend_mask, datestamp, message, from_friend) VALUES (?, ?, ?, ?, ?)",
-                    [profileId, mask, timestamp] + list(encrypt(safe, message, bytes(str(int(fromFriend)), encoding='ascii'))))
+    return History.store(safe, profileId, mask, message, fromFriend, timestamp)
 
-    return con.lastrowid
+def storeHistoryBatch(safe, profileId, entries):
+    """
+    Store several messages in database at once, in a single transaction
+
+    @param safe: crypto box
+    @param profileId: profile ID of logged in user
+    @param entries: iterable of (friend's masked ID, message, from friend, timestamp), see storeHistory()
+    @return: rowids of stored messages, in order of entries
+    """
+    return History.storeMany(safe, profileId, entries)
 
-def getHistory(safe, profileId, mask, limit=20):
+def getHistory(safe, profileId, mask, limit=20, before=None, after=None):
     """
-    Return chat history for the previous <items> number of messages
+    Return a page of chat history, newest message first.
+
+    Pages are selected by keyset (datestamp, rowid) rather than offset so any page costs a single indexed lookup.
+    Without before or after the most recent messages are returned.
 
     @param safe: crypto box
     @param profileId: profile ID of logged in user
     @param mask: friend's masked ID
     @param limit: number of items to return
-    @return: [outgoing, message, datestamp]
+    @param before: (Optional) rowid of a history entry, return entries older than this entry
+    @param after: (Optional) rowid of a history entry, return entries newer than this entry
+    @return: [(rowid, from friend, message, datestamp), ...]
     """
+    # include queued history
+    History.flush()
 
     con = getCursor()
-    con.execute("SELECT rowid, from_friend, message, datestamp FROM history WHERE profile_Id=? AND friend_mask=? ORDER BY datestamp ASC LIMIT ?",
-                (profileId, mask, limit))
 
-    return [(rowid, bool(int(safe.decrypt(from_friend))), safe.decrypt(msg).decode(), datestamp) for rowid, from_friend, msg, datestamp in con.fetchall()]
+    cursor = before if before is not None else after
+    if cursor is not None:
+        con.execute("SELECT datestamp FROM history WHERE rowid=?", (cursor,))
+        out = con.fetchone()
+        if out is None:
+            return []
+
+        if before is not None:
+            con.execute("SELECT rowid, from_friend, message, datestamp FROM history "
+                        "WHERE profile_id=? AND friend_mask=? AND datestamp<=? AND (datestamp<? OR rowid<?) "
+                        "ORDER BY datestamp DESC, rowid DESC LIMIT ?",
+                        (profileId, mask, out[0], out[0], cursor, limit))
+        else:
+            con.execute("SELECT rowid, from_friend, message, datestamp FROM history "
+                        "WHERE profile_id=? AND friend_mask=? AND datestamp>=? AND (datestamp>? OR rowid>?) "
+                        "ORDER BY datestamp ASC, rowid ASC LIMIT ?",
+                        (profileId, mask, out[0], out[0], cursor, limit))
+    else:
+        con.execute("SELECT rowid, from_friend, message, datestamp FROM history WHERE profile_id=? AND friend_mask=? "
+                    "ORDER BY datestamp DESC, rowid DESC LIMIT ?", (profileId, mask, limit))
+
+    rows = con.fetchall()
+    if before is None and after is not None:
+        # newer entries are selected oldest first to keep the LIMIT next to the cursor
+        rows.reverse()
+
+    return [(rowid, bool(int(safe.decrypt(from_friend))), safe.decrypt(msg).decode(), datestamp)
+            for rowid, from_friend, msg, datestamp in rows]
 
 def getFriendRequests(safe, profileId, outgoing=True, expire=28):
     """
@@ -637,7 +1131,7 @@ def getFileRequests(safe, profileId, outgoing, mask=None, expire=7):
     # return dict instead of defaultdict
     return {k: v for k, v in ureqs.items()}
 
-def storeFileRequest(safe, profileId, outgoing, mask, request):
+def storeFileRequest(safe, profileId, outgoing, mask, request, tree=None):
     """
     Set file transfer request
 
@@ -646,14 +1140,42 @@ def storeFileRequest(safe, profileId, outgoing, mask, request):
     @param outgoing: 1 (True) for file requests sent by logged in user, 0 (False) for received file transfer requests
     @param mask: friend mask
     @param request: (filename, size, checksum)
+    @param tree: (Optional) (chunk size, Merkle tree root hash, digest name) for chunked transfers
     """
     fname, size, checksum = request
 
     con = getCursor()
     con.execute("INSERT INTO file_requests (profile_id, outgoing, friend_mask, filename, checksum, filesize, datestamp) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?)", [profileId, outgoing, mask] + list(encrypt(safe, fname, checksum, size, bytes(str(datetime.utcnow()), encoding='ascii'))))
+    rowid = con.lastrowid
 
-    return con.lastrowid
+    if tree is not None:
+        chunkSize, root, digest = tree
+        con.execute("UPDATE file_requests SET tree=? WHERE rowid=?",
+                    list(encrypt(safe, b':'.join((bytes(str(chunkSize), encoding='ascii'), hexlify(root), digest)))) +
+                    [rowid])
+
+    return rowid
+
+def getFileTree(safe, profileId, rowId):
+    """
+    Return the chunked transfer details of a file transfer request
+
+    @param safe: crypto box
+    @param profileId: logged in profile ID
+    @param rowId: file transfer request row ID
+    @return: (chunk size, Merkle tree root hash, digest name), None if the request was not sent with a Merkle tree
+    """
+    con = getCursor()
+    con.execute("SELECT tree FROM file_requests WHERE profile_id=? AND rowid=?", (profileId, rowId))
+    out = con.fetchone()
+    if out is None or out[0] is None:
+        return None
+
+    # chunk size:root hex[:digest name], sha1 when no digest was negotiated
+    tree = safe.decrypt(out[0]).split(b':')
+
+    return int(tree[0]), unhexlify(tree[1]), tree[2] if len(tree) > 2 else b'sha1'
 
 
 def delFileRequests(rowIds, cursor=None):
@@ -673,3 +1195,176 @@ def delFileRequests(rowIds, cursor=None):
         pass
 
     cursor.execute("DELETE FROM file_requests WHERE rowid IN (?)", (', '.join(rowIds),))
+    delFilePartials(rowIds, cursor)
+
+def getFilePartial(safe, profileId, requestId):
+    """
+    Return the download journal of a partially received file
+
+    @param safe: crypto box
+    @param profileId: logged in profile ID
+    @param requestId: file transfer request row ID
+    @return: (download location, chunk size, {chunk index: SHA1 of chunk}) or None if no journal exists
+    """
+    con = getCursor()
+    con.execute("SELECT location, chunk_size FROM file_partials WHERE profile_id=? AND request_id=?",
+                (profileId, requestId))
+    out = con.fetchone()
+    if out is None:
+        return None
+
+    location, chunkSize = out
+    con.execute("SELECT chunk, checksum FROM file_partial_chunks WHERE request_id=?", (requestId,))
+
+    return safe.decrypt(location).decode('utf-8'), chunkSize, {c: safe.decrypt(h) for c, h in con.fetchall()}
+
+def storeFilePartial(safe, profileId, requestId, location, chunkSize):
+    """
+    Start (or restart) the download journal of a file, removing any previously journaled chunks
+
+    @param safe: crypto box
+    @param profileId: logged in profile ID
+    @param requestId: file transfer request row ID
+    @param location: path the file is being downloaded to
+    @param chunkSize: number of bytes covered by each journaled chunk checksum
+    """
+    con = getCursor()
+    delFilePartials((requestId,), con)
+    con.execute("INSERT INTO file_partials (profile_id, request_id, location, chunk_size) VALUES (?, ?, ?, ?)",
+                [profileId, requestId] + list(encrypt(safe, bytes(location, encoding='utf-8'))) + [chunkSize])
+
+def storeFilePartialChunk(safe, requestId, chunk, checksum):
+    """
+    Journal a completely received chunk of a partially downloaded file
+
+    @param safe: crypto box
+    @param requestId: file transfer request row ID
+    @param chunk: chunk index from the start of the file
+    @param checksum: SHA1 hash value of the chunk
+    """
+    con = getCursor()
+    con.execute("INSERT OR REPLACE INTO file_partial_chunks (request_id, chunk, checksum) VALUES (?, ?, ?)",
+                [requestId, chunk] + list(encrypt(safe, checksum)))
+
+def truncateFilePartial(requestId, chunks):
+    """
+    Drop journaled chunks from the given chunk index onwards (chunks no longer present or valid on disk)
+
+    @param requestId: file transfer request row ID
+    @param chunks: number of leading chunks to keep
+    """
+    getCursor().execute("DELETE FROM file_partial_chunks WHERE request_id=? AND chunk>=?", (requestId, chunks))
+
+def delFilePartialChunks(requestId, chunks):
+    """
+    Drop the given journaled chunks (chunks no longer present or valid on disk)
+
+    @param requestId: file transfer request row ID
+    @param chunks: iterable of chunk indexes
+    """
+    getCursor().executemany("DELETE FROM file_partial_chunks WHERE request_id=? AND chunk=?",
+                            ((requestId, c) for c in chunks))
+
+def delFilePartials(rowIds, cursor=None):
+    """
+    Remove download journals of the given file transfer request row id(s)
+
+    @param rowIds: an iterable of file transfer request internal row IDs
+    @param cursor: database connection cursor object. If None, new cursor will be created.
+    """
+    if cursor is None:
+        cursor = getCursor()
+
+    rowIds = [int(r) for r in rowIds]
+    placeholders = ', '.join('?' * len(rowIds))
+    cursor.execute("DELETE FROM file_partials WHERE request_id IN ({})".format(placeholders), rowIds)
+    cursor.execute("DELETE FROM file_partial_chunks WHERE request_id IN ({})".format(placeholders), rowIds)
+
+def _pathMacKey(safe):
+    """
+    Key of the path hashes, derived from the crypto box key so paths are not hashed with the encryption key itself
+
+    @param safe: crypto box
+    @return: 32 byte MAC key
+    """
+    return hmac.new(bytes(safe), PATH_MAC_LABEL, sha256).digest()
+
+def _fileKey(safe, filePath):
+    """
+    @param safe: crypto box
+    @param filePath: path of file (str or bytes)
+    @return: (path as bytes, size:mtime:inode of the file, keyed hash of the path)
+    """
+    if type(filePath) is str:
+        filePath = bytes(filePath, encoding='utf-8')
+
+    # raises OSError if file does not exist
+    fstat = stat(filePath)
+    details = bytes("{}:{}:{}".format(fstat.st_size, fstat.st_mtime_ns, fstat.st_ino), encoding='ascii')
+
+    return filePath, details, hmac.new(_pathMacKey(safe), filePath, sha256).digest()
+
+def getFileChecksum(safe, profileId, filePath):
+    """
+    Return SHA1 checksum of a file, only hashing the file when it is not known or its size, modification time or inode
+    has changed since it was last hashed.
+
+    Paths are stored as a keyed hash and file details are encrypted.
+
+    @param safe: crypto box
+    @param profileId: logged in profile ID
+    @param filePath: path of file (str or bytes)
+    @return: SHA1 hash value (bytes)
+    """
+    filePath, details, pathKey = _fileKey(safe, filePath)
+
+    con = getCursor()
+    con.execute("SELECT details FROM file_checksums WHERE profile_id=? AND path_key=?", (profileId, pathKey))
+    out = con.fetchone()
+
+    if out is not None:
+        # stored as size:mtime:inode:checksum
+        stored, _, checksum = safe.decrypt(out[0]).rpartition(b':')
+        if stored == details:
+            return checksum
+
+    checksum = sha1sum(filePath)
+    con.execute("INSERT OR REPLACE INTO file_checksums (profile_id, path_key, details) VALUES (?, ?, ?)",
+                [profileId, pathKey] + list(encrypt(safe, b':'.join((details, checksum)))))
+
+    return checksum
+
+def getFileMerkleTree(safe, profileId, filePath, chunkSize, digest=b'sha1'):
+    """
+    Return the Merkle tree of a file, only hashing the file when its leaves are not stored with its checksum (see
+    getFileChecksum()) for the chunk size and digest, or the file has changed since they were stored.
+
+    Hashes the file in the calling thread, use run_in_executor() from the event loop.
+
+    @param safe: crypto box
+    @param profileId: logged in profile ID
+    @param filePath: path of file (str or bytes)
+    @param chunkSize: number of bytes in each leaf chunk
+    @param digest: (Optional) name of the tree digest, see DIGESTS
+    @return: list of tree levels, see merkleTree()
+    """
+    filePath, details, pathKey = _fileKey(safe, filePath)
+    details = b':'.join((details, bytes(str(chunkSize), encoding='ascii'), digest))
+
+    con = getCursor()
+    con.execute("SELECT tree FROM file_checksums WHERE profile_id=? AND path_key=?", (profileId, pathKey))
+    out = con.fetchone()
+
+    if out is not None and out[0] is not None:
+        # stored as size:mtime:inode:chunk size:digest name:leaves
+        stored = safe.decrypt(out[0]).split(b':', 5)
+        if b':'.join(stored[:5]) == details:
+            size = DIGESTS[digest]().digest_size
+            return merkleLevels([stored[5][i:i + size] for i in range(0, len(stored[5]), size)], DIGESTS[digest])
+
+    levels = merkleTree(filePath, chunkSize, DIGESTS[digest])
+    # kept with the checksum, which drops the tree when the file changes
+    con.execute("UPDATE file_checksums SET tree=? WHERE profile_id=? AND path_key=?",
+                list(encrypt(safe, b':'.join((details, b''.join(levels[0]))))) + [profileId, pathKey])
+
+    return levels
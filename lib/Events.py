@@ -0,0 +1,69 @@
+#
+# Events published by the P2P server
+#
+import asyncio
+import logging
+from collections import namedtuple, defaultdict
+
+# chat message received from a friend and stored in history
+MessageReceived = namedtuple('MessageReceived', ['uid', 'rowid', 'message', 'timestamp'])
+# friend sent a new avatar
+AvatarUpdated = namedtuple('AvatarUpdated', ['uid'])
+# friend requested to send a file, stored with the incoming file requests
+FileRequest = namedtuple('FileRequest', ['uid', 'filename', 'size', 'checksum', 'rowid'])
+# file sent to a friend, sent is the number of bytes of the file sent (from the resume offset)
+FileSent = namedtuple('FileSent', ['uid', 'checksum', 'sent'])
+# friend accepted a friend request, the auth token is waiting to be sent to the quip server
+AuthPending = namedtuple('AuthPending', ['token'])
+# friend's presence beacons show a new status or address, address is (ip, port) of the friend's P2P server
+PresenceChanged = namedtuple('PresenceChanged', ['uid', 'status', 'address'])
+
+
+class EventBus:
+    """
+    Delivers published events to their subscribers as they happen.
+
+    Callbacks are subscribed to an event type (one of the namedtuples above) and called from the event loop with each
+    event of that type, so they must not run the loop themselves. Coroutine consumers can read events from a queue
+    instead, see queue().
+    """
+    def __init__(self):
+        # event type -> [callback, ]
+        self.subscribers = defaultdict(list)
+
+    def subscribe(self, eventType, callback):
+        """
+        @param eventType: event type to receive
+        @param callback: called with each published event of eventType
+        """
+        self.subscribers[eventType].append(callback)
+
+    def unsubscribe(self, eventType, callback):
+        try:
+            self.subscribers[eventType].remove(callback)
+        except ValueError:
+            pass
+
+    def publish(self, event):
+        """
+        Call the subscribers of the event's type, a failing subscriber does not stop the others
+        """
+        for callback in tuple(self.subscribers[type(event)]):
+            try:
+                callback(event)
+            except Exception:
+                logging.error("Event subscriber failed for {!r}".format(event), exc_info=True)
+
+    def queue(self, *eventTypes, loop=None):
+        """
+        Receive events in an asyncio.Queue, for consumers without a GUI
+
+        @param eventTypes: event types to receive
+        @param loop: (Optional) event loop of the queue
+        @return: asyncio.Queue of published events, unsubscribe() its put_nowait method to stop receiving events
+        """
+        events = asyncio.Queue(loop=loop)
+        for eventType in eventTypes:
+            self.subscribe(eventType, events.put_nowait)
+
+        return events
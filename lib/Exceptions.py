@@ -23,6 +23,9 @@ class Unauthorised(Exception): pass
 # Raised when computed file hash does not equal stored hash for file
 class FileCorruption(Exception): pass
 
+# Raised when a queued or running file transfer is cancelled
+class TransferCancelled(Exception): pass
+
 # Raised when sending data failed
 class SendFailure(Exception): pass
 
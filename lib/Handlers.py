@@ -8,13 +8,16 @@ from functools import partial
 from hashlib import sha1, sha384
 from uuid import uuid4
 from os import path
+from binascii import hexlify, unhexlify
 
 from lib.Database import getFriendRequests, getSigningKeys, setUidMask, storeAuthority, setFriendAuth, getMessageKeys, \
     setAddress, getFileRequests, storeFileRequest, delFileRequests, delFriendRequests, getFriendChecksum, \
-    updateFriendDetails, storeHistory
-from lib.Utils import isValidUUID, sha1sum
+    updateFriendDetails, storeHistory, getFileChecksum, getFileMerkleTree
+from lib.Exceptions import TransferCancelled
+from lib.Utils import isValidUUID, merkleProof, chooseCodec, DIGESTS, CODECS
 from lib.Constants import BTRUE, BFALSE, WRITE_END, COMMAND_LENGTH, NONEXISTANT, PROFILE_VALUE_SEPARATOR, \
-    LIMIT_AVATAR_SIZE, MODIFIED_FILE
+    LIMIT_AVATAR_SIZE, MODIFIED_FILE, LIMIT_CHUNK_MIN, LIMIT_CHUNK_MAX, INVALID_DATA, BLOCK_LENGTH, COMPRESS_SAMPLE, \
+    COMPRESS_RATIO
 
 ######################################
 # Server Dispatch Coroutine Handlers
@@ -152,16 +155,18 @@ def requestSendFile(safe, profileId, mask, data):
     @param safe: crypto box
     @param profileId: logged in user's profile ID
     @param mask: local friend mask for given friend's user ID
-    @param data: filename, size, checksum seperated by VALUE_SEPERATOR and user ID
+    @param data: filename, size, checksum (and optionally chunk size, Merkle tree root hex and tree digest name for
+                 chunked transfers) seperated by VALUE_SEPERATOR and user ID
     @return: user id, filename, size
     """
+    fields = data[:-36 - COMMAND_LENGTH].split(bytes(PROFILE_VALUE_SEPARATOR, encoding='utf-8'))
     try:
-        filename, size, checksum = data[:-36].split(bytes(PROFILE_VALUE_SEPARATOR, encoding='utf-8'))
-    except ValueError:
+        filename, size, checksum = fields[:3]
+        assert len(fields) in (3, 5, 6)
+    except (ValueError, AssertionError):
         logging.info("Invalid file request data recieved: {!r}".format(data))
         return False
 
-    checksum = checksum[:-COMMAND_LENGTH]
     # validate received data
     try:
         # sha1 hex length
@@ -175,15 +180,28 @@ def requestSendFile(safe, profileId, mask, data):
         logging.info("Invalid file request data received, size is not an integer: {!r}".format(size))
         return False
 
+    tree = None
+    if len(fields) > 3:
+        try:
+            # sha1 unless another digest was negotiated
+            tree = int(fields[3]), unhexlify(fields[4]), fields[5] if len(fields) == 6 else b'sha1'
+            assert LIMIT_CHUNK_MIN <= tree[0] <= LIMIT_CHUNK_MAX and len(tree[1]) == 20 and tree[2] in DIGESTS
+        except (ValueError, AssertionError):
+            # chunked transfers are optional, the file can still be sent as a single stream
+            logging.info("Invalid file request Merkle tree received: {!r}".format(fields[3:]))
+            tree = None
+
     # store file transfer request
-    rowid = storeFileRequest(safe, profileId, outgoing=False, mask=mask, request=(filename, size, checksum))
+    rowid = storeFileRequest(safe, profileId, outgoing=False, mask=mask, request=(filename, size, checksum), tree=tree)
 
     return data[-36:], filename, size, checksum, rowid
 
 @asyncio.coroutine
-def sendFile(writer, safe, profileId, mask, checksum, expiry, blockSize=4098):
+def _outgoingFile(writer, safe, profileId, mask, checksum, expiry, end=b''):
     """
-    Send file to from server to client destination
+    Find the outgoing file transfer request for a file and ensure the file is unchanged since the request was sent.
+
+    Invalid or expired requests are removed and the failure is written to the client.
 
     @param writer: StreamWriter object to client
     @param safe: crypto box
@@ -191,8 +209,8 @@ def sendFile(writer, safe, profileId, mask, checksum, expiry, blockSize=4098):
     @param mask: local friend mask for given friend's user ID
     @param checksum: sha1 sum value of file to be sent
     @param expiry: expire days for file transfer requests (config set value)
-    @param blockSize: total number of bytes to read at once
-    @return: True when file if completely sent, otherwise False
+    @param end: (Optional) bytes written after a failure value
+    @return: (file path, size, request row ID), None if the file can not be sent
     """
     try:
         # obtain current requests for provided mask and clear expired requests
@@ -200,20 +218,20 @@ def sendFile(writer, safe, profileId, mask, checksum, expiry, blockSize=4098):
     except KeyError:
         logging.warning("\t".join(("File Transfer Failed",
                                    "File transfer request does not exist for mask {} and checksum {}".format(mask, checksum))))
-        writer.write(NONEXISTANT)
+        writer.write(b''.join((NONEXISTANT, end)))
         yield from writer.drain()
-        return False
+        return None
 
     if not path.isfile(filename):
         delFileRequests(rowid)
         logging.warning("\t".join(("File Transfer Failed", "File no longer exists: {}".format(filename))))
-        writer.write(NONEXISTANT)
+        writer.write(b''.join((NONEXISTANT, end)))
         yield from writer.drain()
-        return False
+        return None
 
     # match file checksum to ensure the same file which was to be sent
-    # has not been modified since the original transfer request
-    cursum = sha1sum(filename)
+    # has not been modified since the original transfer request (only rehashed if file details have changed)
+    cursum = getFileChecksum(safe, profileId, filename)
     if checksum != cursum:
         # remove invalid transfer request
         delFileRequests(rowid)
@@ -221,25 +239,238 @@ def sendFile(writer, safe, profileId, mask, checksum, expiry, blockSize=4098):
                                    "Filename: {}".format(filename),
                                    "Original checksum: {}".format(checksum),
                                    "Current checksum: {}".format(cursum))))
-        writer.write(MODIFIED_FILE)
+        writer.write(b''.join((MODIFIED_FILE, end)))
         yield from writer.drain()
 
-        return False
+        return None
+
+    return filename, size, rowid
+
+def _compressedBlocks(blocks, compressor):
+    """
+    Compress file blocks into length prefixed blocks, ending with an empty block
+
+    @param blocks: iterable of (length, file data)
+    @param compressor: compression object
+    @return: generator of (uncompressed length, bytes to write)
+    """
+    for length, buf in blocks:
+        out = compressor.compress(buf)
+        # compressors buffer input, there may be nothing to send yet
+        yield length, b''.join((BLOCK_LENGTH.pack(len(out)), out)) if out else b''
+
+    out = compressor.flush()
+    yield 0, b''.join((BLOCK_LENGTH.pack(len(out)), out, BLOCK_LENGTH.pack(0)) if out else (BLOCK_LENGTH.pack(0),))
+
+@asyncio.coroutine
+def sendFile(writer, safe, profileId, mask, checksum, expiry, blockSize=4098, timeout=None, watermarks=None,
+             offset=0, codecs=None, compression=None, throttle=None):
+    """
+    Send file to from server to client destination
+
+    The file is streamed one block at a time, waiting for the transport to drain below its low watermark whenever the
+    high watermark is exceeded, so memory use is bounded by the watermarks rather than the file size.
+
+    A non zero offset resumes an interrupted transfer, only the remainder of the file from that byte is sent.
+
+    Clients offering compression codecs (protocol v5) first receive a line naming the codec used ('none' when the file
+    does not compress well), compressed files are sent as length prefixed blocks ending with an empty block. Failures
+    are then followed by a newline.
+
+    @param writer: StreamWriter object to client
+    @param safe: crypto box
+    @param profileId: logged in user's profile ID
+    @param mask: local friend mask for given friend's user ID
+    @param checksum: sha1 sum value of file to be sent
+    @param expiry: expire days for file transfer requests (config set value)
+    @param blockSize: total number of bytes to read at once
+    @param timeout: (Optional) seconds the client may stall receiving data before the transfer is abandoned
+    @param watermarks: (Optional) transport write buffer (high, low) limits in bytes
+    @param offset: (Optional) byte position to start sending from
+    @param codecs: (Optional) compression codec names offered by the client
+    @param compression: (Optional) (preferred codec name, level) used when offered and worthwhile
+    @param throttle: (Optional) coroutine function given the number of bytes about to be sent, see Transfer.throttle
+    @return: number of bytes of the file sent (from offset) when completely sent, otherwise None
+    """
+    end = WRITE_END if codecs is not None else b''
+    request = yield from _outgoingFile(writer, safe, profileId, mask, checksum, expiry, end)
+    if request is None:
+        return None
+
+    filename, size, rowid = request
+    size = int(size)
+    try:
+        offset = int(offset)
+        assert 0 <= offset <= size
+    except (ValueError, AssertionError):
+        # request is kept, the client restarts the transfer from the beginning
+        logging.warning("\t".join(("File Transfer Failed", "Invalid resume offset: {!r}".format(offset),
+                                   "Filename: {}".format(filename))))
+        writer.write(b''.join((NONEXISTANT, end)))
+        yield from writer.drain()
+        return None
+
+    if watermarks is not None:
+        high, low = watermarks
+        writer.transport.set_write_buffer_limits(high=int(high), low=int(low))
 
     blockSize = int(blockSize)
+    sent = offset
+    codec = None
     with open(filename, 'rb') as fd:
-        for buf in iter(partial(fd.read, blockSize), b''):
+        if codecs is not None:
+            if compression is not None:
+                # sample the data to be sent, files which are already compressed are sent as is
+                fd.seek(offset)
+                codec = chooseCodec(fd.read(COMPRESS_SAMPLE), codecs, compression[0], int(compression[1]),
+                                    COMPRESS_RATIO)
+            writer.write(b''.join((codec or b'none', WRITE_END)))
+
+        fd.seek(offset)
+        # NOTE: a new buffer is read for each block as transports may keep a reference to written data until sent
+        blocks = ((len(buf), buf) for buf in iter(partial(fd.read, blockSize), b''))
+        if codec is not None:
+            blocks = _compressedBlocks(blocks, CODECS[codec][0](int(compression[1])))
+
+        for length, buf in blocks:
+            if throttle is not None:
+                try:
+                    yield from throttle(len(buf))
+                except TransferCancelled:
+                    logging.info("\t".join(("File Transfer Cancelled", "Filename: {}".format(filename),
+                                             "Sent: {} of {} bytes".format(sent, size))))
+                    return None
+
             writer.write(buf)
+            sent += length
 
-        yield from writer.drain()
+            try:
+                # only waits while the transport buffer is above its high watermark
+                yield from asyncio.wait_for(writer.drain(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("\t".join(("File Transfer Failed", "Transfer stalled for {} seconds".format(timeout),
+                                           "Filename: {}".format(filename),
+                                           "Sent: {} of {} bytes".format(sent, size))))
+                return None
+
+    logging.info("\t".join(("File Transfer Complete", "Filename: {}".format(filename),
+                             "Sent: {} bytes".format(sent - offset), "Offset: {}".format(offset),
+                             "Compression: {}".format(codec))))
 
     # remove file transfer request from storage
     delFileRequests(rowid)
 
+    return sent - offset
+
+@asyncio.coroutine
+def sendChunk(writer, safe, profileId, mask, checksum, chunkSize, index, expiry, trees, timeout=None, digest=b'sha1',
+              codecs=None, compression=None, compressible=None, throttle=None, loop=None):
+    """
+    Send a single chunk of a file with the Merkle tree proof needed to verify it
+
+    The response is a line of chunk index, chunk length and proof hashes (hex) seperated by ':', followed by the chunk.
+    Clients offering compression codecs (protocol v5) receive the codec name ('none' if uncompressed) after the chunk
+    length, the length is then the number of bytes sent. Failures are followed by a newline.
+
+    @param writer: StreamWriter object to client
+    @param safe: crypto box
+    @param profileId: logged in user's profile ID
+    @param mask: local friend mask for given friend's user ID
+    @param checksum: sha1 sum value of file to be sent
+    @param chunkSize: number of bytes in each chunk
+    @param index: index of chunk to send
+    @param expiry: expire days for file transfer requests (config set value)
+    @param trees: Merkle tree levels of files being sent, (checksum, chunk size, digest) -> levels
+    @param timeout: (Optional) seconds the client may stall receiving data before the transfer is abandoned
+    @param digest: (Optional) name of the Merkle tree digest, see DIGESTS
+    @param codecs: (Optional) compression codec names offered by the client
+    @param compression: (Optional) (preferred codec name, level) used when offered and worthwhile
+    @param compressible: (Optional) files found worth compressing, (checksum, codec name) -> bool
+    @param throttle: (Optional) coroutine function given the number of bytes about to be sent, see Transfer.throttle
+    @param loop: (Optional) event loop, files without a stored Merkle tree are hashed in its default executor
+    @return: True when the chunk is sent, otherwise False
+    """
+    request = yield from _outgoingFile(writer, safe, profileId, mask, checksum, expiry, WRITE_END)
+    if request is None:
+        return False
+
+    filename, size, rowid = request
+    try:
+        chunkSize, index = int(chunkSize), int(index)
+        assert LIMIT_CHUNK_MIN <= chunkSize <= LIMIT_CHUNK_MAX and digest in DIGESTS
+    except (ValueError, AssertionError):
+        logging.warning("\t".join(("File Chunk Failed", "Invalid chunk size: {!r}".format(chunkSize),
+                                   "Invalid digest: {!r}".format(digest), "Filename: {}".format(filename))))
+        writer.write(b''.join((INVALID_DATA, WRITE_END)))
+        yield from writer.drain()
+        return False
+
+    try:
+        levels = trees[(checksum, chunkSize, digest)]
+    except KeyError:
+        # kept once per file and chunk size, the file is unchanged while its checksum matches. The leaves are stored
+        # with the file's checksum, so the file is only hashed again when it changed
+        levels = yield from (loop or asyncio.get_event_loop()).run_in_executor(None, getFileMerkleTree, safe, profileId,
+                                                                               filename, chunkSize, digest)
+        trees[(checksum, chunkSize, digest)] = levels
+
+    if not 0 <= index < len(levels[0]):
+        logging.warning("\t".join(("File Chunk Failed", "Invalid chunk index: {}".format(index),
+                                   "Filename: {}".format(filename))))
+        writer.write(b''.join((INVALID_DATA, WRITE_END)))
+        yield from writer.drain()
+        return False
+
+    codec = None
+    with open(filename, 'rb') as fd:
+        if codecs is not None and compression is not None and compression[0] in codecs:
+            if compressible is None:
+                compressible = {}
+            try:
+                codec = compression[0] if compressible[(checksum, compression[0])] else None
+            except KeyError:
+                # the start of the file decides for all of its chunks, files which are already compressed are sent as is
+                codec = chooseCodec(fd.read(COMPRESS_SAMPLE), codecs, compression[0], int(compression[1]),
+                                    COMPRESS_RATIO)
+                compressible[(checksum, compression[0])] = codec is not None
+
+        fd.seek(index * chunkSize)
+        buf = fd.read(chunkSize)
+
+    if codec is not None:
+        compressor = CODECS[codec][0](int(compression[1]))
+        out = b''.join((compressor.compress(buf), compressor.flush()))
+        if len(out) < len(buf):
+            buf = out
+        else:
+            codec = None
+
+    header = [bytes(str(index), encoding='ascii'), bytes(str(len(buf)), encoding='ascii')]
+    if codecs is not None:
+        header.append(codec or b'none')
+
+    if throttle is not None:
+        try:
+            yield from throttle(len(buf))
+        except TransferCancelled:
+            logging.info("\t".join(("File Chunk Cancelled", "Filename: {}".format(filename), "Chunk: {}".format(index))))
+            # ends the client's use of this connection for the transfer
+            writer.write(b''.join((NONEXISTANT, WRITE_END)))
+            yield from writer.drain()
+            return False
+    writer.write(b''.join((b':'.join(header + [hexlify(h) for h in merkleProof(levels, index)]), WRITE_END, buf)))
+
+    try:
+        yield from asyncio.wait_for(writer.drain(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("\t".join(("File Chunk Failed", "Transfer stalled for {} seconds".format(timeout),
+                                   "Filename: {}".format(filename), "Chunk: {}".format(index))))
+        return False
+
     return True
 
 @asyncio.coroutine
-def receiveAvatar(reader, writer, safe, profileId, mask, checksum):
+def receiveAvatar(reader, writer, safe, profileId, mask, checksum, timeout=None):
     """
     Receive avatar update check from friend
 
@@ -249,6 +480,7 @@ def receiveAvatar(reader, writer, safe, profileId, mask, checksum):
     @param profileId: logged in user's profile ID
     @param mask: friend mask uid
     @param checksum: avatar sha1 checksum
+    @param timeout: (Optional) seconds allowed for each read from friend
     @return: '0' if avatar not updated, otherwise locally calculated checksum value of stored avatar
     """
     if len(checksum) != 40:
@@ -268,7 +500,11 @@ def receiveAvatar(reader, writer, safe, profileId, mask, checksum):
         return BFALSE
 
     # get size of avatar to read from friend
-    size = yield from reader.readline()
+    try:
+        size = yield from asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Friend mask '{}' timed out sending avatar size".format(mask))
+        return BFALSE
 
     try:
         size = int(size)
@@ -281,7 +517,11 @@ def receiveAvatar(reader, writer, safe, profileId, mask, checksum):
     yield from writer.drain()
 
     # read avatar into memory
-    avatar = yield from reader.readexactly(size)
+    try:
+        avatar = yield from asyncio.wait_for(reader.readexactly(size), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Friend mask '{}' timed out sending avatar".format(mask))
+        return BFALSE
 
     # store avatar
     storedChecksum = updateFriendDetails(safe, profileId, mask, avatar=avatar)
@@ -0,0 +1,409 @@
+#
+# Stream multiplexing over a single P2P connection (protocol v6)
+#
+import asyncio
+import logging
+from itertools import count
+
+import lib.Constants as CONS
+
+
+class StreamTransport:
+    """
+    Transport facade of a stream, for handlers adjusting write buffer limits or inspecting the connection
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def get_extra_info(self, name, default=None):
+        return self.stream.mux.writer.transport.get_extra_info(name, default)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        """
+        @param high: bytes buffered by the stream before drain() waits, defaults to 4 * low or 65536
+        @param low: bytes buffered by the stream when drain() resumes, defaults to high // 4
+        """
+        if high is None:
+            high = 4 * low if low is not None else 65536
+        if low is None:
+            low = high // 4
+
+        self.stream.high, self.stream.low = high, low
+
+    def close(self):
+        self.stream.close()
+
+
+class MuxStream:
+    """
+    A logical stream of a multiplexed connection.
+
+    Provides the StreamReader (read, readline, readexactly) and StreamWriter (write, drain, close) methods used by the
+    P2P client and server, the same object is used as both reader and writer.
+    """
+    def __init__(self, mux, streamId, priority, limit):
+        """
+        Stream constructor
+
+        @param mux: Multiplexer of the connection
+        @param streamId: stream id
+        @param priority: PRIORITY_CONTROL or PRIORITY_BULK
+        @param limit: maximum line length read by readline()
+        """
+        self.mux = mux
+        self.id = streamId
+        self.priority = priority
+        self.limit = min(limit, CONS.MUX_WINDOW_SIZE)
+        self.transport = StreamTransport(self)
+        # received data not yet read
+        self.incoming = bytearray()
+        # bytes read since the last window update sent to the peer
+        self.consumed = 0
+        self.eof = False
+        self.readable = asyncio.Event()
+        # data waiting to be sent, and the bytes the peer is willing to receive
+        self.outgoing = bytearray()
+        self.window = CONS.MUX_WINDOW_SIZE
+        self.high, self.low = 65536, 16384
+        self.drained = asyncio.Event()
+        self.drained.set()
+        # closed locally (sent once outgoing data is sent) or by the peer
+        self.closing = False
+        self.closed = False
+        # order of the stream's last sent frame, streams of equal priority take turns
+        self.turn = 0
+
+    def feed(self, data):
+        """
+        Data received from the peer
+
+        @return: False if the peer sent more data than the window allows
+        """
+        if len(self.incoming) + len(data) > CONS.MUX_WINDOW_SIZE:
+            return False
+
+        self.incoming.extend(data)
+        self.readable.set()
+        return True
+
+    def feed_eof(self):
+        """
+        Stream closed by the peer (or the connection was lost), pending outgoing data is dropped
+        """
+        self.eof = self.closed = True
+        self.outgoing.clear()
+        self.readable.set()
+        self.drained.set()
+
+    def _take(self, n):
+        """
+        Remove n bytes from the received data, granting the peer more window once half the window has been read
+        """
+        data = bytes(self.incoming[:n])
+        del self.incoming[:n]
+        if not self.incoming:
+            self.readable.clear()
+
+        self.consumed += len(data)
+        if self.consumed >= CONS.MUX_WINDOW_SIZE // 2 and not self.eof:
+            self.mux.control(self.id, CONS.MUX_WINDOW, CONS.BLOCK_LENGTH.pack(self.consumed))
+            self.consumed = 0
+
+        return data
+
+    @asyncio.coroutine
+    def _wait(self):
+        self.readable.clear()
+        yield from self.readable.wait()
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        """
+        @param n: maximum number of bytes to read, all data until the stream is closed if negative
+        @return: received data, empty once the stream is closed
+        """
+        if n < 0:
+            data = bytearray()
+            while not self.eof or self.incoming:
+                data.extend(self._take(len(self.incoming)))
+                if not self.eof:
+                    yield from self._wait()
+            return bytes(data)
+
+        while not self.incoming and not self.eof:
+            yield from self._wait()
+
+        return self._take(n)
+
+    @asyncio.coroutine
+    def readline(self):
+        """
+        @return: data up to and including a newline, or the remaining data once the stream is closed
+        """
+        while True:
+            end = self.incoming.find(b'\n')
+            if end >= 0:
+                return self._take(end + 1)
+            elif self.eof:
+                return self._take(len(self.incoming))
+            elif len(self.incoming) >= self.limit:
+                raise ValueError("Line is too long")
+
+            yield from self._wait()
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        """
+        @param n: number of bytes to read
+        @return: n bytes, IncompleteReadError raised if the stream is closed first
+        """
+        if len(self.incoming) >= n:
+            return self._take(n)
+
+        # reads larger than the window are only received as the data is taken
+        data = bytearray()
+        while len(data) < n:
+            if self.incoming:
+                data.extend(self._take(n - len(data)))
+            elif self.eof:
+                raise asyncio.IncompleteReadError(bytes(data), n)
+            else:
+                yield from self._wait()
+
+        return bytes(data)
+
+    def at_eof(self):
+        return self.eof and not self.incoming
+
+    def exception(self):
+        # connection errors end the stream with EOF
+        return None
+
+    def write(self, data):
+        if self.closing or self.closed:
+            return
+
+        self.outgoing.extend(data)
+        if len(self.outgoing) > self.high:
+            self.drained.clear()
+        self.mux.wakeup.set()
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Wait until the stream's buffered data is below its high watermark
+        """
+        if self.closed:
+            raise ConnectionResetError("Stream {} closed".format(self.id))
+
+        yield from self.drained.wait()
+        if self.closed:
+            raise ConnectionResetError("Stream {} closed".format(self.id))
+
+    def close(self):
+        """
+        Close the stream once its buffered data is sent
+        """
+        if not self.closing and not self.closed:
+            self.closing = True
+            self.mux.wakeup.set()
+
+
+class Multiplexer:
+    """
+    Multiplexes logical streams over one P2P connection, so chat, presence, avatar and file traffic to a friend
+    interleave instead of waiting for each other.
+
+    Data is sent in MUX_HEADER frames of up to MUX_FRAME bytes. Streams with data to send take turns, the control
+    stream first. Each stream may only send MUX_WINDOW_SIZE bytes the peer has not read yet, so a slow file transfer
+    does not fill the connection. Streams are opened by the connecting client, servers handle each opened stream as a
+    connection of its own (see handler).
+    """
+    def __init__(self, reader, writer, loop, handler=None, limit=65536, timeout=None):
+        """
+        Multiplexer constructor
+
+        @param reader: StreamReader of the connection
+        @param writer: StreamWriter of the connection
+        @param loop: event loop running the connection
+        @param handler: (Optional) coroutine function called with each stream opened by the peer. If None opened
+                        streams are refused
+        @param limit: maximum line length of streams
+        @param timeout: (Optional) seconds the connection may stay idle without open streams
+        """
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.handler = handler
+        self.limit = limit
+        self.timeout = timeout
+        # stream id -> MuxStream
+        self.streams = {}
+        # tasks handling streams opened by the peer
+        self.tasks = set()
+        # frames sent before stream data (stream opening, closing and window updates)
+        self.frames = []
+        self.ids = count(1)
+        self.turns = count(1)
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.sender = None
+
+    def start(self):
+        """
+        Run the connection in a task
+        """
+        return self.loop.create_task(self.run())
+
+    def open(self, priority=CONS.PRIORITY_BULK):
+        """
+        Open a new stream
+
+        @param priority: PRIORITY_CONTROL or PRIORITY_BULK
+        @return: MuxStream
+        """
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+
+        streamId = next(self.ids)
+        stream = self.streams[streamId] = MuxStream(self, streamId, priority, self.limit)
+        self.control(streamId, CONS.MUX_OPEN, bytes((priority,)))
+        return stream
+
+    def control(self, streamId, kind, payload=b''):
+        """
+        Queue a control frame, sent before any further stream data
+        """
+        self.frames.append(CONS.MUX_HEADER.pack(streamId, kind, len(payload)) + payload)
+        self.wakeup.set()
+
+    def _next(self):
+        """
+        @return: next frame to send, None if there is nothing to send
+        """
+        if self.frames:
+            return self.frames.pop(0)
+
+        ready = [s for s in self.streams.values() if (s.outgoing and s.window > 0) or (s.closing and not s.outgoing)]
+        if not ready:
+            return None
+
+        stream = min(ready, key=lambda s: (s.priority, s.turn))
+        stream.turn = next(self.turns)
+        if not stream.outgoing:
+            # closed and all data sent
+            del self.streams[stream.id]
+            stream.closed = True
+            stream.drained.set()
+            return CONS.MUX_HEADER.pack(stream.id, CONS.MUX_CLOSE, 0)
+
+        data = bytes(stream.outgoing[:min(CONS.MUX_FRAME, stream.window)])
+        del stream.outgoing[:len(data)]
+        stream.window -= len(data)
+        if len(stream.outgoing) <= stream.low:
+            stream.drained.set()
+
+        return b''.join((CONS.MUX_HEADER.pack(stream.id, CONS.MUX_DATA, len(data)), data))
+
+    @asyncio.coroutine
+    def _send(self):
+        """
+        Write frames to the connection as streams have data to send
+        """
+        while True:
+            frame = self._next()
+            if frame is None:
+                self.wakeup.clear()
+                yield from self.wakeup.wait()
+                continue
+
+            try:
+                self.writer.write(frame)
+                yield from self.writer.drain()
+            except ConnectionError:
+                self.close()
+                return
+
+    def _receive(self, streamId, kind, payload):
+        """
+        Process a received frame
+
+        @return: False if the peer violated the protocol
+        """
+        stream = self.streams.get(streamId)
+        if kind == CONS.MUX_OPEN:
+            if stream is not None or self.handler is None or len(self.streams) >= CONS.LIMIT_STREAMS:
+                self.control(streamId, CONS.MUX_CLOSE)
+                return stream is None
+
+            priority = payload[0] if payload else CONS.PRIORITY_BULK
+            stream = self.streams[streamId] = MuxStream(self, streamId, priority, self.limit)
+            task = self.loop.create_task(self.handler(stream))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif stream is None:
+            # frames of streams already closed locally
+            pass
+        elif kind == CONS.MUX_DATA:
+            return stream.feed(payload)
+        elif kind == CONS.MUX_WINDOW:
+            if len(payload) != CONS.BLOCK_LENGTH.size:
+                return False
+            stream.window += CONS.BLOCK_LENGTH.unpack(payload)[0]
+            self.wakeup.set()
+        elif kind == CONS.MUX_CLOSE:
+            del self.streams[streamId]
+            stream.feed_eof()
+        else:
+            return False
+
+        return True
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Read frames from the connection until it is closed
+        """
+        self.sender = self.loop.create_task(self._send())
+        try:
+            while True:
+                try:
+                    header = yield from asyncio.wait_for(self.reader.readexactly(CONS.MUX_HEADER.size), self.timeout)
+                except asyncio.TimeoutError:
+                    if self.streams:
+                        continue
+                    # idle connection
+                    break
+
+                streamId, kind, length = CONS.MUX_HEADER.unpack(header)
+                if length > CONS.MUX_FRAME:
+                    logging.info("Multiplexed frame of {} bytes exceeds maximum size".format(length))
+                    break
+
+                payload = yield from self.reader.readexactly(length)
+                if not self._receive(streamId, kind, payload):
+                    logging.info("\t".join(("Invalid multiplexed frame", "Stream: {}".format(streamId),
+                                            "Type: {}".format(kind))))
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # connection lost
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Close the connection and all of its streams
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.sender is not None and self.sender is not asyncio.Task.current_task(self.loop):
+            self.sender.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        for stream in self.streams.values():
+            stream.feed_eof()
+        self.streams.clear()
+        self.writer.close()
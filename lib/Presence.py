@@ -0,0 +1,213 @@
+#
+# UDP presence heartbeat
+#
+import asyncio
+import logging
+from time import time, monotonic
+
+from nacl.exceptions import BadSignatureError
+
+import lib.Constants as CONS
+from lib.Exceptions import MissingFriend
+from lib.Events import PresenceChanged
+
+
+class PresenceProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint of the presence heartbeat
+    """
+    def __init__(self, presence):
+        self.presence = presence
+
+    def connection_made(self, transport):
+        self.presence.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.presence.receive(data, addr)
+
+    def error_received(self, exc):
+        # e.g. port unreachable, friends which went away time out
+        logging.debug("Presence datagram error: {!r}".format(exc))
+
+    def connection_lost(self, exc):
+        self.presence.transport = None
+
+
+class Presence:
+    """
+    UDP presence heartbeat.
+
+    Every interval seconds a signed beacon holding our status and P2P server port is sent to friends known to be online
+    (see track()). The quip server learns our status from setStatus requests, not beacons. A friend is online while their beacons arrive, and offline once none
+    arrived for timeout seconds or they send an offline beacon. Changes of a friend's status or address are published
+    as PresenceChanged events.
+
+    Beacons are signed for their recipient, so a beacon can't be replayed to another user from a different address.
+    """
+    def __init__(self, uid, signer, verifier, masks, tcp, publish, interval=60, timeout=180):
+        """
+        Presence constructor
+
+        @param uid: logged in user's uid
+        @param signer: SigningKey of the logged in user
+        @param verifier: callable returning the VerifyKey of a friend mask
+        @param masks: friend uid->mask container
+        @param tcp: P2P server port, sent in beacons
+        @param publish: callable publishing PresenceChanged events
+        @param interval: seconds between beacons
+        @param timeout: seconds without a beacon before a friend is offline
+        """
+        self.uid = uid
+        self.signer = signer
+        self.verifier = verifier
+        self.masks = masks
+        self.tcp = int(tcp)
+        self.publish = publish
+        self.interval = int(interval)
+        self.timeout = int(timeout)
+        self.status = CONS.STATUS_ONLINE
+        # friends beacons are sent to: uid -> (ip, udp port)
+        self.targets = {}
+        # friends beacons were received from: uid -> (received (monotonic), beacon stamp, status, (ip, tcp port))
+        self.peers = {}
+        self.port = None
+        self.loop = None
+        self.transport = None
+        self.task = None
+
+    @asyncio.coroutine
+    def start(self, loop, host, port):
+        """
+        Listen for beacons and start sending them
+
+        @param loop: event loop
+        @param host: address to listen on
+        @param port: UDP port to listen on, friends are first sent beacons on the same port
+        """
+        self.loop = loop
+        self.port = int(port)
+        yield from loop.create_datagram_endpoint(lambda: PresenceProtocol(self), local_addr=(host, self.port))
+        self.task = loop.create_task(self.run())
+
+    def stop(self):
+        """
+        Tell friends we are offline and stop sending beacons
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        if self.transport is not None:
+            self.status = CONS.STATUS_OFFLINE
+            self.beat()
+            self.transport.close()
+
+    def track(self, uid, ip, port=None):
+        """
+        Send beacons to a friend until theirs time out
+
+        @param uid: friend uid
+        @param ip: friend's IP address
+        @param port: (Optional) friend's UDP port, defaults to ours until the friend's beacons show theirs
+        """
+        if uid in self.targets:
+            return
+
+        addr = self.targets[uid] = (ip, port or self.port)
+        if self.transport is not None and self.status != CONS.STATUS_INVISIBLE:
+            # the friend replies with their own beacon
+            self.transport.sendto(self.beacon(uid), addr)
+
+    def setStatus(self, status):
+        """
+        Change our status, sending a beacon straight away
+        """
+        self.status = status
+        self.beat()
+
+    def beacon(self, recipient):
+        """
+        @param recipient: uid of the friend the beacon is sent to
+        @return: signed beacon of our current status
+        """
+        return self.signer.sign(CONS.PRESENCE_BEACON.pack(CONS.PRESENCE_VERSION, self.uid, recipient, self.status,
+                                                          self.tcp, int(time() * 1000)))
+
+    def beat(self):
+        """
+        Send a beacon to tracked friends, friends are not sent beacons while invisible
+        """
+        if self.transport is None or self.status == CONS.STATUS_INVISIBLE:
+            return
+
+        for uid, addr in self.targets.items():
+            self.transport.sendto(self.beacon(uid), addr)
+
+    def expire(self):
+        """
+        Mark friends whose beacons stopped arriving as offline
+        """
+        now = monotonic()
+        for uid, (received, stamp, status, address) in list(self.peers.items()):
+            if now - received > self.timeout:
+                self._offline(uid, address)
+
+    def _offline(self, uid, address):
+        del self.peers[uid]
+        self.targets.pop(uid, None)
+        self.publish(PresenceChanged(uid, CONS.STATUS_OFFLINE, address))
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Send beacons every interval seconds
+        """
+        while True:
+            self.beat()
+            self.expire()
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+
+    def receive(self, data, addr):
+        """
+        Process a received beacon
+
+        @param data: signed beacon
+        @param addr: (ip, udp port) the beacon was sent from
+        """
+        if len(data) != CONS.PRESENCE_SIZE:
+            return
+
+        version, origin, recipient, status, tcp, stamp = CONS.PRESENCE_BEACON.unpack(data[-CONS.PRESENCE_BEACON.size:])
+        if version != CONS.PRESENCE_VERSION or recipient != self.uid:
+            # the P2P address is taken from where the beacon was sent, only beacons signed for us are trusted with it
+            return
+
+        try:
+            self.verifier(self.masks[origin]).verify(data)
+        except (MissingFriend, BadSignatureError, TypeError, ValueError):
+            logging.info("\t".join(("Invalid presence beacon", "IP: {!r}".format(addr),
+                                     "Sent ID: {!r}".format(origin))))
+            return
+
+        peer = self.peers.get(origin)
+        if (peer is not None and stamp <= peer[1]) or abs(time() - stamp / 1000) > CONS.LIMIT_MESSAGE_TIME:
+            # replayed or stale beacon
+            return
+
+        address = (addr[0], str(tcp))
+        if status == CONS.STATUS_OFFLINE:
+            if peer is not None:
+                self._offline(origin, address)
+            return
+
+        self.peers[origin] = (monotonic(), stamp, status, address)
+        # the friend's beacons show the port reaching them
+        self.targets[origin] = addr
+        if peer is None:
+            if self.status != CONS.STATUS_INVISIBLE:
+                # let a friend coming online know we are online without waiting for the next beacon
+                self.transport.sendto(self.beacon(origin), addr)
+        elif peer[2:] == (status, address):
+            return
+
+        self.publish(PresenceChanged(origin, status, address))
@@ -12,12 +12,14 @@ from datetime import datetime
 from time import time
 from collections import defaultdict
 from hashlib import sha1
+import zlib
 from base64 import a85decode
+from functools import partial
 
 # third-party crypto libs
 from nacl.exceptions import BadSignatureError
 from nacl.secret import SecretBox
-from nacl.signing import VerifyKey
+from nacl.signing import VerifyKey, SigningKey
 from nacl.encoding import HexEncoder
 
 # third-part libs
@@ -25,18 +27,26 @@ from miniupnpc import UPnP
 
 # application modules
 from lib.Constants import REQ_FRIEND, INVITE_CHAT, RECV_FILE, RECV_MSG, COMMAND_LENGTH, BTRUE, BFALSE, \
-    INVALID_COMMAND, INVALID_DATA, REQ_FILE, TIMEOUT, RECV_AVATAR, LIMIT_MESSAGE_TIME
+    INVALID_COMMAND, INVALID_DATA, REQ_FILE, TIMEOUT, RECV_AVATAR, LIMIT_MESSAGE_TIME, SERVER_BUSY, WRITE_END, \
+    PROTOCOL_NEGOTIATE, PROTOCOL_VERSION, FRAME_HEADER, FRAME_SIGNED, RECV_CHUNK, FRAME_COMPRESSED, PROTOCOL_MULTIPLEX
 from lib.Containers import Masks, FileRequests
-from lib.Handlers import friendAcceptance, inviteChat, requestSendFile, receiveMessage, sendFile, receiveAvatar
-from lib.Database import getAuthority, getLocalAuth, getAccount
+from lib.Handlers import friendAcceptance, inviteChat, requestSendFile, receiveMessage, sendFile, receiveAvatar, \
+    sendChunk
+from lib.Database import getAuthority, getLocalAuth, getAccount, getSigningKeys, History, Cache
+from lib.Transfers import Transfers
+from lib.Multiplex import Multiplexer, MuxStream
+from lib.Presence import Presence
+from lib.Events import EventBus, MessageReceived, AvatarUpdated, FileRequest, FileSent, AuthPending
 from lib.Config import Configuration
 from lib.Utils import isValidUUID
+from lib.Exceptions import MissingFriend
 
 # Valid server commands
 Commands = {REQ_FRIEND: friendAcceptance,
             INVITE_CHAT: inviteChat,
             REQ_FILE: requestSendFile,
             RECV_FILE: sendFile,
+            RECV_CHUNK: sendChunk,
             RECV_MSG: receiveMessage,
             RECV_AVATAR: receiveAvatar}
 
@@ -68,8 +78,21 @@ class P2PServer:
         self.forwarded = False
         self.server = None
         self.sock = None
+        # seconds waited for a client's next command
         self.timeout = int(Config.idle_timeout)
-        #self.loop = asyncio.get_event_loop()
+        # seconds allowed to receive a command's data line
+        self.headerTimeout = int(Config.header_timeout)
+        # seconds a file or avatar transfer may stall
+        self.transferTimeout = int(Config.file_timeout)
+        self.loop = None
+        # connected client handling tasks, task -> peer address
+        self.tasks = {}
+        # simultaneous connection limit
+        self.maxConnections = int(Config.max_connections)
+        # StreamReader buffer limit for each connection
+        self.readLimit = int(Config.read_limit)
+        # maximum payload size of a v2 frame
+        self.maxFrame = int(Config.max_frame)
         self.host = host
         self.port = port
         self.certfile = certfile
@@ -79,18 +102,32 @@ class P2PServer:
         self.uid, _ = getAccount(self.safe, profileId)
 
         self.hashchain = defaultdict(bytes)
-        # messages awaiting to be read. uid -> [message, ]
-        self.messages = defaultdict(list)
-        # auth tokens awaiting server storage
-        self.auth = []
-        # new avatar received
-        self.avatar = False
+        # received messages, avatars, file requests, auth tokens and presence changes are published as events
+        self.events = EventBus()
         # incoming transfer requests
         self.fileRequests = FileRequests(self.safe, self.profileId)
         # outgoing transfers
         self.fileRequestsOut = FileRequests(self.safe, self.profileId, outgoing=True)
+        # Merkle trees of files sent in chunks: (checksum, chunk size, digest) -> tree levels
+        self.trees = {}
+        # files worth compressing: (checksum, codec) -> bool
+        self.compressible = {}
+        # upload slots held by connections: StreamWriter -> (mask, checksum) -> Transfer
+        self.transfers = defaultdict(dict)
+        # compression (codec, level) offered to protocol v5 clients, None to send uncompressed
+        self.compression = None
+        if Config.compression in ('zlib', 'lzma'):
+            self.compression = (bytes(Config.compression, encoding='ascii'), int(Config.compression_level))
         # friend uid->mask container
         self.friendMasks = Masks(self.safe, self.profileId)
+        # signature verifiers, mask -> VerifyKey. Populated on first use, see _verifier()
+        self.verifiers = {}
+        # drop verifiers when a friend's stored authority changes or the friend is deleted
+        Cache.listeners.append(self._invalidateVerifier)
+        # UDP presence heartbeat
+        self.presence = Presence(self.uid, SigningKey(getSigningKeys(self.safe, self.profileId)[0]), self._verifier,
+                                 self.friendMasks, self.port, self.events.publish, Config.presence_interval,
+                                 Config.presence_timeout)
 
         logging.basicConfig(filename='Logs/{:s}.log'.format(datetime.date(datetime.now()).isoformat()),
                             level=logging.DEBUG,
@@ -148,6 +185,39 @@ class P2PServer:
 
         return context
 
+    def _verifier(self, mask):
+        """
+        Return signature verifier for given friend
+
+        @param mask: friend mask
+        @return: VerifyKey object of friend's stored signing public key
+        """
+        try:
+            verifier = self.verifiers[mask]
+        except KeyError:
+            authority = getAuthority(self.safe, self.profileId, mask)
+            if not authority:
+                raise MissingFriend("No stored authority for friend mask: {}".format(mask))
+            verifier = self.verifiers[mask] = VerifyKey(authority[0], encoder=HexEncoder)
+
+        return verifier
+
+    def _invalidateVerifier(self, profileId, mask, names):
+        """
+        Cache invalidation listener, removes verifiers made from invalidated authority
+
+        @param profileId: profile ID of invalidated values
+        @param mask: friend mask of invalidated values, None for all friends
+        @param names: invalidated database function names, empty for all
+        """
+        if profileId != self.profileId or (names and 'getAuthority' not in names):
+            return
+
+        if mask is None:
+            self.verifiers.clear()
+        else:
+            self.verifiers.pop(mask, None)
+
     @asyncio.coroutine
     def _close_connection(self, writer, reason=None):
         """
@@ -188,31 +258,69 @@ class P2PServer:
         if command is receiveMessage:
             msg = yield from receiveMessage(self.safe, self.profileId, mask, data)
             if msg:
-                # uid-> [(rowid, message, tstamp), ...]
-                self.messages[msg[1]].append((msg[0], msg[2], None))
+                self.events.publish(MessageReceived(msg[1], msg[0], msg[2], None))
                 returnData = BTRUE
             else:
                 returnData = BFALSE
         elif command is receiveAvatar:
             returnData = yield from receiveAvatar(client_reader, client_writer, self.safe, self.profileId, mask,
-                                                  data[:-36 - COMMAND_LENGTH])
+                                                  data[:-36 - COMMAND_LENGTH], timeout=self.transferTimeout)
             if len(returnData) > 3:
-                self.avatar = True
+                self.events.publish(AvatarUpdated(data[-36:]))
         elif command is requestSendFile:
             # timeout set to config file_timeout
             fdata = yield from requestSendFile(self.safe, self.profileId, mask, data)
             if fdata:
                 # reload available incoming file transfer requests
                 self.fileRequests.reload()
+                self.events.publish(FileRequest(*fdata))
 
             returnData = BTRUE if fdata else BFALSE
         elif command is sendFile:
-            success = yield from sendFile(client_writer, self.safe, self.profileId, mask, data[:-36 - COMMAND_LENGTH],
-                                          Config.file_expiry, Config.max_chunk)
-            if not success and (mask, data[:-36 - COMMAND_LENGTH]) in self.fileRequestsOut.keys():
+            # sha1 checksum, optionally followed by the byte offset to resume from and (v5) offered compression codecs
+            checksum = data[:40]
+            offset, offered, codecs = data[40:-36 - COMMAND_LENGTH].partition(b':')
+            # wait for an upload slot, the transfer shares the slot of a chunked transfer of the same file
+            transfer = yield from self._uploadSlot(client_writer, mask, checksum)
+            try:
+                sent = yield from sendFile(client_writer, self.safe, self.profileId, mask, checksum,
+                                           Config.file_expiry, Config.max_chunk, timeout=self.transferTimeout,
+                                           watermarks=(Config.write_high, Config.write_low),
+                                           offset=offset or 0, codecs=codecs.split(b',') if offered else None,
+                                           compression=self.compression, throttle=transfer.throttle)
+            finally:
+                self._releaseUploads(client_writer, (mask, checksum))
+
+            if sent is not None:
+                self.events.publish(FileSent(data[-36:], checksum, sent))
+                # transfer complete (chunked transfers finish by requesting the end of the file)
+                for key in [k for k in self.trees if k[0] == checksum]:
+                    del self.trees[key]
+                for key in [k for k in self.compressible if k[0] == checksum]:
+                    del self.compressible[key]
+            elif (mask, checksum) in self.fileRequestsOut.keys():
                 self.fileRequestsOut.reload()
             # return no data as all communication is handled in the sendFile handler
             returnData = b''
+        elif command is sendChunk:
+            # sha1 checksum followed by chunk size, chunk index and optionally the Merkle tree digest and (v5) offered
+            # compression codecs
+            checksum = data[:40]
+            request = data[40:-36 - COMMAND_LENGTH].split(b':')
+            chunkSize, index = (request + [b''])[:2]
+            digest = request[2] if len(request) > 2 else b'sha1'
+            codecs = request[3].split(b',') if len(request) > 3 else None
+            # the upload slot is kept by the connection for following chunks, until the connection closes
+            transfer = yield from self._uploadSlot(client_writer, mask, checksum)
+            success = yield from sendChunk(client_writer, self.safe, self.profileId, mask, checksum, chunkSize, index,
+                                           Config.file_expiry, self.trees, timeout=self.transferTimeout,
+                                           digest=digest, codecs=codecs, compression=self.compression,
+                                           compressible=self.compressible, throttle=transfer.throttle,
+                                           loop=self.loop)
+            if not success and (mask, checksum) in self.fileRequestsOut.keys():
+                self.fileRequestsOut.reload()
+            # return no data as all communication is handled in the sendChunk handler
+            returnData = b''
         elif command is inviteChat:
             # chat invite
             returnData = yield from inviteChat(client_reader, data)
@@ -220,68 +328,177 @@ class P2PServer:
         return returnData
 
     @asyncio.coroutine
-    def _handle_client(self, client_reader, client_writer, address):
+    def _uploadSlot(self, client_writer, mask, checksum):
         """
-        This method actually does the work to handle the requests for a specific client. The protocol is byte AND line
-        oriented, the command is read first (8 bytes) and matched against available commands, the complete line (up to
-        64k) is read into memory and must end with newline character. The received data is verified against the received
-        user id's public key. Once verified, the matched command is executed.
+        Wait for an upload slot for a file (see lib.Transfers), slots are held by the connection until released
+
+        @param client_writer: StreamWriter of the connection
+        @param mask: friend mask
+        @param checksum: checksum of the sent file
+        @return: Transfer
+        """
+        held = self.transfers[client_writer]
+        if (mask, checksum) not in held:
+            held[(mask, checksum)] = yield from Transfers.acquire(mask, checksum, outgoing=True)
+
+        return held[(mask, checksum)]
+
+    def _releaseUploads(self, client_writer, key=None):
+        """
+        Release upload slots held by a connection
+
+        @param client_writer: StreamWriter of the connection
+        @param key: (Optional) (mask, checksum) of the slot to release, all slots if None
+        """
+        held = self.transfers.get(client_writer, {})
+        for k in [key] if key is not None else list(held):
+            if k in held:
+                Transfers.release(held.pop(k))
+
+        if not held:
+            self.transfers.pop(client_writer, None)
+
+    def _decompressFrame(self, data):
+        """
+        Decompress a compressed (v5) frame payload, up to max_frame bytes
+
+        @param data: zlib compressed payload
+        @return: payload, None if it is invalid or decompresses beyond max_frame bytes
+        """
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data, self.maxFrame)
+        except zlib.error:
+            return None
+
+        return data if not decompressor.unconsumed_tail and decompressor.eof else None
+
+    @asyncio.coroutine
+    def _read_command(self, client_reader, client_writer, address, version):
+        """
+        Read the next command and its data from the client.
+
+        Protocol v1 is byte AND line oriented, the command is read first (8 bytes) followed by a newline terminated line
+        of (ASCII85 encoded, if signed) data, up to read_limit bytes. Protocol v2 frames are a FRAME_HEADER (command,
+        flags and payload length) followed by the raw payload, up to max_frame bytes.
 
         @param client_reader: StreamReader object
         @param client_writer: StreamWriter object
+        @param address: client's peer address
+        @param version: negotiated protocol version
+        @return: (command coroutine, data, flags), or (None, None, None) if the connection has been closed
         """
-        while True:
-            # recevied incoming data time stamp
-            stamp = int(time())
-            # read command first, only take first 8 bytes
-            cmd = yield from client_reader.readexactly(COMMAND_LENGTH)
+        try:
+            if version > 1:
+                header = yield from asyncio.wait_for(client_reader.readexactly(FRAME_HEADER.size), self.timeout)
+            else:
+                cmd = yield from asyncio.wait_for(client_reader.readexactly(COMMAND_LENGTH), self.timeout)
+        except asyncio.TimeoutError:
+            # idle connection
+            yield from self._close_connection(client_writer)
+            return None, None, None
+
+        if version > 1:
+            cmd, flags, length = FRAME_HEADER.unpack(header)
+            if length > self.maxFrame:
+                logging.info("\t".join(("Frame exceeds maximum size", "IP: {!r}".format(address),
+                                        "Length: {}".format(length))))
+                yield from self._close_connection(client_writer, INVALID_DATA)
+                return None, None, None
+        else:
+            flags = None
 
-            if not cmd:
-                # nothing received from client
-                break
+        # check received command is valid
+        try:
+            command = Commands[int(cmd)] if int(cmd) != PROTOCOL_NEGOTIATE else PROTOCOL_NEGOTIATE
+        except (ValueError, KeyError):
+            logging.info("\t".join(("Invalid Command Provided By Client",
+                                    "IP: {!r}".format(address),
+                                    "Command: {!r}".format(cmd))))
+            yield from self._close_connection(client_writer, INVALID_COMMAND)
+            return None, None, None
 
-            ################
-            # Data checking
-            ################
+        try:
+            if version > 1:
+                data = yield from asyncio.wait_for(client_reader.readexactly(length), self.headerTimeout)
+                if flags & FRAME_COMPRESSED:
+                    data = self._decompressFrame(data)
+                    if data is None:
+                        logging.info("\t".join(("Invalid compressed frame", "IP: {!r}".format(address))))
+                        yield from self._close_connection(client_writer, INVALID_DATA)
+                        return None, None, None
+            else:
+                # use of encoded data allows for direct readline()
+                data = yield from asyncio.wait_for(client_reader.readline(), self.headerTimeout)
+                # clear up data before proceeding (i.e newline char)
+                data = data.strip()
+                # v1 signs all commands except friendship completion
+                flags = FRAME_SIGNED if command not in (friendAcceptance, PROTOCOL_NEGOTIATE) else 0
+        except asyncio.TimeoutError:
+            yield from self._close_connection(client_writer, TIMEOUT)
+            return None, None, None
 
-            # check received command is valid
-            try:
-                command = Commands[int(cmd)]
-            except ValueError:
-                logging.info("\t".join(("Invalid Command Provided By Client",
-                                        "IP: {!r}".format(address),
-                                        "Command: {!r}".format(cmd))))
-                yield from self._close_connection(client_writer, INVALID_COMMAND)
-                return
+        return command, data, flags
 
-            try:
-                # use of encoded data allows for direct readline()
-                data = yield from client_reader.readline()
+    @asyncio.coroutine
+    def _handle_client(self, client_reader, client_writer, address, version=1):
+        """
+        This method actually does the work to handle the requests for a specific client. Each command is read (see
+        _read_command) and matched against available commands. The received data is verified against the received
+        user id's public key. Once verified, the matched command is executed.
 
-            except asyncio.futures.TimeoutError:
-                yield from self._close_connection(client_writer, TIMEOUT)
+        Connections start in protocol v1 and switch to v2 framing once the client negotiates it (PROTOCOL_NEGOTIATE).
+        Connections negotiating v6 are multiplexed from then on, each stream is handled as a connection of its own
+        (see _multiplex). Connections are closed when no command is received within idle_timeout seconds, or a
+        command's data is not received within header_timeout seconds.
+
+        @param client_reader: StreamReader object
+        @param client_writer: StreamWriter object
+        @param address: client's peer address, followed by the stream id for multiplexed streams
+        @param version: protocol version the connection starts in
+        """
+        while True:
+            # recevied incoming data time stamp
+            stamp = int(time())
+
+            command, data, flags = yield from self._read_command(client_reader, client_writer, address, version)
+            if command is None:
                 return
 
-            # clear up data before proceeding (i.e newline char)
-            data = data.strip()
+            if command == PROTOCOL_NEGOTIATE:
+                # client requested protocol version, respond with the version used from now on
+                try:
+                    version = max(1, min(int(data), PROTOCOL_VERSION))
+                except ValueError:
+                    version = 1
+                client_writer.write(b''.join((bytes(str(version), encoding='ascii'), WRITE_END)))
+                yield from client_writer.drain()
+                if version >= PROTOCOL_MULTIPLEX and not isinstance(client_writer, MuxStream):
+                    yield from self._multiplex(client_reader, client_writer, address, version)
+                    return
+                continue
 
             ################
             # Authorisation
             ################
             if command != friendAcceptance:
-                try:
-                    data = a85decode(data, foldspaces=True)
-                except ValueError:
-                    logging.info("Invalid data received, unable to decode as ASCII85")
-                    yield from self._close_connection(client_writer, INVALID_COMMAND)
+                if not flags & FRAME_SIGNED:
+                    logging.info("Unsigned data received for command requiring authorisation")
+                    yield from self._close_connection(client_writer, INVALID_DATA)
                     return
 
+                if version == 1:
+                    try:
+                        data = a85decode(data, foldspaces=True)
+                    except ValueError:
+                        logging.info("Invalid data received, unable to decode as ASCII85")
+                        yield from self._close_connection(client_writer, INVALID_COMMAND)
+                        return
+
                 # verify data integrity
                 try:
-                    # using getAuthority hits the disk db
-                    data = VerifyKey(getAuthority(self.safe, self.profileId, self.friendMasks[data[-36:]])[0],
-                                     encoder=HexEncoder).verify(data)
-                except (BadSignatureError, TypeError):
+                    data = self._verifier(self.friendMasks[data[-36:]]).verify(data)
+                except (BadSignatureError, TypeError, MissingFriend):
                     # signed data does not match stored public key for provided user id
                     logging.warning('\t'.join(("Unable to verify sent data",
                                                "IP: {!r}".format(address),
@@ -312,6 +529,7 @@ class P2PServer:
                         logging.warning("Message Integrity Failure: Message time {!r} is invalid".format(tstamp))
 
                 if integrity and isValidUUID(origin):
+                    # chains are kept per connection, multiplexed streams are keyed by their stream id (see _serve_stream)
                     hchain = bytes(sha1(b''.join((self.hashchain[address], data))).hexdigest(), encoding='ascii')
                     if hchain != chain:
                         logging.warning("Message Integrity Failure: Provided hash chain {!r} does not match local {!r}".format(chain, hchain))
@@ -330,7 +548,7 @@ class P2PServer:
                 except (ValueError, AssertionError):
                     logging.info('\t'.join(("Client unsigned CMD data does not equal signed CMD",
                                             "IP: {!r}".format(address),
-                                            "Unsigned Command: {!r}".format(cmd),
+                                            "Unsigned Command: {!r}".format(command),
                                             "Signed Command: {!r}".format(data[-COMMAND_LENGTH:]))))
                     yield from self._close_connection(client_writer, INVALID_DATA)
                     return
@@ -341,9 +559,10 @@ class P2PServer:
                 # data verified, execute command with data and origin user id
                 returnData = yield from self._command_dispatch(client_reader, client_writer, command, b''.join((data, origin)))
             else:
-                returnData, authToken = yield from friendAcceptance(client_reader, client_writer, self.safe, self.profileId, data)
+                returnData, authToken = yield from friendAcceptance(client_reader, client_writer, self.safe, self.profileId,
+                                                                    data.strip())
                 if authToken is not None:
-                    self.auth.append(authToken)
+                    self.events.publish(AuthPending(authToken))
 
             # send command result to client
             client_writer.write(returnData)
@@ -352,20 +571,89 @@ class P2PServer:
             yield from client_writer.drain()
 
     @asyncio.coroutine
+    def _multiplex(self, client_reader, client_writer, address, version):
+        """
+        Serve the streams of a multiplexed (v6) connection until the connection closes
+
+        @param client_reader: StreamReader object
+        @param client_writer: StreamWriter object
+        @param address: client's peer address
+        @param version: negotiated protocol version
+        """
+        mux = Multiplexer(client_reader, client_writer, self.loop, handler=partial(self._serve_stream, address, version),
+                          limit=self.readLimit, timeout=self.timeout)
+        yield from mux.run()
+
+    @asyncio.coroutine
+    def _serve_stream(self, address, version, stream):
+        """
+        Handle the commands of a multiplexed stream, each stream has its own hash chain
+
+        @param address: client's peer address
+        @param version: negotiated protocol version
+        @param stream: MuxStream opened by the client
+        """
+        address = address + (stream.id,)
+        try:
+            yield from self._serve_client(stream, stream, address, version)
+        finally:
+            self.hashchain.pop(address, None)
+
     def _accept_client(self, client_reader, client_writer):
         """
         Callback method used by start_server (or create_server).
 
-        Accepts a new client connection and dispatch asynchronous client handling
+        Accepts a new client connection and dispatches a task to handle it. Connections beyond the configured maximum
+        are rejected with SERVER_BUSY.
         """
         address = client_writer.transport.get_extra_info('peername')
+
+        if len(self.tasks) >= self.maxConnections:
+            logging.warning("Connection limit of {} reached, rejecting client {!r}".format(self.maxConnections, address))
+            self.loop.create_task(self._close_connection(client_writer, SERVER_BUSY))
+            return
+
         # reset hash chain on new connection
         self.hashchain[address] = b''
         # start a new Task to handle this specific client connection
-        #task = asyncio.Task(self._handle_client(client_reader, client_writer, address))
-        #loop = asyncio.get_event_loop()
-       # task = loop.create_task(self._handle_client(client_reader, client_writer, address))
-        yield from self._handle_client(client_reader, client_writer, address)
+        task = self.loop.create_task(self._serve_client(client_reader, client_writer, address))
+        self.tasks[task] = address
+        task.add_done_callback(self._client_done)
+
+    @asyncio.coroutine
+    def _serve_client(self, client_reader, client_writer, address, version=1):
+        """
+        Run client handling until the connection ends, ensuring the connection is closed
+
+        @param client_reader: StreamReader object
+        @param client_writer: StreamWriter object
+        @param address: client's peer address
+        @param version: (Optional) protocol version the connection starts in
+        """
+        try:
+            yield from self._handle_client(client_reader, client_writer, address, version)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # client disconnected
+            pass
+        except ValueError:
+            # StreamReader limit exceeded
+            logging.warning("Client {!r} exceeded read limit of {} bytes".format(address, self.readLimit))
+        except Exception:
+            logging.error("Client {!r} handling failed".format(address), exc_info=True)
+        finally:
+            self._releaseUploads(client_writer)
+            client_writer.close()
+
+    def _client_done(self, task):
+        """
+        Client handling task completion callback, releases connection state
+
+        @param task: completed client handling task
+        """
+        address = self.tasks.pop(task, None)
+        self.hashchain.pop(address, None)
 
     def portForward(self, port=None, protocol='TCP'):
         if port:
@@ -402,16 +690,26 @@ class P2PServer:
         # use created SSLContext with create_server() or start_server() (abstracts create_server(), takes direct callback
         #  instead of Protocol Factory) (see PEP 3156)
 
+        self.loop = loop
         self.server = loop.run_until_complete(
             asyncio.streams.start_server(self._accept_client,
                                          loop=loop,
+                                         limit=self.readLimit,
                                          ssl=self._createSSLContext(),
                                          sock=self._createSocket()))
 
+        try:
+            loop.run_until_complete(self.presence.start(loop, self.host, Config.udp))
+        except OSError:
+            # presence is then only known from the quip server
+            logging.warning("Unable to start presence heartbeat on UDP port {}".format(Config.udp), exc_info=True)
+
     def stop(self, loop):
         """
         Stops the TCP server, closes the listening socket(s).
         """
+        self.presence.stop()
+
         # clear port-forwarding rule on router
         if self.forwarded:
             try:
@@ -424,6 +722,24 @@ class P2PServer:
             loop.run_until_complete(self.server.wait_closed())
             self.server = None
 
+        # end connected client handling
+        if self.tasks:
+            for task in self.tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.wait(list(self.tasks), loop=loop))
+            self.tasks.clear()
+
+        # write queued chat history
+        History.flush()
+
+        try:
+            Cache.listeners.remove(self._invalidateVerifier)
+        except ValueError:
+            pass
+        self.verifiers.clear()
+        self.trees.clear()
+        self.compressible.clear()
+
 def runServer(profileId, phrase, certfile=None, keyfile=None, loop=None, host=None, port=None):
     """
     Initiate P2P Server
@@ -0,0 +1,266 @@
+#
+# File transfer scheduling and rate limiting
+#
+import asyncio
+import logging
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+from lib.Config import Configuration
+from lib.Exceptions import TransferCancelled
+
+Config = Configuration()
+
+# transfer states
+QUEUED = 'queued'
+ACTIVE = 'active'
+PAUSED = 'paused'
+CANCELLED = 'cancelled'
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Data larger than the bucket is allowed through by going into debt, later consumers wait
+    for the debt to be repaid so the long term rate holds.
+    """
+    def __init__(self, rate, burst=None):
+        """
+        Token bucket constructor
+
+        @param rate: bytes per second, 0 for unlimited
+        @param burst: (Optional) bucket size in bytes, defaults to one second of data
+        """
+        self.rate = int(rate)
+        self.burst = int(burst) if burst is not None else self.rate
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    @asyncio.coroutine
+    def consume(self, amount):
+        """
+        Take amount tokens from the bucket, waiting until the bucket is no longer in debt
+
+        @param amount: number of bytes
+        """
+        if self.rate <= 0:
+            return
+
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        self.tokens -= amount
+        if self.tokens < 0:
+            yield from asyncio.sleep(-self.tokens / self.rate)
+
+
+class Transfer:
+    """
+    Scheduled file transfer
+    """
+    def __init__(self, manager, mask, checksum, outgoing, priority):
+        """
+        Transfer constructor
+
+        @param manager: TransferManager scheduling this transfer
+        @param mask: friend mask
+        @param checksum: checksum of the transferred file
+        @param outgoing: True for uploads, False for downloads
+        @param priority: lower values are started first
+        """
+        self.manager = manager
+        self.mask = mask
+        self.checksum = checksum
+        self.outgoing = outgoing
+        self.priority = priority
+        self.state = QUEUED
+        # number of connections using this transfer (chunked transfers share one slot)
+        self.refs = 0
+        # completed when the transfer may start
+        self.ready = asyncio.Future()
+        # set while the transfer is not paused
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+    @property
+    def key(self):
+        return self.outgoing, self.mask, self.checksum
+
+    @asyncio.coroutine
+    def throttle(self, amount):
+        """
+        Wait before transferring data, while the transfer is paused and until the rate limit allows amount bytes
+
+        @param amount: number of bytes about to be transferred
+        """
+        while self.state == PAUSED:
+            yield from self.resumed.wait()
+
+        if self.state == CANCELLED:
+            raise TransferCancelled("Transfer of {} cancelled".format(self.checksum))
+
+        yield from (self.manager.upload if self.outgoing else self.manager.download).consume(amount)
+
+
+class TransferManager:
+    """
+    Schedules uploads and downloads, limiting the number of transfers running at once (globally and per friend) and
+    their combined upload and download rates.
+
+    Transfers wait in a priority queue until a slot is free (see acquire()), data loops call Transfer.throttle()
+    before sending or after receiving data, and release() frees the slot once the transfer ends.
+    """
+    def __init__(self, maxTransfers=4, maxFriendTransfers=2, uploadRate=0, downloadRate=0):
+        """
+        Transfer manager constructor
+
+        @param maxTransfers: maximum number of transfers running at once
+        @param maxFriendTransfers: maximum number of transfers with a single friend running at once
+        @param uploadRate: bytes per second shared by all uploads, 0 for unlimited
+        @param downloadRate: bytes per second shared by all downloads, 0 for unlimited
+        """
+        self.maxTransfers = int(maxTransfers)
+        self.maxFriendTransfers = int(maxFriendTransfers)
+        self.upload = TokenBucket(uploadRate)
+        self.download = TokenBucket(downloadRate)
+        # (outgoing, mask, checksum) -> Transfer
+        self.transfers = {}
+        # (priority, order, key) heap of queued transfers
+        self.queue = []
+        self.order = count()
+
+    def _running(self, mask=None):
+        """
+        @param mask: (Optional) only count transfers with this friend
+        @return: number of running (not paused) transfers
+        """
+        return sum(1 for t in self.transfers.values() if t.state == ACTIVE and (mask is None or t.mask == mask))
+
+    def _schedule(self):
+        """
+        Start queued transfers in priority order while the limits allow, transfers with a friend already at their
+        limit do not hold up transfers with other friends
+        """
+        waiting = []
+        while self.queue and self._running() < self.maxTransfers:
+            item = heappop(self.queue)
+            transfer = self.transfers.get(item[2])
+            if transfer is None or transfer.state != QUEUED:
+                continue
+
+            if self._running(transfer.mask) >= self.maxFriendTransfers:
+                waiting.append(item)
+                continue
+
+            transfer.state = ACTIVE
+            transfer.ready.set_result(True)
+
+        for item in waiting:
+            heappush(self.queue, item)
+
+    @asyncio.coroutine
+    def acquire(self, mask, checksum, outgoing, priority=0):
+        """
+        Wait for a transfer slot. Connections of a transfer which is already running share its slot.
+
+        @param mask: friend mask
+        @param checksum: checksum of the transferred file
+        @param outgoing: True for uploads, False for downloads
+        @param priority: (Optional) lower values are started first
+        @return: Transfer, must be passed to release() when the transfer ends
+        """
+        key = (outgoing, mask, checksum)
+        transfer = self.transfers.get(key)
+        if transfer is None:
+            transfer = self.transfers[key] = Transfer(self, mask, checksum, outgoing, priority)
+            heappush(self.queue, (priority, next(self.order), key))
+            self._schedule()
+
+        transfer.refs += 1
+        try:
+            yield from asyncio.shield(transfer.ready)
+        except asyncio.CancelledError:
+            self.release(transfer)
+            raise
+
+        return transfer
+
+    def release(self, transfer):
+        """
+        Free a connection's use of a transfer slot, the slot is free once no connection is using it
+
+        @param transfer: Transfer returned by acquire()
+        """
+        transfer.refs -= 1
+        if transfer.refs <= 0 and self.transfers.get(transfer.key) is transfer:
+            del self.transfers[transfer.key]
+            if not transfer.ready.done():
+                transfer.ready.cancel()
+            self._schedule()
+
+    def find(self, mask, checksum, outgoing):
+        """
+        @return: queued or running Transfer, None if there is no such transfer
+        """
+        return self.transfers.get((outgoing, mask, checksum))
+
+    def pause(self, mask, checksum, outgoing):
+        """
+        Pause a running transfer, its slot is given to the next queued transfer until resumed
+
+        @return: True if the transfer was paused
+        """
+        transfer = self.find(mask, checksum, outgoing)
+        if transfer is None or transfer.state != ACTIVE:
+            return False
+
+        transfer.state = PAUSED
+        transfer.resumed.clear()
+        self._schedule()
+        return True
+
+    def resume(self, mask, checksum, outgoing):
+        """
+        Resume a paused transfer
+
+        @return: True if the transfer was resumed
+        """
+        transfer = self.find(mask, checksum, outgoing)
+        if transfer is None or transfer.state != PAUSED:
+            return False
+
+        transfer.state = ACTIVE
+        transfer.resumed.set()
+        return True
+
+    def cancel(self, mask, checksum, outgoing):
+        """
+        Cancel a queued or running transfer, its next throttle() call raises TransferCancelled
+
+        @return: True if the transfer was cancelled
+        """
+        transfer = self.find(mask, checksum, outgoing)
+        if transfer is None or transfer.state == CANCELLED:
+            return False
+
+        transfer.state = CANCELLED
+        transfer.resumed.set()
+        if not transfer.ready.done():
+            # queued connections continue to their first throttle() call
+            transfer.ready.set_result(False)
+
+        logging.info("\t".join(("File Transfer Cancelled", "Mask: {}".format(mask), "Checksum: {}".format(checksum))))
+        self._schedule()
+        return True
+
+    def status(self):
+        """
+        @return: (outgoing, mask, checksum) -> (state, priority) of all queued and running transfers
+        """
+        return {k: (t.state, t.priority) for k, t in self.transfers.items()}
+
+
+# transfers of the running client, shared by the P2P server (uploads) and client (downloads)
+Transfers = TransferManager(Config.max_transfers, Config.max_friend_transfers, Config.upload_rate,
+                            Config.download_rate)
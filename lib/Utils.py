@@ -5,13 +5,35 @@ import sys
 from functools import partial
 from uuid import UUID
 from hashlib import sha1
+try:
+    # python 3.6+
+    from hashlib import blake2b
+except ImportError:
+    blake2b = None
 from os import path, listdir
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
 from zipfile import ZipFile
 from subprocess import Popen, TimeoutExpired
 
 import nacl.utils
 import nacl.secret
 
+# Merkle tree digests which may be negotiated for chunked file transfers, all produce 20 byte hashes
+DIGESTS = {b'sha1': sha1}
+if blake2b is not None:
+    DIGESTS[b'blake2b'] = partial(blake2b, digest_size=20)
+
+# compression codecs which may be negotiated for file transfers: name -> (compressor(level), decompressor())
+CODECS = {b'zlib': (zlib.compressobj, zlib.decompressobj)}
+CODEC_ERRORS = (zlib.error,)
+if lzma is not None:
+    CODECS[b'lzma'] = (lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor)
+    CODEC_ERRORS += (lzma.LZMAError,)
+
 def isValidUUID(uid):
     """
     Validate UUID
@@ -47,7 +69,7 @@ def encrypt(safe, *args):
     """
     return (safe.encrypt(a, nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)) for a in args)
 
-def sha1sum(filePath, blocksize=1024):
+def sha1sum(filePath, blocksize=1048576):
     """
     Calculate SHA1 hash of file
 
@@ -62,6 +84,124 @@ def sha1sum(filePath, blocksize=1024):
 
     return bytes(out.hexdigest(), encoding='ascii')
 
+def merkleLeaf(chunk, digest=sha1):
+    """
+    Calculate Merkle tree leaf hash of a file chunk
+
+    @param chunk: chunk data
+    @param digest: hash constructor, see DIGESTS
+    @return: digest (bytes)
+    """
+    return digest(b''.join((b'\x00', chunk))).digest()
+
+def merkleTree(filePath, chunkSize, digest=sha1):
+    """
+    Calculate Merkle tree of a file split into chunkSize chunks.
+
+    Leaf and node hashes are prefixed with different bytes so a leaf can never be mistaken for a node. A node without
+    a sibling is promoted to the next level unchanged.
+
+    @param filePath: Path to hashable file
+    @param chunkSize: number of bytes in each leaf chunk
+    @param digest: hash constructor, see DIGESTS
+    @return: list of tree levels (lists of digests), leaves first and the root level last
+    """
+    with open(filePath, mode='rb') as f:
+        return merkleLevels([merkleLeaf(buf, digest) for buf in iter(partial(f.read, chunkSize), b'')] or
+                            [merkleLeaf(b'', digest)], digest)
+
+def merkleLevels(leaves, digest=sha1):
+    """
+    Calculate the levels of a Merkle tree from its leaf hashes, see merkleTree()
+
+    @param leaves: list of leaf hashes, see merkleLeaf()
+    @param digest: hash constructor, see DIGESTS
+    @return: list of tree levels (lists of digests), leaves first and the root level last
+    """
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([digest(b''.join((b'\x01', level[i], level[i + 1]))).digest() if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+
+    return levels
+
+def merkleProof(levels, index):
+    """
+    Return the sibling hashes needed to verify a leaf against the tree root
+
+    @param levels: Merkle tree levels, see merkleTree()
+    @param index: leaf index
+    @return: list of digests, from the leaf level upwards
+    """
+    proof = []
+    for level in levels[:-1]:
+        if index ^ 1 < len(level):
+            proof.append(level[index ^ 1])
+        index //= 2
+
+    return proof
+
+def merkleVerify(leaf, index, count, proof, root, digest=sha1):
+    """
+    Verify a leaf hash belongs to a Merkle tree
+
+    @param leaf: leaf hash, see merkleLeaf()
+    @param index: leaf index
+    @param count: total number of leaves in the tree
+    @param proof: sibling hashes, see merkleProof()
+    @param root: expected tree root hash
+    @param digest: hash constructor, see DIGESTS
+    @return: True if the leaf and proof produce the root hash, otherwise False
+    """
+    proof = list(proof)
+    node = leaf
+    while count > 1:
+        if index ^ 1 < count:
+            if not proof:
+                return False
+            sibling = proof.pop(0)
+            node = digest(b''.join((b'\x01', sibling, node) if index & 1 else (b'\x01', node, sibling))).digest()
+        index //= 2
+        count = (count + 1) // 2
+
+    return not proof and node == root
+
+def chooseCodec(sample, offered, preferred, level, ratio=0.9):
+    """
+    Choose the compression codec for data starting with sample
+
+    @param sample: start of the data to be compressed
+    @param offered: codec names the receiver is able to decompress
+    @param preferred: codec name to use when worthwhile
+    @param level: compression level (zlib) or preset (lzma)
+    @param ratio: maximum compressed size of the sample, as a fraction of its size
+    @return: codec name, None when the data should be sent uncompressed
+    """
+    if preferred not in offered or preferred not in CODECS or not sample:
+        return None
+
+    compressor = CODECS[preferred][0](level)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+
+    return preferred if compressed < len(sample) * ratio else None
+
+def decompress(codec, data, limit):
+    """
+    Decompress data, producing at most limit + 1 bytes where supported (so oversized output can be detected)
+
+    @param codec: codec name, see CODECS
+    @param data: compressed data
+    @param limit: expected maximum decompressed size
+    @return: decompressed data
+    """
+    decompressor = CODECS[codec][1]()
+    try:
+        return decompressor.decompress(data, limit + 1)
+    except TypeError:
+        # lzma before python 3.5 has no output limit
+        return decompressor.decompress(data)
+
 def checkCerts():
     """
     Checks to see if required TLS certificates exist in Resources directory. Attempts to generate certificates if not found
@@ -0,0 +1,137 @@
+#
+# P2P client tests
+#
+import asyncio
+import unittest
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+from hashlib import sha1
+from unittest import mock
+
+import lib.Constants as CONS
+from lib.Client import TLSClient, P2PClient
+from lib.Multiplex import MuxStream
+
+
+class StubReader:
+    """
+    Connection answering protocol negotiation with the given lines, then staying silent
+    """
+    def __init__(self, lines, loop):
+        self.lines = list(lines)
+        self.loop = loop
+
+    @asyncio.coroutine
+    def readline(self):
+        return self.lines.pop(0) if self.lines else b''
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        # no frames arrive from the peer
+        return (yield from asyncio.Future(loop=self.loop))
+
+
+class StubWriter:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class YieldingWriter(StubWriter):
+    """
+    Writer whose drain lets other tasks run, like a stream waiting on its send window
+    """
+    @asyncio.coroutine
+    def drain(self):
+        yield from asyncio.sleep(0)
+
+
+class MultiplexedConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addr = ('127.0.0.1', 5555)
+        self.reader = StubReader([bytes(str(CONS.PROTOCOL_MULTIPLEX), encoding='ascii') + CONS.WRITE_END], self.loop)
+        self.writer = StubWriter()
+
+        # client state used by connections, without a profile
+        self.client = P2PClient.__new__(P2PClient)
+        self.client.loop = self.loop
+        self.client.connections = {}
+        self.client.protocols = {}
+        self.client.muxes = {}
+
+    def tearDown(self):
+        for mux in self.client.muxes.values():
+            mux.close()
+        self.client.muxes.clear()
+        self.client.connections.clear()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.loop.close()
+
+    def _connect(self, client, server, port, key=None):
+        stamp = datetime.utcnow()
+        client.connections[key or (server, port)] = (self.reader, self.writer, stamp)
+        return self.reader, self.writer, stamp
+
+    def test_stream_keeps_connection_open(self):
+        connect = asyncio.coroutine(lambda client, server, port, key=None: self._connect(client, server, port, key))
+        with mock.patch.object(TLSClient, '_connect_host', connect):
+            reader, writer, stamp = self.loop.run_until_complete(self.client._connect_host(*self.addr))
+            # the control stream's opening frame is sent over the connection
+            self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+
+        self.assertEqual(self.client.protocols[self.addr], CONS.PROTOCOL_MULTIPLEX)
+        self.assertIsInstance(reader, MuxStream)
+        self.assertIs(self.client.connections[self.addr][0], reader)
+        self.assertFalse(self.writer.closed)
+        self.assertFalse(self.client.muxes[self.addr].closed)
+
+
+class HashChainTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.uid = bytes(36)
+        self.writer = YieldingWriter()
+
+        # client state used by signed sends, without a profile
+        self.client = P2PClient.__new__(P2PClient)
+        self.client.loop = self.loop
+        self.client.uid = b'1' * 36
+        self.client.hashchain = defaultdict(bytes)
+        self.client.chainLocks = defaultdict(partial(asyncio.Lock, loop=self.loop))
+        self.client.friends = {self.uid: ('127.0.0.1', 5555)}
+        self.client.signer = mock.Mock(sign=lambda data: data)
+        self.client._frame = lambda addr, command, data, sign: data
+        self.client._connection = asyncio.coroutine(lambda uid, addr, channel: (None, self.writer, datetime.utcnow()))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_concurrent_sends_extend_chain(self):
+        messages = [b'first', b'second', b'third']
+        sends = [asyncio.ensure_future(self.client.send(self.uid, CONS.RECV_MSG, message), loop=self.loop)
+                 for message in messages]
+        self.loop.run_until_complete(asyncio.gather(*sends, loop=self.loop))
+
+        # data written as: timestamp, hash chain hex, destination user id, data, sender user id
+        chain = b''
+        for written, message in zip(self.writer.written, messages):
+            chain = bytes(sha1(b''.join((chain, message))).hexdigest(), encoding='ascii')
+            self.assertEqual(written[10:50], chain)
+            self.assertEqual(written[86:-36], message)
+        self.assertEqual(self.client.hashchain[self.uid], chain)
+
+
+if __name__ == '__main__':
+    unittest.main()
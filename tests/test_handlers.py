@@ -0,0 +1,69 @@
+#
+# P2P server command handler tests
+#
+import asyncio
+import os
+import unittest
+from tempfile import mkstemp
+from unittest import mock
+
+from lib import Handlers
+
+
+class StubWriter:
+    def __init__(self):
+        self.written = []
+        self.transport = mock.Mock()
+
+    def write(self, data):
+        self.written.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+class SendFileTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.data = os.urandom(10000)
+        fd, self.filename = mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.writer = StubWriter()
+
+    def tearDown(self):
+        os.remove(self.filename)
+        self.loop.close()
+
+    def _send(self, **kwargs):
+        outgoing = asyncio.coroutine(lambda *args: (self.filename, len(self.data), 1))
+        with mock.patch.object(Handlers, '_outgoingFile', outgoing), \
+                mock.patch.object(Handlers, 'delFileRequests') as delFileRequests:
+            sent = self.loop.run_until_complete(Handlers.sendFile(self.writer, None, None, None, b'0' * 40, 7,
+                                                                  blockSize=4096, **kwargs))
+
+        return sent, delFileRequests
+
+    def test_reports_bytes_sent(self):
+        sent, delFileRequests = self._send()
+
+        self.assertEqual(sent, len(self.data))
+        self.assertEqual(b''.join(self.writer.written), self.data)
+        delFileRequests.assert_called_once_with(1)
+
+    def test_reports_bytes_sent_from_offset(self):
+        sent, _ = self._send(offset=6000)
+
+        self.assertEqual(sent, len(self.data) - 6000)
+        self.assertEqual(b''.join(self.writer.written), self.data[6000:])
+
+    def test_failure_reports_nothing(self):
+        sent, delFileRequests = self._send(offset=len(self.data) + 1)
+
+        self.assertIsNone(sent)
+        self.assertFalse(delFileRequests.called)
+
+
+if __name__ == '__main__':
+    unittest.main()